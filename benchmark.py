@@ -0,0 +1,549 @@
+import argparse
+import copy
+import json
+import os
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+from models.encoder_decoder import *
+from tools.Constants import *
+from tools.Dataloader import Dataset, vocab_collate_func
+from tools.preprocess import prepareData
+from tools.beam import Beam
+from eval import evaluate
+from train import train
+from tools.simultaneous import IncrementalEncoder
+from tools.batch_split import BatchSplitter
+from tools.token_bleu import TokenBLEU
+from tools.bleu_calculation import BLEUCalculator
+
+# Offline CPU benchmarks on a synthetic corpus, no IWSLT files or fastText vectors needed:
+#   python benchmark.py --output results/bench-new.jsonl
+#   python benchmark.py --output results/bench-new.jsonl --compare results/bench-old.jsonl
+# Every result line holds the median time of one benchmark; --compare prints old/new per benchmark.
+
+
+def synthetic_sentence(rng, length, vocab, probs):
+    return ' '.join(vocab[rng.choice(len(vocab), size=length, p=probs)])
+
+
+def to_word(rank):
+    "a distinct lowercase word per rank, survives normalizeString and normalizeSource"
+    word = ""
+    while rank > 0:
+        rank, d = divmod(rank, 26)
+        word += chr(ord('a') + d)
+    return word
+
+
+def make_corpus(path, language, n_train, n_dev, seed=0):
+    """
+    Write a synthetic iwslt-<language>-en corpus in the layout readLangs expects.
+    Token frequencies are zipfian and sentence lengths log-normal with a long
+    tail, roughly like IWSLT talks; target length follows source length.
+    """
+    rng = np.random.RandomState(seed)
+    ranks = np.arange(1, 20001)
+    probs = 1. / ranks ** 1.1
+    probs /= probs.sum()
+    target_vocab = np.array([to_word(r) for r in ranks], dtype=object)
+    if language == "zh":
+        source_vocab = np.array([chr(0x4e00 + r) for r in ranks[:5000]], dtype=object)
+        source_probs = probs[:5000] / probs[:5000].sum()
+    else:
+        source_vocab = np.array([to_word(r) + "a" for r in ranks], dtype=object)
+        source_probs = probs
+
+    folder = "%s/iwslt-%s-en" % (path, language)
+    os.makedirs(folder, exist_ok=True)
+    for t, n in (("train", n_train), ("dev", n_dev)):
+        source_file = "%s/%s.%s" % (folder, t, language) if language == "zh" else "%s/%s.tok.%s" % (folder, t, language)
+        with open(source_file, "w", encoding="utf-8") as fs, open("%s/%s.tok.en" % (folder, t), "w", encoding="utf-8") as ft:
+            for _ in range(n):
+                source_len = int(np.clip(rng.lognormal(2.8, 0.6), 1, 120))
+                target_len = int(np.clip(source_len * rng.normal(1.0, 0.15), 1, 120))
+                if language == "zh":
+                    # character level, chinese sentences are about 1.5x longer in characters
+                    fs.write(''.join(source_vocab[rng.choice(len(source_vocab), size=int(source_len * 1.5) + 1,
+                                                             p=source_probs)]) + "\n")
+                else:
+                    fs.write(synthetic_sentence(rng, source_len, source_vocab, source_probs) + "\n")
+                ft.write(synthetic_sentence(rng, target_len, target_vocab, probs) + "\n")
+    return folder
+
+
+def bench(name, fn, repeats, warmup=1, units=None, **params):
+    """
+    @param units: work done by one fn() call (sentences, steps..), reported per second
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    median = float(np.median(times))
+    result = {"name": name, "median_ms": 1000 * median, "min_ms": 1000 * min(times), "repeats": repeats}
+    if units is not None:
+        result["per_second"] = units / median
+    result.update(params)
+    print("%-45s %10.3f ms%s" % (name, result["median_ms"],
+                                 "  %.1f/s" % result["per_second"] if units is not None else ""))
+    return result
+
+
+def build_models(name, n_source, n_target, hidden_size, device):
+    """
+    The encoder/decoder combinations main.py can train with train()
+    """
+    rnn_type = "LSTM" if "lstm" in name else "GRU"
+    if name.startswith("selfattn"):
+        encoder = Encoder_SelfAttn(n_source, EMB_DIM, 1000, 2, 1, EMB_DIM, None, None, device, 6)
+        decoder = DecoderRNN_Attention(n_target, EMB_DIM, EMB_DIM, 1, None, None, rnn_type,
+                                       device=device, method="cat")
+    elif name.startswith("conv"):
+        # conv_uni_*: what main.py builds for --decoder_type attn --unidirectional_attn True
+        encoder = EncoderConv(n_source, EMB_DIM, hidden_size, 6, 1, hidden_size, None, None, rnn_type,
+                              "_uni_" not in name, device, 3, attention_outputs=True)
+        decoder = DecoderRNN_Attention(n_target, EMB_DIM, hidden_size, 1, None, None, rnn_type,
+                                       device=device, method="cat")
+    elif name.endswith("basic"):
+        encoder = EncoderRNN(n_source, EMB_DIM, hidden_size, 2, 1, hidden_size, None, None, rnn_type,
+                             False, device, False, 6)
+        decoder = DecoderRNN(n_target, EMB_DIM, hidden_size, 1, None, None, rnn_type, device=device)
+    else:
+        encoder = EncoderRNN(n_source, EMB_DIM, hidden_size, 2, 1, hidden_size, None, None, rnn_type,
+                             "_uni_" not in name, device, False, 6, attention_outputs=True)
+        decoder = DecoderRNN_Attention(n_target, EMB_DIM, hidden_size, 1, None, None, rnn_type,
+                                       device=device, method=name.split("_")[-1])
+    return encoder.to(device), decoder.to(device)
+
+
+def stack_steps(kind, recompute, batch_size, seq_len, layers, dim_ff, repeats, results):
+    """
+    Training steps of one self attention stack. Runs in a fresh process so the
+    peak RSS growth it reports comes from these steps only.
+    """
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+    x = torch.randn(batch_size, seq_len, EMB_DIM, requires_grad=True)
+    src_mask = torch.zeros(batch_size, 1, seq_len, dtype=torch.bool)
+    if kind == "encoder":
+        stack = SelfAttentionEncoder(SelfAttentionEncoderLayer(EMB_DIM, MultiHeadedAttention(6, EMB_DIM),
+                                                               FeedForwardSublayer(EMB_DIM, dim_ff)), layers, recompute)
+        step = lambda: stack(x, src_mask)
+    else:
+        stack = SelfAttentionDecoder(SelfAttentionDecoderLayer(EMB_DIM, MultiHeadedAttention(6, EMB_DIM),
+                                                               MultiHeadedAttention(6, EMB_DIM),
+                                                               FeedForwardSublayer(EMB_DIM, dim_ff)), layers, recompute)
+        memory = torch.randn(batch_size, seq_len, EMB_DIM)
+        tgt_mask = torch.triu(torch.ones(1, seq_len, seq_len, dtype=torch.bool), diagonal=1)
+        step = lambda: stack(x, memory, src_mask, tgt_mask)
+    stack.train()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in range(repeats + 1):
+        start = time.perf_counter()
+        step().sum().backward()
+        times.append(time.perf_counter() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((float(np.median(times[1:])), (peak - baseline) / 1024.))
+
+
+def recompute_bench(kind, recompute, args):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=stack_steps, args=(kind, recompute, args.batch_size, args.stack_len,
+                                                        args.stack_layers, 1000, args.repeats, results))
+    process.start()
+    median, peak_mb = results.get()
+    process.join()
+    name = "selfattn_%s_stack/recompute=%s" % (kind, recompute)
+    print("%-45s %10.3f ms  peak +%.1f MB" % (name, 1000 * median, peak_mb))
+    return {"name": name, "median_ms": 1000 * median, "repeats": args.repeats, "peak_rss_mb": peak_mb,
+            "batch_size": args.batch_size, "seq_len": args.stack_len, "layers": args.stack_layers}
+
+
+# main.py imports these in the modes that use them, `import main` alone must not load them
+DEFERRED_MODULES = ["matplotlib", "sacrebleu", "train", "tools.distributed", "tools.server",
+                    "tools.simultaneous", "tools.async_eval", "tools.checkpoint", "translate",
+                    "tools.cache", "tools.quantization", "torch.ao.quantization", "tools.export"]
+STARTUP_SNIPPET = """
+import json, sys, time
+start = time.perf_counter()
+import main
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "loaded": [m for m in %r if m in sys.modules]}))
+"""
+
+
+def startup_bench(args):
+    """
+    Wall time of `import main` in fresh interpreters, and the deferred modules it loaded
+    """
+    times, loaded = [], set()
+    for _ in range(args.repeats):
+        output = subprocess.check_output([sys.executable, "-c", STARTUP_SNIPPET % DEFERRED_MODULES],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        times.append(result["seconds"])
+        loaded.update(result["loaded"])
+    median = float(np.median(times))
+    print("%-45s %10.3f ms%s" % ("startup/import_main", 1000 * median,
+                                 "  loaded %s" % ", ".join(sorted(loaded)) if loaded else ""))
+    return {"name": "startup/import_main", "median_ms": 1000 * median, "min_ms": 1000 * min(times),
+            "repeats": args.repeats, "deferred_modules": sorted(loaded)}
+
+
+def check(name, diffs, tolerance=1e-5, **params):
+    """
+    @param diffs: max abs differences between two computations that should give the same numbers
+    """
+    diff = max(diffs)
+    result = {"name": "check/%s" % name, "max_abs_diff": diff, "ok": diff <= tolerance}
+    result.update(params)
+    print("%-45s %10.2e    %s" % (result["name"], diff, "ok" if result["ok"] else "MISMATCH"))
+    return result
+
+
+def max_diff(a, b):
+    return (a.float() - b.float()).abs().max().item()
+
+
+def check_forward_sequence(hidden_size=32, batch_size=4, source_len=7, steps=6, vocab=50):
+    """
+    DecoderRNN_Attention.forward_sequence against forward() one step at a time,
+    for GRU and LSTM, with and without a partly frozen pretrained embedding
+    """
+    results = []
+    rng = np.random.RandomState(0)
+    for rnn_type in ("GRU", "LSTM"):
+        for pretrained in (False, True):
+            torch.manual_seed(0)
+            pre_embedding = rng.randn(vocab, EMB_DIM) if pretrained else None
+            not_pretrained = (rng.rand(vocab) < 0.3).astype(np.float32) if pretrained else None
+            decoder = DecoderRNN_Attention(vocab, EMB_DIM, hidden_size, 1, pre_embedding, not_pretrained, rnn_type,
+                                           device="cpu", method="cat").eval()
+            encoder_outputs = torch.randn(batch_size, source_len, 2, hidden_size)
+            lengths = torch.tensor([source_len] + sorted(rng.randint(1, source_len + 1, batch_size - 1), reverse=True))
+            hidden = torch.randn(1, batch_size, hidden_size)
+            c_state = torch.randn(1, batch_size, hidden_size) if rnn_type == "LSTM" else None
+            inputs = torch.randint(0, vocab, (batch_size, steps))
+            with torch.no_grad():
+                seq_out, seq_hidden, seq_attn, seq_c = decoder.forward_sequence(inputs, hidden, None, encoder_outputs,
+                                                                                lengths, c_state)
+                step_hidden, step_c, outputs, attns = hidden, c_state, [], []
+                for di in range(steps):
+                    output, step_hidden, attn, step_c = decoder(inputs[:, di:di+1], step_hidden, None, encoder_outputs,
+                                                                lengths, step_c)
+                    outputs.append(output)
+                    attns.append(attn)
+            diffs = [max_diff(seq_out, torch.stack(outputs, dim=1)), max_diff(seq_hidden, step_hidden),
+                     max_diff(seq_attn, torch.cat(attns, dim=1))]
+            if rnn_type == "LSTM":
+                diffs.append(max_diff(seq_c, step_c))
+            results.append(check("forward_sequence/%s%s" % (rnn_type.lower(), "/pretrained" if pretrained else ""),
+                                 diffs))
+    return results
+
+
+def check_incremental_encoder(hidden_size=32, batch_size=4, source_len=7, vocab=50):
+    """
+    IncrementalEncoder fed one token at a time against EncoderRNN on the whole source, for the
+    unidirectional attention encoder wait-k extends without re-encoding
+    """
+    results = []
+    for rnn_type in ("GRU", "LSTM"):
+        torch.manual_seed(0)
+        encoder = EncoderRNN(vocab, EMB_DIM, hidden_size, 2, 1, hidden_size, None, None, rnn_type,
+                             False, "cpu", False, 6, attention_outputs=True).eval()
+        lengths = torch.tensor([source_len, source_len - 1, 4, 2])
+        source = torch.randint(0, vocab, (batch_size, source_len))
+        incremental = IncrementalEncoder(encoder)
+        with torch.no_grad():
+            hidden, c_state = encoder.initHidden(batch_size)
+            _, full_hidden, full_outputs, _, full_c = encoder(source, hidden, lengths, c_state)
+            incremental.reset(batch_size, "cpu")
+            for read in range(source_len):
+                incremental.extend(source[:, read:read+1], read < lengths)
+            _, step_hidden, step_outputs, _, step_c = incremental.state()
+        diffs = [max_diff(full_outputs, step_outputs), max_diff(full_hidden, step_hidden)]
+        if rnn_type == "LSTM":
+            diffs.append(max_diff(full_c, step_c))
+        results.append(check("incremental_encoder/%s" % rnn_type.lower(), diffs))
+    return results
+
+
+def check_batch_split(hidden_size=32, vocab=50):
+    """
+    train() on a batch run whole and as sub-batches (BatchSplitter budgets forcing 2 and
+    batch_size chunks) must leave the same gradients, with dropout off
+    """
+    results = []
+    source_len = torch.tensor([9, 8, 6, 5, 3, 2])
+    target_len = torch.tensor([7, 4, 6, 2, 5, 3])
+    batch_size, padded_len = len(source_len), source_len.max().item() + target_len.max().item()
+    source = torch.randint(EOS + 1, vocab, (batch_size, source_len.max().item()))
+    source[torch.arange(source.size(1)).unsqueeze(0) >= source_len.unsqueeze(1)] = PAD
+    target = torch.randint(EOS + 1, vocab, (batch_size, target_len.max().item()))
+    target[torch.arange(target.size(1)).unsqueeze(0) >= target_len.unsqueeze(1)] = PAD
+    for name in ("gru_attn_cat", "lstm_basic", "selfattn_attn_cat", "conv_attn_cat",
+                 "gru_uni_attn_cat", "conv_uni_attn_cat"):
+        for teacher_forcing_ratio in (1, 0):
+            torch.manual_seed(0)
+            encoder, decoder = build_models(name, vocab, vocab, hidden_size, "cpu")
+            grads = []
+            for n_chunks in (1, 2, batch_size):
+                e, d = copy.deepcopy(encoder).eval(), copy.deepcopy(decoder).eval()
+                splitter = BatchSplitter(budgets={0: -(-batch_size * padded_len // n_chunks)})
+                train(source, target, source_len, target_len, e, d,
+                      torch.optim.SGD(e.parameters(), lr=0), torch.optim.SGD(d.parameters(), lr=0),
+                      nn.NLLLoss(), device="cpu", teacher_forcing_ratio=teacher_forcing_ratio, splitter=splitter)
+                grads.append([p.grad for p in list(e.parameters()) + list(d.parameters()) if p.grad is not None])
+            diffs = [max_diff(a, b) for split in grads[1:] for a, b in zip(grads[0], split)]
+            results.append(check("batch_split/%s/tf=%d" % (name, teacher_forcing_ratio), diffs,
+                                 n_parameters=len(grads[0])))
+    try:
+        BatchSplitter().out_of_memory(4, padded_len, 4)
+        raised = False
+    except RuntimeError:
+        raised = True
+    print("%-45s %10s    %s" % ("check/batch_split/single_row_oom", "", "ok" if raised else "MISMATCH"))
+    results.append({"name": "check/batch_split/single_row_oom", "ok": raised})
+    return results
+
+
+def check_token_bleu(n_sentences=500, batch_size=64):
+    """
+    TokenBLEU on ids against sacrebleu (BLEUCalculator) with tokenize="none" on the words,
+    for noisy copies of the synthetic dev references. bleu_13a is what the 13a tokenizer,
+    scored before TokenBLEU, gives on the same text: it splits <UNK> into "< UNK >".
+    """
+    rng = np.random.RandomState(0)
+    with tempfile.TemporaryDirectory() as path:
+        folder = make_corpus(path, "vi", 0, n_sentences)
+        with open("%s/dev.tok.en" % folder, encoding="utf-8") as f:
+            refs = [line.split() for line in f]
+    words = sorted(set(w for ref in refs for w in ref))
+    hyps = []
+    for ref in refs:
+        hyp = []
+        for w in ref:
+            r = rng.rand()
+            if r < 0.1:
+                continue
+            hyp.append(words[rng.randint(len(words))] if r < 0.2 else "<UNK>" if r < 0.25 else w)
+        hyps.append(hyp)
+    word2index = {w: i for i, w in enumerate(words + ["<UNK>"])}
+
+    def to_ids(sentences):
+        ids = torch.full((len(sentences), max(len(s) for s in sentences) + 1), PAD, dtype=torch.long)
+        for i, s in enumerate(sentences):
+            ids[i, :len(s)] = torch.tensor([word2index[w] for w in s], dtype=torch.long)
+        return ids, torch.tensor([len(s) for s in sentences])
+
+    bleu_cal = TokenBLEU(smooth="exp", smooth_floor=0.00, use_effective_order=True)
+    for start in range(0, len(refs), batch_size):
+        (hyp, hyp_len), (ref, ref_len) = to_ids(hyps[start:start+batch_size]), to_ids(refs[start:start+batch_size])
+        bleu_cal.update(hyp, hyp_len, ref, ref_len)
+    hyp_strings, ref_strings = [' '.join(h) for h in hyps], [' '.join(r) for r in refs]
+    sacre = BLEUCalculator(smooth="exp", smooth_floor=0.00, lowercase=False, use_effective_order=True,
+                           tokenizer="none").bleu(hyp_strings, [ref_strings], score_only=True)
+    bleu_13a = BLEUCalculator(smooth="exp", smooth_floor=0.00, lowercase=False, use_effective_order=True,
+                              tokenizer="13a").bleu(hyp_strings, [ref_strings], score_only=True)
+    return [check("token_bleu/tokenize_none", [abs(bleu_cal.score() - sacre)], tolerance=1e-4,
+                  bleu=bleu_cal.score(), sacrebleu=sacre, bleu_13a=bleu_13a, sentences=len(refs))]
+
+
+def checks(args):
+    """
+    Equivalence checks of the fast paths against the code they replace
+    """
+    results = []
+    for fn in (check_forward_sequence, check_incremental_encoder, check_batch_split, check_token_bleu):
+        torch.manual_seed(0)
+        try:
+            results += fn()
+        except Exception as e:
+            # a check that cannot run is a failed check, the timings still run
+            print("%-45s failed: %r" % ("check/%s" % fn.__name__, e))
+            results.append({"name": "check/%s" % fn.__name__, "ok": False, "error": repr(e)})
+    return results
+
+
+def decoder_teacher_forced(decoder, inputs, hidden, encoder_outputs, lengths, c_state, sequence):
+    """
+    Teacher forced decoder forward and backward, with forward_sequence or one forward() per step
+    """
+    if sequence:
+        outputs = decoder.forward_sequence(inputs, hidden, None, encoder_outputs, lengths, c_state)[0]
+    else:
+        outputs = []
+        for di in range(inputs.size(1)):
+            output, hidden, _, c_state = decoder(inputs[:, di:di+1], hidden, None, encoder_outputs, lengths, c_state)
+            outputs.append(output)
+        outputs = torch.stack(outputs, dim=1)
+    outputs.sum().backward()
+
+
+MODELS = ["gru_basic", "gru_attn_cat", "gru_attn_dot", "lstm_basic", "lstm_attn_cat", "selfattn_attn_cat", "conv_attn_cat",
+          "gru_uni_attn_cat", "conv_uni_attn_cat"]
+
+
+def run(args):
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads)
+    device = torch.device("cpu")
+    results = [startup_bench(args)]
+    make_corpus(args.data_path, args.language, args.n_train, args.n_dev)
+
+    results.append(bench("prepareData/train", lambda: prepareData("train", args.language, "en", args.data_path,
+                                                                  max_len_ratio=0.97),
+                         args.repeats, warmup=0, units=args.n_train, sentences=args.n_train))
+    input_lang, output_lang, pairs, max_length = prepareData("train", args.language, "en", args.data_path,
+                                                             max_len_ratio=0.97)
+    dataset = Dataset(pairs, input_lang, output_lang)
+    items = [dataset[i] for i in range(args.batch_size)]
+    results.append(bench("vocab_collate_func", lambda: vocab_collate_func(items), args.repeats * 10,
+                         units=args.batch_size, batch_size=args.batch_size))
+    source, target, source_len, target_len = vocab_collate_func(items)
+    source, target, source_len, target_len = source.to(device), target.to(device), source_len.to(device), target_len.to(device)
+
+    B, L, H = args.batch_size, source.size(1), args.hidden_size
+    encoder_outputs = torch.randn(B, L, 2, H)
+    for method in ("cat", "dot"):
+        attention = Attention(H, 1, method=method).eval()
+        last_hidden = torch.randn(1, B, H)
+        with torch.no_grad():
+            results.append(bench("Attention/%s" % method, lambda: attention(encoder_outputs, last_hidden, source_len, device),
+                                 args.repeats * 10, units=B, batch_size=B, source_len=L, hidden_size=H))
+    mha = MultiHeadedAttention(6, EMB_DIM).eval()
+    x = torch.randn(B, L, EMB_DIM)
+    with torch.no_grad():
+        results.append(bench("MultiHeadedAttention", lambda: mha(x, x, x, None), args.repeats * 10,
+                             units=B, batch_size=B, seq_len=L))
+        local_mha = MultiHeadedAttention(6, EMB_DIM, window=8).eval()
+        results.append(bench("MultiHeadedAttention/window8", lambda: local_mha(x, x, x, None), args.repeats * 10,
+                             units=B, batch_size=B, seq_len=L))
+
+    word_probs = torch.log_softmax(torch.randn(args.beam_width, output_lang.n_words), dim=1)
+    def advance():
+        beam = Beam(args.beam_width, 5, 5, device)
+        for _ in range(10):
+            beam.advance(word_probs.clone())
+    results.append(bench("Beam.advance", advance, args.repeats, units=10, beam_width=args.beam_width,
+                         vocab_size=output_lang.n_words))
+
+    criterion = nn.NLLLoss()
+    for name in MODELS:
+        encoder, decoder = build_models(name, input_lang.n_words, output_lang.n_words, H, device)
+        encoder_optimizer = torch.optim.Adam(encoder.parameters(), lr=3e-4)
+        decoder_optimizer = torch.optim.Adam(decoder.parameters(), lr=3e-4)
+        def step():
+            encoder.train()
+            decoder.train()
+            train(source, target, source_len, target_len, encoder, decoder, encoder_optimizer, decoder_optimizer,
+                  criterion, device=device, teacher_forcing_ratio=1)
+        try:
+            results.append(bench("train_step/%s" % name, step, args.repeats, units=B, batch_size=B))
+            encoder.eval()
+            decoder.eval()
+            results.append(bench("evaluate_greedy/%s" % name,
+                                 lambda: evaluate(encoder, decoder, source, source_len, max_length[1],
+                                                  args.beam_width, 5, 5, "greedy", device),
+                                 args.repeats, units=B, batch_size=B, max_length=max_length[1]))
+            results.append(bench("beam_decode/%s" % name,
+                                 lambda: evaluate(encoder, decoder, source[:args.beam_batch], source_len[:args.beam_batch],
+                                                  max_length[1], args.beam_width, 5, 5, "beam", device),
+                                 args.repeats, units=args.beam_batch, batch_size=args.beam_batch,
+                                 beam_width=args.beam_width))
+        except Exception as e:
+            # report combinations the current code cannot run instead of aborting the suite
+            print("%-45s failed: %r" % (name, e))
+            results.append({"name": "models/%s" % name, "error": repr(e)})
+
+    # teacher forcing fixed at 1: the whole-target decoder path against stepping the fused one-step nn.GRU/nn.LSTM
+    T = target.size(1)
+    encoder_outputs = torch.randn(B, L, 2, H)
+    decoder_inputs = torch.randint(0, output_lang.n_words, (B, T))
+    for rnn_type in ("GRU", "LSTM"):
+        decoder = DecoderRNN_Attention(output_lang.n_words, EMB_DIM, H, 1, None, None, rnn_type,
+                                       device=device, method="cat").train()
+        hidden = torch.randn(1, B, H)
+        c_state = torch.randn(1, B, H) if rnn_type == "LSTM" else None
+        for sequence in (False, True):
+            results.append(bench("decoder_teacher_forced/%s/%s" % (rnn_type.lower(), "sequence" if sequence else "step"),
+                                 lambda: decoder_teacher_forced(decoder, decoder_inputs, hidden, encoder_outputs,
+                                                                source_len, c_state, sequence),
+                                 args.repeats, units=B, batch_size=B, steps=T))
+
+    # activation checkpointing: step time against peak memory of each stack
+    for kind in ("encoder", "decoder"):
+        for recompute in (False, True):
+            results.append(recompute_bench(kind, recompute, args))
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    return {"name": "environment", "commit": commit, "torch": torch.__version__, "python": platform.python_version(),
+            "machine": platform.machine(), "threads": torch.get_num_threads(), "time": time.time()}
+
+
+def compare(old_path, results):
+    with open(old_path) as f:
+        old = {r["name"]: r for r in map(json.loads, f) if "median_ms" in r}
+    print("%-45s %10s %10s %8s" % ("benchmark", "old ms", "new ms", "speedup"))
+    for r in results:
+        if "median_ms" in r and r["name"] in old:
+            print("%-45s %10.3f %10.3f %7.2fx" % (r["name"], old[r["name"]]["median_ms"], r["median_ms"],
+                                                  old[r["name"]]["median_ms"] / r["median_ms"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='offline benchmark suite')
+    parser.add_argument('--output', type=str, action='store', help='json lines results file', default='results/benchmark.jsonl')
+    parser.add_argument('--compare', type=str, action='store', help='earlier results file to compare against', default=None)
+    parser.add_argument('--data_path', type=str, action='store', help='where to write the synthetic corpus', default='bench_data')
+    parser.add_argument('--language', type=str, action='store', help='zh or vi', default='zh')
+    parser.add_argument('--n_train', type=int, action='store', help='synthetic training pairs', default=20000)
+    parser.add_argument('--n_dev', type=int, action='store', help='synthetic dev pairs', default=1000)
+    parser.add_argument('--batch_size', type=int, action='store', help='batch size', default=64)
+    parser.add_argument('--beam_batch', type=int, action='store', help='sentences per beam search benchmark', default=8)
+    parser.add_argument('--beam_width', type=int, action='store', help='beam width', default=10)
+    parser.add_argument('--hidden_size', type=int, action='store', help='rnn hidden size', default=256)
+    parser.add_argument('--stack_len', type=int, action='store', help='sequence length of the self attention stack benchmarks', default=200)
+    parser.add_argument('--stack_layers', type=int, action='store', help='layers of the self attention stack benchmarks', default=6)
+    parser.add_argument('--threads', type=int, action='store', help='intra-op threads', default=4)
+    parser.add_argument('--repeats', type=int, action='store', help='timed runs per benchmark', default=5)
+    parser.add_argument('--checks_only', action='store_true', help='only run the equivalence checks')
+    parser.add_argument('--max_startup_ms', type=float, action='store', help='fail when importing main.py takes longer, 0 for no limit', default=0)
+    args = parser.parse_args()
+
+    results = checks(args)
+    if not args.checks_only:
+        results += run(args)
+    results.insert(0, environment())
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        for r in results:
+            f.write(json.dumps(r) + "\n")
+    if args.compare:
+        compare(args.compare, results)
+    failed = [r["name"] for r in results if r.get("ok") is False]
+    if failed:
+        sys.exit("checks failed: %s" % ", ".join(failed))
+    startup = [r for r in results if r["name"] == "startup/import_main"]
+    if startup and (startup[0]["deferred_modules"] or 0 < args.max_startup_ms < startup[0]["median_ms"]):
+        sys.exit("startup regression: %.1f ms, deferred modules loaded: %s" % (
+            startup[0]["median_ms"], ", ".join(startup[0]["deferred_modules"]) or "none"))
@@ -1,9 +1,15 @@
+import os
+import shutil
 import torch
+import torch.nn.utils.rnn as rnn
 from tools.preprocess import tensorFromSentence
 from tools.Constants import SOS, EOS, DEVICE, BATCH_SIZE, MAX_WORD_LENGTH
+import numpy as np
 import numpy.random as random
 from tools.beam import Beam
-from tools.bleu_calculation import *
+from tools.token_bleu import TokenBLEU, vocab_map, trim_at_eos
+from tools.precision import autocast
+from tools import profiling
 
 def beam_decode(decoder, decoder_hidden, c, encoder_hidden,
                 encoder_outputs, decoder_c_state, encoder_output_lengths,
@@ -26,48 +32,55 @@ def beam_decode(decoder, decoder_hidden, c, encoder_hidden,
 
     for di in range(max_length):
 
-        decoder_input = torch.stack(
-            [b.get_current_state() for b in beams] # (B, k)
-            ).view(-1, 1).to(device) # (B x k, 1)
+        with profiling.stage("beam_bookkeeping"):
+            decoder_input = torch.stack(
+                [b.get_current_state() for b in beams] # (B, k)
+                ).view(-1, 1).to(device) # (B x k, 1)
 
-        if beams[0].prev_ks:
-            decoder_hidden = torch.cat(
-                [decoder_hidden[:, i:i+beam_width, :].index_select(1, b.get_current_origin())
-                    for i, b in enumerate(beams)], dim=1).to(device)
-        else:
-            decoder_hidden = torch.cat([decoder_hidden[:, i:i+1, :].expand(decoder_hidden.size(0), beam_width, decoder_hidden.size(2))
-                           for i in range(batch_size)], dim=1).to(device)
+            if beams[0].prev_ks:
+                decoder_hidden = torch.cat(
+                    [decoder_hidden[:, i*beam_width:(i+1)*beam_width, :].index_select(1, b.get_current_origin())
+                        for i, b in enumerate(beams)], dim=1).to(device)
+            else:
+                decoder_hidden = torch.cat([decoder_hidden[:, i:i+1, :].expand(decoder_hidden.size(0), beam_width, decoder_hidden.size(2))
+                               for i in range(batch_size)], dim=1).to(device)
 
         assert decoder_hidden.size(1) == batch_size*beam_width
 
 #         decoder_output, decoder_hidden, attn = decoder(
 #                 decoder_input, decoder_hidden, c, encoder_outputs, encoder_output_lengths)
 
-        decoder_output, decoder_hidden, attn, decoder_c_state = decoder(decoder_input, decoder_hidden, c, 
-                                                     encoder_outputs, encoder_output_lengths, decoder_c_state)
+        with profiling.stage("decoder_step"):
+            decoder_output, decoder_hidden, attn, decoder_c_state = decoder(decoder_input, decoder_hidden, c, 
+                                                         encoder_outputs, encoder_output_lengths, decoder_c_state)
         
         
         decoder_output = decoder_output.view(-1, beam_width, decoder.output_size)
         assert decoder_output.size(0) == batch_size
         
         active = []
-        for b in range(batch_size):
-            if beams[b].done():
-                continue
+        with profiling.stage("beam_bookkeeping"):
+            for b in range(batch_size):
+                if beams[b].done():
+                    # this sentence's beam_width rows were decoded for nothing
+                    profiling.count("decode_wasted_rows", beam_width)
+                    continue
 
-            if not beams[b].advance(decoder_output.data[b]):
-                active.append(b)
+                if not beams[b].advance(decoder_output.data[b]):
+                    active.append(b)
+        profiling.count("decode_steps")
         if not active:
             break
 #         print(beams[0].get_current_state(), beams[0].scores)
 #         import pdb; pdb.set_trace()
-    decoded_words = []
+    hyps = []
     for b in beams:
         scores, ks = b.sort_finished()
-        decoded_words.append(b.get_hyp(*(ks[0])))
-    return decoded_words
+        hyps.append(b.get_hyp(*(ks[0])))
+    return rnn.pad_sequence(hyps, batch_first=True, padding_value=EOS).to(device)
 
-def evaluate(encoder, decoder, source, source_len, max_length, beam_width, min_len, n_best, method, device):
+def evaluate(encoder, decoder, source, source_len, max_length, beam_width, min_len, n_best, method, device,
+             precision="float32", return_attention=False):
     """
     Function that generate translation.
     First, feed the source sentence into the encoder and obtain the hidden states from encoder.
@@ -78,78 +91,172 @@ def evaluate(encoder, decoder, source, source_len, max_length, beam_width, min_l
     @param decoder: the decoder network
     @param sentence: string, a sentence in source language to be translated
     @param max_length: the max # of words that the decoder can return
-    @output decoded_words: a list of words in target language
-    @output decoder_attentions: a list of vector, each of which sums up to 1.0
+    @param precision: "float32" or "bfloat16" autocast, see tools/precision.py
+    @param return_attention: greedy only, whether to keep the attention of every step
+    @output decoded_words: (batch_size, steps) tensor of word ids, rows padded with EOS
+    @output attention: (batch_size, max_length, source_len) if return_attention, else None
     """
     # process input sentence
-    with torch.no_grad():
+    with torch.no_grad(), autocast(precision, device):
         batch_size = source.size(0)
         # encode the source lanugage
         encoder_hidden, encoder_c_state = encoder.initHidden(source.size(0))
-        c, decoder_hidden, encoder_outputs, encoder_output_lengths, encoder_c_state = \
-                                                    encoder(source, encoder_hidden, source_len, encoder_c_state)
+        with profiling.stage("encoder"):
+            c, decoder_hidden, encoder_outputs, encoder_output_lengths, encoder_c_state = \
+                                                        encoder(source, encoder_hidden, source_len, encoder_c_state)
         decoder_c_state = encoder_c_state
+        attn_bag = []
         
         if method == "greedy":
             decoder_input = torch.tensor([[SOS]]*source.size(0), device=source.device)  # (B, 1)
 
             decoded_words = []
-            attn_bag = []
+            finished = torch.zeros(source.size(0), dtype=torch.bool, device=source.device)
             for di in range(max_length):
                 # for each time step, the decoder network takes two inputs: previous outputs and the previous hidden states
-                decoder_output, decoder_hidden, attn, decoder_c_state = decoder(decoder_input, decoder_hidden, c, 
-                                                     encoder_outputs, encoder_output_lengths, decoder_c_state)
+                with profiling.stage("decoder_step"):
+                    decoder_output, decoder_hidden, attn, decoder_c_state = decoder(decoder_input, decoder_hidden, c, 
+                                                         encoder_outputs, encoder_output_lengths, decoder_c_state)
                 
                 _, topi = decoder_output.topk(1)
-                decoded_words.append(topi.squeeze().detach())
-                decoder_input = topi.squeeze().detach().unsqueeze(1)
-                attn_bag.append(attn)
-            decoded_words = list(zip(*decoded_words))
+                if profiling.enabled():
+                    # rows that already produced EOS keep being decoded
+                    profiling.count("decode_steps")
+                    profiling.count("decode_wasted_rows", finished.sum())
+                    finished |= topi.squeeze(1) == EOS
+                decoded_words.append(topi.squeeze(1).detach())
+                decoder_input = topi.detach()
+                if return_attention:
+                    if attn is None:
+                        raise ValueError("this decoder has no attention to return")
+                    attn_bag.append(attn)
+            decoded_words = torch.stack(decoded_words, 1) if decoded_words else \
+                            torch.zeros(batch_size, 0, dtype=torch.long, device=source.device)
 
         elif method == "beam":
+            if return_attention:
+                raise ValueError("attention is only returned for greedy decoding")
             decoded_words = beam_decode(decoder, decoder_hidden, c, encoder_hidden,
                                         encoder_outputs, decoder_c_state, encoder_output_lengths,
                                         max_length, batch_size, beam_width, min_len, n_best, device)
         else:
             raise ValueError
 
-    return decoded_words, attn_bag #, decoder_attentions[:di + 1]
+    return decoded_words, torch.cat(attn_bag, dim=1) if attn_bag else None
+
+
+def word_array(lang):
+    "index2word of lang as a numpy array, so a whole row of ids maps to words in one indexing op"
+    return np.array(lang.index2word, dtype=object)
+
+def ids_to_sentences(ids, lengths, words):
+    """
+    @param ids: (batch_size, len) integer numpy array
+    @param lengths: number of leading ids of each row to keep
+    @param words: word_array() of the vocabulary of ids
+    """
+    return [' '.join(words[row[:n]]) for row, n in zip(ids, lengths)]
 
+class ExampleWriter(object):
+    """
+    Streaming sink for test(): S/T/H lines (source, translation, human reference)
+    are written as each batch is decoded, the bleu header is added by close()
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path + ".tmp", "w+")
 
-def trim_decoded_words(decoded_words):
-    # HAZARD!!!!
-    try:
-        trim_loc = decoded_words.index("<EOS>")
-    except:
-        trim_loc = len(decoded_words)
-    return decoded_words[:trim_loc]
+    def write(self, sources, translations, references):
+        for source, translation, reference in zip(sources, translations, references):
+            self.f.write("S: {}\nT: {}\nH: {}\n\n".format(source, translation, reference))
+
+    def close(self, bleu_score):
+        self.f.seek(0)
+        with open(self.path, "w") as out:
+            out.write("bleu: {}\n".format(bleu_score))
+            shutil.copyfileobj(self.f, out)
+        self.f.close()
+        os.remove(self.path + ".tmp")
 
 def test(encoder, decoder, dataloader, input_lang, output_lang, input_lang_dev, output_lang_dev,
-         beam_width, min_len, n_best, max_word_len, method, device):
-    all_scores = 0
+         beam_width, min_len, n_best, max_word_len, method, device, precision="float32", return_text=True,
+         attention_writer=None, sink=None, bleu_cal=None):
+    """
+    BLEU is computed on token ids batch by batch, see tools/token_bleu.py.
+    With return_text=False decoded_list and target_list come back empty and
+    no strings are built, which is what per-epoch dev evaluation needs.
+    attention_writer: optional AttentionWriter (tools/attention_store.py) that
+    gets each sentence's attention trimmed to its output and source length,
+    in decoded_list order; greedy decoding only.
+    sink: optional ExampleWriter that gets every batch's source, translation and
+    reference text as soon as it is decoded.
+    bleu_cal: optional TokenBLEU to add this loader's statistics to, the
+    returned bleu is then that of everything it has seen.
+    """
+    if bleu_cal is None:
+        bleu_cal = TokenBLEU(smooth="exp", smooth_floor=0.00, use_effective_order=True)
+    ref_map = vocab_map(output_lang_dev, output_lang).to(device)
+    input_words, output_words, output_words_dev = word_array(input_lang), word_array(output_lang), word_array(output_lang_dev)
     decoded_list =[]
     target_list = []
-    bleu_cal = BLEUCalculator(smooth="exp", smooth_floor=0.00,
-                 lowercase=False, use_effective_order=True,
-                 tokenizer=DEFAULT_TOKENIZER)
     first = True
     encoder.eval()
     decoder.eval()
-    for (data1,data2,len1,len2) in (dataloader):
+    for (data1,data2,len1,len2) in profiling.timed_iter(dataloader, "data_loader"):
         source, target, source_len, target_len = data1.to(device),data2.to(device),len1.to(device),len2.to(device)
-        decoded_words, attn_weight = evaluate(encoder, decoder, source, source_len, max_word_len[1],
-                                beam_width, min_len, n_best, method, device)
-
-        decoded_words = [[output_lang.index2word[k.item()] for k in decoded_words[i]] for i in range(len(decoded_words))]
-        target_words = [[output_lang_dev.index2word[k.item()] for k in target[i]] for i in range(len(decoded_words))]
+        decoded_words, attn = evaluate(encoder, decoder, source, source_len, max_word_len[1],
+                                beam_width, min_len, n_best, method, device, precision, 
+                                return_attention=attention_writer is not None)
+        with profiling.stage("detokenize"):
+            hyp, hyp_len = trim_at_eos(decoded_words)
+        if attention_writer is not None:
+            attention_writer.add(attn, hyp_len.cpu().numpy(), source_len.cpu().numpy())
+        with profiling.stage("bleu"):
+            bleu_cal.update(hyp, hyp_len, ref_map[target], target_len - 1)
+        profiling.count("decode_sentences", source.size(0))
 
-        decoded_list.extend([' '.join(trim_decoded_words(j)) for j in decoded_words])
-        target_list.extend([' '.join(target_words[j][:target_len[j]-1]) for j in range(len(decoded_words))])
+        if return_text or first or sink is not None:
+            # one host transfer per tensor instead of an .item() per token
+            with profiling.stage("detokenize"):
+                decoded_text = ids_to_sentences(hyp.cpu().numpy(), hyp_len.cpu().numpy(), output_words)
+                target_text = ids_to_sentences(target.cpu().numpy(), (target_len - 1).cpu().numpy(), output_words_dev)
         if first:
-            print("S: ", ' '.join([input_lang.index2word[k.item()] for k in data1[0]]))
-            print("H: ", decoded_list[0])
-            print("T: ", target_list[0])
+            print("S: ", ' '.join(input_words[data1[0].numpy()]))
+            print("H: ", decoded_text[0])
+            print("T: ", target_text[0])
             first =False
-    bleu_scores = bleu_cal.bleu(decoded_list,[target_list])[0]
-    return bleu_scores, decoded_list, target_list, attn_weight
+        if sink is not None:
+            with profiling.stage("detokenize"):
+                source_text = ids_to_sentences(data1.numpy(), (len1 - 1).numpy(), input_words)
+            sink.write(source_text, decoded_text, target_text)
+        if return_text:
+            decoded_list.extend(decoded_text)
+            target_list.extend(target_text)
+    bleu_scores = bleu_cal.score()
+    profiling.count("decode_tokens", bleu_cal.sys_len)
+    return bleu_scores, decoded_list, target_list, attention_writer
 
+
+def sampled_test(encoder, decoder, dataloader, *test_args, sample_size=0, ci_width=None, seed=0, **test_kwargs):
+    """
+    test() on a length stratified sample of dataloader's dataset (tools/sampling.py),
+    with a 95% bootstrap interval of the corpus bleu. sample_size <= 0 decodes
+    the whole set. With ci_width the sample is doubled, decoding only the new
+    sentences, until the interval is at most ci_width bleu wide or nothing is left.
+    test_args and test_kwargs are passed on to test(), return_text is always False.
+    @return: bleu, (low, high), number of sentences decoded
+    """
+    # only sampled evaluation needs it, translation imports this module too
+    from tools.sampling import source_lengths, stratified_order, subset_loader
+    order = stratified_order(source_lengths(dataloader.dataset), seed=seed)
+    n = len(order) if sample_size <= 0 else min(sample_size, len(order))
+    bleu_cal = TokenBLEU(smooth="exp", smooth_floor=0.00, use_effective_order=True, sentence_stats=True)
+    done = 0
+    while True:
+        test(encoder, decoder, subset_loader(dataloader, order[done:n]), *test_args,
+             return_text=False, bleu_cal=bleu_cal, **test_kwargs)
+        done = n
+        low, high = bleu_cal.bootstrap_ci(seed=seed)
+        if ci_width is None or high - low <= ci_width or done == len(order):
+            return bleu_cal.score(), (low, high), done
+        n = min(2 * n, len(order))
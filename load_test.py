@@ -0,0 +1,61 @@
+import argparse
+import asyncio
+import json
+import time
+
+# Run against a server started with `python main.py ... --serve True`. Compare
+# --max_batch_size 1 (one request at a time) with dynamic batching at equal p99.
+
+
+async def post(host, port, sentences):
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps({"texts": sentences}).encode("utf-8")
+    writer.write(("POST /translate HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\n"
+                  "Content-Length: %d\r\nConnection: close\r\n\r\n" % (host, len(body))).encode("latin-1") + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b" ", 2)[1])
+
+
+async def client(host, port, sentences, sentences_per_request, deadline, latencies, status):
+    i = 0
+    while time.time() < deadline:
+        request = [sentences[(i + j) % len(sentences)] for j in range(sentences_per_request)]
+        i += sentences_per_request
+        start = time.time()
+        code = await post(host, port, request)
+        status[code] = status.get(code, 0) + 1
+        if code == 200:
+            latencies.append(time.time() - start)
+        else:
+            await asyncio.sleep(0.01)
+
+
+async def load_test(args):
+    with open(args.input, encoding="utf-8") as f:
+        sentences = [line.strip() for line in f if line.strip()]
+    latencies, status = [], {}
+    start = time.time()
+    deadline = start + args.duration
+    await asyncio.gather(*[client(args.host, args.port, sentences[k::args.concurrency] or sentences,
+                                  args.sentences_per_request, deadline, latencies, status)
+                           for k in range(args.concurrency)])
+    elapsed = time.time() - start
+    latencies.sort()
+    percentile = lambda p: 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.))] if latencies else 0.
+    print("concurrency %d: %d requests in %.1fs, %.1f sentences/sec, p50 %.1fms, p99 %.1fms, status %s" % (
+          args.concurrency, len(latencies), elapsed, len(latencies) * args.sentences_per_request / elapsed,
+          percentile(50), percentile(99), status))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load test for the translation server')
+    parser.add_argument('--input', type=str, action='store', help='file with one source sentence per line')
+    parser.add_argument('--host', type=str, action='store', help='server host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, action='store', help='server port', default=8000)
+    parser.add_argument('--concurrency', type=int, action='store', help='number of concurrent clients', default=32)
+    parser.add_argument('--sentences_per_request', type=int, action='store', help='sentences sent per request', default=1)
+    parser.add_argument('--duration', type=float, action='store', help='seconds to run', default=30)
+    args = parser.parse_args()
+    asyncio.run(load_test(args))
@@ -2,13 +2,17 @@ import argparse
 from models.encoder_decoder import *
 import os.path
 import os
+import time
 import torch
 from tools.Constants import *
 from tools.Dataloader import *
 from tools.helper import *
 from tools.preprocess import *
-from train import trainIters
-from eval import test
+from eval import test, sampled_test, ExampleWriter
+from tools.precision import PRECISIONS
+from tools import profiling
+# training, serving, translation, quantization, export, distributed and wait-k modules are
+# imported where they are used, so each mode only pays for loading what it runs
 
 # ++++++++ update notes: +++++++++ #
 # put raw zh files under data path
@@ -19,9 +23,32 @@ from eval import test
 # default has been changed to greedy
 
 
+def checkpoint_paths(label):
+    return ['encoder' + "-" + label + '.ckpt', 'decoder' + "-" + label + '.ckpt']
+
+
+def load_checkpoint(encoder, decoder, label, quantize=False):
+    """
+    With quantize the int8 files written by --export_quantized are used unless the
+    float checkpoints are newer; otherwise the model is quantized in memory only
+    """
+    if quantize:
+        from tools.quantization import quantize_model, load_quantized, has_quantized
+        if has_quantized(label, checkpoint_paths(label)):
+            return load_quantized(encoder, decoder, label)
+    encoder_path, decoder_path = checkpoint_paths(label)
+    encoder.load_state_dict(torch.load(encoder_path, map_location=lambda storage, location: storage))
+    decoder.load_state_dict(torch.load(decoder_path, map_location=lambda storage, location: storage))
+    if quantize:
+        print("no current int8 files for %s, quantizing in memory (--export_quantized True writes them)" % label)
+        encoder, decoder = quantize_model(encoder, decoder)
+    return encoder, decoder
+
+
 def main(args):
     if args.decoder_type == "attn":
-        args.use_bi = True
+        # a unidirectional attention encoder can be extended token by token for wait-k
+        args.use_bi = not args.unidirectional_attn
 
     if (args.test_only == True) and (args.decode_method == "beam"):
         args.batch_size = 1
@@ -30,6 +57,15 @@ def main(args):
         args.encoder_hidden_size = 300
         args.decoder_hidden_size = 300
 
+    if args.quantize or args.quantize_compare or args.export_quantized:
+        # dynamic int8 kernels only run on CPU
+        args.device = "cpu"
+        args.precision = "float32"
+
+    if args.profile:
+        profiling.enable(args.save_result_path + '/%s-profile.jsonl' % args.save_model_name, 
+                         args.save_result_path + '/%s-trace.json' % args.save_model_name if args.profile_trace else None)
+
     source_words_to_load = 1000000
     target_words_to_load = 1000000
     input_lang, output_lang, train_pairs, train_max_length = prepareData("train", args.language, 
@@ -73,10 +109,18 @@ def main(args):
     # 0000000000
 #     target_embedding = target_notPretrained = None
 
-    params = {'batch_size':args.batch_size, 'shuffle':True, 'collate_fn':vocab_collate_func, 'num_workers':20}
+    params = {'batch_size':args.batch_size, 'shuffle':True, 'collate_fn':vocab_collate_func, 'num_workers':20 // args.world_size}
     params2 = {'batch_size':args.batch_size, 'shuffle':False, 'collate_fn':vocab_collate_func, 'num_workers':20}
+    if args.profile:
+        params['collate_fn'] = params2['collate_fn'] = profiling.Timed(vocab_collate_func, "collate")
     
     train_set, dev_set = Dataset(train_pairs, input_lang, output_lang), Dataset(dev_pairs, input_lang, output_lang_dev)
+    train_sampler = None
+    if args.world_size > 1:
+        # every rank reads its own shard, reshuffled each epoch by trainIters
+        train_sampler = torch.utils.data.distributed.DistributedSampler(train_set, args.world_size, args.rank)
+        params['shuffle'] = False
+        params['sampler'] = train_sampler
     train_loader = torch.utils.data.DataLoader(train_set, **params)
     dev_loader = torch.utils.data.DataLoader(dev_set, **params2)
 
@@ -86,21 +130,30 @@ def main(args):
         encoder = Encoder_SelfAttn(input_lang.n_words, EMB_DIM, args.dim_ff, args.selfattn_en_num, 
                                    args.decoder_layers, args.decoder_hidden_size,
                                    source_embedding, source_notPretrained,
-                                   args.device, args.attn_head
+                                   args.device, args.attn_head, 
+                                   args.attn_window or None, args.global_tokens, 
+                                   args.recompute_encoder
                                    ).to(args.device)
+    elif args.conv_encoder:
+        encoder = EncoderConv(input_lang.n_words, EMB_DIM, args.encoder_hidden_size,
+                              args.conv_en_num, args.decoder_layers, args.decoder_hidden_size, 
+                              source_embedding, source_notPretrained, args.rnn_type,
+                              args.use_bi, args.device, args.conv_kernel_size, 
+                              attention_outputs=args.decoder_type == "attn"
+                             ).to(args.device)
     else:
         encoder = EncoderRNN(input_lang.n_words, EMB_DIM, args.encoder_hidden_size,
                          args.encoder_layers, args.decoder_layers, args.decoder_hidden_size, 
                          source_embedding, source_notPretrained, args.rnn_type,
                          args.use_bi, args.device, False, 
-                         args.attn_head
+                         args.attn_head, attention_outputs=args.decoder_type == "attn"
                         ).to(args.device)
         
     if args.transformer:
         decoder = Decoder_SelfAttn(output_lang.n_words, EMB_DIM,
                                    args.dim_ff, args.selfattn_de_num,
                                    target_embedding, target_notPretrained, 
-                                   args.device, args.attn_head
+                                   args.device, args.attn_head, args.recompute_decoder
                                    ).to(args.device)
     elif args.decoder_type == "basic":
         decoder = DecoderRNN(output_lang.n_words, EMB_DIM, 
@@ -123,7 +176,61 @@ def main(args):
         raise ValueError
 
     print(encoder, decoder)
-    if not args.test_only:
+    export_path = args.export_path or args.save_model_name + '.pt'
+    if args.export:
+        from tools.export import export_model
+        encoder, decoder = load_checkpoint(encoder, decoder, args.save_model_name)
+        export_model(encoder, decoder, export_path)
+        print("exported inference graph to", export_path)
+        return 0
+    if args.export_quantized:
+        from tools.quantization import quantize_model, save_quantized
+        encoder, decoder = quantize_model(*load_checkpoint(encoder, decoder, args.save_model_name))
+        save_quantized(encoder, decoder, args.save_model_name)
+        print("saved int8 model of", args.save_model_name)
+        return 0
+
+    if args.serve or args.translate_input:
+        from translate import Translator, translate_file
+        from tools.cache import TranslationCache
+        if args.use_exported:
+            from tools.export import load_exported
+            encoder, decoder = load_exported(export_path, args.device)
+        else:
+            encoder, decoder = load_checkpoint(encoder, decoder, args.save_model_name, args.quantize)
+        cache = TranslationCache(args.cache_size, args.cache_path) if args.cache_size > 0 else None
+        # a persisted cache must not serve translations of another variant of the same model
+        label = "%s|q=%s|exp=%s|%s" % (args.save_model_name, args.quantize and not args.use_exported, 
+                                        args.use_exported, args.precision)
+        translator = Translator(encoder, decoder, input_lang, output_lang, train_max_length[1],
+                                args.language, char=args.char_chinese, method=args.decode_method,
+                                beam_width=args.beam_width, min_len=args.min_len, n_best=args.n_best,
+                                batch_size=args.batch_size if args.translate_input else args.max_batch_size, 
+                                device=args.device, cache=cache, label=label)
+        if args.translate_input:
+            translate_file(translator, args.translate_input, args.translate_output, 
+                           num_procs=args.num_procs, chunk_size=args.chunk_size, 
+                           threads_per_proc=args.threads_per_proc, 
+                           documents=train_max_length[0] if args.documents else None)
+            if cache is not None:
+                cache.save()
+            return 0
+        from tools.server import TranslationServer
+        server = TranslationServer(translator.translate, host=args.host, port=args.port,
+                                   max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                                   max_queue=args.max_queue, 
+                                   extra_stats=cache.stats if cache is not None else None)
+        server.serve_forever()
+        if cache is not None:
+            cache.save()
+    elif not args.test_only:
+        from train import trainIters
+        from tools.checkpoint import latest_checkpoint
+        from tools.sampling import source_lengths, stratified_order, subset_loader
+        if args.eval_sample_size > 0:
+            # the same stratified dev sample every epoch, so the scores stay comparable
+            dev_loader = subset_loader(dev_loader, stratified_order(source_lengths(dev_set), 
+                                                                    seed=args.eval_seed)[:args.eval_sample_size])
         trainIters(encoder, decoder, train_loader, dev_loader, \
                    input_lang, output_lang, input_lang_dev, output_lang_dev,
                    train_max_length, args.epoch, 
@@ -134,58 +241,97 @@ def main(args):
                    use_lr_scheduler = True, gamma_en = 0.99, gamma_de = 0.99, 
                    beam_width=args.beam_width, min_len=args.min_len, n_best=args.n_best, 
                    decode_method=args.decode_method, 
-                   save_result_path = args.save_result_path, save_model=args.save_model)
+                   save_result_path = args.save_result_path, save_model=args.save_model, 
+                   rank=args.rank, world_size=args.world_size, train_sampler=train_sampler, 
+                   precision=args.precision, checkpoint_dir=args.checkpoint_dir, 
+                   keep_checkpoints=args.keep_checkpoints, 
+                   resume=latest_checkpoint(args.checkpoint_dir, args.save_model_name) if args.resume else None, 
+                   async_eval=args.async_eval, eval_threads=args.eval_threads, 
+                   validate_every=args.validate_every, adaptive_split=args.adaptive_split)
     else:
-        encoder.load_state_dict(torch.load('encoder' + "-" + args.save_model_name + '.ckpt', 
-                                           map_location=lambda storage, location: storage))
-        decoder.load_state_dict(torch.load('decoder' + "-" + args.save_model_name + '.ckpt', 
-                                           map_location=lambda storage, location: storage))
+        if args.use_exported:
+            from tools.export import load_exported
+            encoder, decoder = load_exported(export_path, args.device)
+        else:
+            encoder, decoder = load_checkpoint(encoder, decoder, args.save_model_name, 
+                                               args.quantize and not args.quantize_compare)
+        if args.quantize_compare:
+            from tools.quantization import quantize_model, save_quantized, compare_quantized
+            q_encoder, q_decoder = quantize_model(encoder, decoder)
+            save_quantized(q_encoder, q_decoder, args.save_model_name)
+            compare_quantized(encoder, decoder, q_encoder, q_decoder, 
+                              lambda e, d: test(e, d, dev_loader, input_lang, output_lang, 
+                                                input_lang, output_lang_dev, 
+                                                args.beam_width, args.min_len, args.n_best, 
+                                                train_max_length, args.decode_method, args.device, 
+                                                return_text=False)[0], 
+                              len(dev_set))
+            encoder, decoder = q_encoder, q_decoder
 
     
-        bleu_score, decoded_list, target_list, attn_weight = test(encoder, decoder, dev_loader, 
-                                                     input_lang, output_lang, 
-                                                     input_lang, output_lang_dev,
-                                                     args.beam_width, args.min_len, args.n_best, 
-                                                     train_max_length, args.decode_method, args.device)
-        print("dev bleu: ", bleu_score)
-        i = 0
-        with open("results/dev_examples_{}.txt".format(args.save_result_label), "w+") as f:
-            f.write("bleu: {}\n".format(bleu_score))
-            for (source, target, source_len, target_len) in (dev_loader):
-                source_list = [ [input_lang.index2word[k.item()] for k in source[i]][:source_len[i]-1] 
-                               for i in range(len(source))
-                              ]
-                for s in source_list:
-                    f.write("S: {}\n".format(" ".join(s)))
-                    f.write("T: {}\n".format(decoded_list[i]))
-                    f.write("H: {}\n".format(target_list[i]))
-                    f.write("\n")
-                    i += 1
+        attention_writer = None
+        if args.capture_attention:
+            from tools.attention_store import AttentionWriter
+            attention_writer = AttentionWriter(args.capture_attention)
+        # examples are written while decoding, the loaders are walked once
+        sink = ExampleWriter("results/dev_examples_{}.txt".format(args.save_result_label))
+        test_start = time.time()
+        bleu_score, (low, high), n = sampled_test(encoder, decoder, dev_loader, 
+                                                  input_lang, output_lang, 
+                                                  input_lang, output_lang_dev,
+                                                  args.beam_width, args.min_len, args.n_best, 
+                                                  train_max_length, args.decode_method, args.device, 
+                                                  args.precision, 
+                                                  sample_size=args.eval_sample_size, ci_width=args.eval_ci_width, 
+                                                  seed=args.eval_seed, 
+                                                  attention_writer=attention_writer, sink=sink)
+        sink.close(bleu_score)
+        print("dev bleu: %s, 95%% ci [%.2f, %.2f] on %d/%d sentences" % (bleu_score, low, high, n, len(dev_set)))
+        if attention_writer is not None:
+            attention_writer.close()
+            print("saved attention of %d dev sentences to %s.bin" % (len(attention_writer), args.capture_attention))
+        profiling.dump(phase="test_dev")
+        if args.wait_k > 0:
+            from tools.simultaneous import wait_k_test
+            bleu_score, lagging, proportion = wait_k_test(encoder, decoder, dev_loader, output_lang, output_lang_dev, 
+                                                          args.wait_k, train_max_length[1], args.device, args.precision)
+            print("wait-%d dev bleu: %s, average lagging %.2f, average proportion %.3f" % (
+                args.wait_k, bleu_score, lagging, proportion))
+        print("%s: %.1f sentences/sec" % (args.precision, n / (time.time() - test_start)))
 
         # ===================================================== #
-        bleu_score, decoded_list, target_list, attn_weight  = test(encoder, decoder, train_loader, 
-                                                     input_lang, output_lang, 
-                                                     input_lang, output_lang, 
-                                                     args.beam_width, args.min_len, args.n_best, 
-                                                     train_max_length, args.decode_method, args.device)
-        print("train bleu: ", bleu_score)
-        i = 0
-        with open("results/train_examples_{}.txt".format(args.save_result_label), "w+") as f:
-            f.write("bleu: {}\n".format(bleu_score))
-            for (source, target, source_len, target_len) in (train_loader):
-                source_list = [ [input_lang.index2word[k.item()] for k in source[i]][:source_len[i]-1] 
-                               for i in range(len(source))
-                              ]
-                for s in source_list:
-                    f.write("S: {}\n".format(" ".join(s)))
-                    f.write("T: {}\n".format(decoded_list[i]))
-                    f.write("H: {}\n".format(target_list[i]))
-                    f.write("\n")
-                    i += 1
+        sink = ExampleWriter("results/train_examples_{}.txt".format(args.save_result_label))
+        bleu_score, (low, high), n = sampled_test(encoder, decoder, train_loader, 
+                                                  input_lang, output_lang, 
+                                                  input_lang, output_lang, 
+                                                  args.beam_width, args.min_len, args.n_best, 
+                                                  train_max_length, args.decode_method, args.device, 
+                                                  args.precision, 
+                                                  sample_size=args.train_eval_sample_size, ci_width=args.eval_ci_width, 
+                                                  seed=args.eval_seed, sink=sink)
+        sink.close(bleu_score)
+        print("train bleu: %s, 95%% ci [%.2f, %.2f] on %d/%d sentences" % (bleu_score, low, high, n, len(train_set)))
+        profiling.dump(phase="test_train")
     
     return 0
 
 
+def run_rank(rank, args):
+    args.rank = rank
+    if args.world_size > 1:
+        import torch.distributed as dist
+        from tools.distributed import init_distributed
+        init_distributed(rank, args.world_size, args.dist_init, args.dist_timeout)
+    main(args)
+    if args.world_size > 1:
+        dist.destroy_process_group()
+
+
+def read_throughput(args):
+    with open(args.save_result_path + '/%s-throughput.txt' % args.save_model_name) as f:
+        return float(f.readlines()[-1].split()[1])
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='training')
     # preprocessing: 
@@ -215,11 +361,19 @@ if __name__ == '__main__':
     parser.add_argument('--selfattn_de_num', type=int, action='store', help='num of decoder layers in the stack', default=2)
     parser.add_argument('--encoder_hidden_size', type=int, action='store', help='encoder num hidden', default=256)
     parser.add_argument('--use_bi', type=str2bool, action='store', help='if use bid encoder', default=False)
+    parser.add_argument('--unidirectional_attn', type=str2bool, action='store', help='attention decoder over a unidirectional encoder, so wait-k decoding extends the encoding instead of re-encoding the prefix', default=False)
     parser.add_argument('--use_pretrain_emb', type=str2bool, action='store', help='if use pretrained emb', default=True)
     parser.add_argument('--tune_pretrain_emb', type=str2bool, action='store', help='if fine tune on pretrain', default=True)
     parser.add_argument('--char_chinese', type=str2bool, action='store', help='whether to use character based chinese token', default=True)
     parser.add_argument('--self_attn', type=str2bool, action='store', help='whether to use self attention', default=False)
     parser.add_argument('--attn_head', type=int, action='store', help='number of head for self attention', default=6)
+    parser.add_argument('--conv_encoder', type=str2bool, action='store', help='whether to use a gated convolutional encoder', default=False)
+    parser.add_argument('--conv_en_num', type=int, action='store', help='num of residual conv blocks in the conv encoder', default=6)
+    parser.add_argument('--conv_kernel_size', type=int, action='store', help='odd kernel width of the conv encoder', default=3)
+    parser.add_argument('--attn_window', type=int, action='store', help='self attention encoder: sliding attention window, 0 for full attention', default=0)
+    parser.add_argument('--global_tokens', type=int, action='store', help='with attn_window, leading source tokens that attend globally', default=0)
+    parser.add_argument('--recompute_encoder', type=str2bool, action='store', help='activation checkpointing for the self attention encoder stack', default=False)
+    parser.add_argument('--recompute_decoder', type=str2bool, action='store', help='activation checkpointing for the self attention decoder stack', default=False)
     parser.add_argument('--dim_ff', type=int, action='store', help='dim of point-wise ffnn in self attn', default=1000)
     # model parameters -- decoder: 
     parser.add_argument('--decoder_type', type=str, action='store', help='basic/attn', default='attn')
@@ -232,11 +386,64 @@ if __name__ == '__main__':
     parser.add_argument('--beam_width', type=int, action='store', help='beam width', default=10)
     parser.add_argument('--n_best', type=int, action='store', help='find >=n best from beam', default=5)
     parser.add_argument('--min_len', type=int, action='store', help='placeholder, meaningless', default=5)   
+    parser.add_argument('--quantize', type=str2bool, help='whether to run test/serve with a dynamic int8 model', default=False)
+    parser.add_argument('--quantize_compare', type=str2bool, help='report bleu, latency and size of float vs int8 on dev, then test int8', default=False)
+    parser.add_argument('--export_quantized', type=str2bool, help='whether to write the dynamic int8 model of the saved checkpoint for --quantize', default=False)
+    parser.add_argument('--export', type=str2bool, help='whether to export the saved model as a torchscript inference graph', default=False)
+    parser.add_argument('--export_path', type=str, action='store', help='exported graph file, default <save_model_name>.pt', default=None)
+    parser.add_argument('--use_exported', type=str2bool, help='whether test/serve run on the exported graph', default=False)
+    parser.add_argument('--precision', type=str, action='store', help='float32 or bfloat16 autocast for training and decoding', 
+                        choices=PRECISIONS, default='float32')
+    parser.add_argument('--eval_sample_size', type=int, action='store', help='dev sentences to decode in test_only and per epoch evaluation, stratified by length, 0 for all', default=0)
+    parser.add_argument('--train_eval_sample_size', type=int, action='store', help='train sentences to decode in test_only, stratified by length, 0 for all', default=2000)
+    parser.add_argument('--eval_ci_width', type=float, action='store', help='test_only: grow the samples until the 95%% bleu interval is this narrow, optional', default=None)
+    parser.add_argument('--eval_seed', type=int, action='store', help='seed of the evaluation samples', default=0)
+    parser.add_argument('--wait_k', type=int, action='store', help='with test_only, also report bleu and latency of wait-k simultaneous decoding on dev, 0 to skip', default=0)
+    parser.add_argument('--capture_attention', type=str, action='store', help='with test_only and greedy decoding, store dev attention under this path prefix', default=None)
     # saving path: 
     parser.add_argument('--save_model', type=str2bool, help='whether to save model on the fly', default=True)
     parser.add_argument('--save_result_path', type=str, action='store', help='what path to save results', default='results/')
     parser.add_argument('--save_result_label', type=str, action='store', help='what label to save results', default='')
+    parser.add_argument('--checkpoint_dir', type=str, action='store', help='where to write full training state every epoch, empty to disable', default='checkpoints/')
+    parser.add_argument('--keep_checkpoints', type=int, action='store', help='how many epoch checkpoints to keep', default=3)
+    parser.add_argument('--resume', type=str2bool, help='whether to resume training from the latest checkpoint in checkpoint_dir', default=False)
+    parser.add_argument('--async_eval', type=str2bool, help='whether to decode the dev set in a background process while training continues', default=False)
+    parser.add_argument('--eval_threads', type=int, action='store', help='intra-op threads of the background evaluation process', default=4)
+    parser.add_argument('--validate_every', type=int, action='store', help='log teacher forced dev loss and perplexity every ? steps, 0 to disable', default=0)
+    parser.add_argument('--adaptive_split', type=str2bool, action='store', help='on out of memory, retry a batch as sub-batches with accumulated gradients', default=False)
+    parser.add_argument('--profile', type=str2bool, help='whether to write per stage times and token rates to <save_result_path>/<name>-profile.jsonl', default=False)
+    parser.add_argument('--profile_trace', type=str2bool, help='with --profile, also write a pytorch profiler trace of the first epoch', default=False)
+    # data parallel training:
+    parser.add_argument('--world_size', type=int, action='store', help='number of training processes', default=1)
+    parser.add_argument('--dist_init', type=str, action='store', help='rendezvous, file:// or tcp://, default a temp file', default=None)
+    parser.add_argument('--dist_timeout', type=int, action='store', help='minutes ranks wait in a collective, e.g. while rank 0 decodes the dev set', default=180)
+    parser.add_argument('--scaling_report', type=str2bool, help='train one epoch with 1, 2, 4.. world_size ranks and report efficiency', default=False)
+    # serving:
+    parser.add_argument('--serve', type=str2bool, help='whether to serve the saved model over http', default=False)
+    parser.add_argument('--host', type=str, action='store', help='address to serve on', default='127.0.0.1')
+    parser.add_argument('--port', type=int, action='store', help='port to serve on', default=8000)
+    parser.add_argument('--max_batch_size', type=int, action='store', help='max sentences per dynamic batch', default=32)
+    parser.add_argument('--max_wait_ms', type=float, action='store', help='max ms to wait for a batch to fill', default=10)
+    parser.add_argument('--max_queue', type=int, action='store', help='max queued sentences before rejecting', default=1024)
+    parser.add_argument('--cache_size', type=int, action='store', help='max cached translations, 0 to disable', default=100000)
+    parser.add_argument('--cache_path', type=str, action='store', help='pickle file to persist the cache, optional', default=None)
+    # bulk translation:
+    parser.add_argument('--translate_input', type=str, action='store', help='file to translate line by line, optional', default=None)
+    parser.add_argument('--translate_output', type=str, action='store', help='where to write the translations', default='translations.txt')
+    parser.add_argument('--num_procs', type=int, action='store', help='number of translation processes', default=1)
+    parser.add_argument('--chunk_size', type=int, action='store', help='lines per resumable chunk', default=10000)
+    parser.add_argument('--documents', type=str2bool, help='whether every input line is a paragraph/document to split into sentences', default=False)
+    parser.add_argument('--threads_per_proc', type=int, action='store', help='intra-op threads per translation process', default=1)
 
     args = parser.parse_args()
+    args.rank = 0
     print(args)
-    main(args)
+    if args.scaling_report:
+        from tools.distributed import scaling_report
+        scaling_report(run_rank, args, read_throughput)
+    elif args.world_size > 1 and not (args.test_only or args.serve or args.translate_input or args.export):
+        # only training runs one process per rank
+        from tools.distributed import launch
+        launch(run_rank, args)
+    else:
+        main(args)
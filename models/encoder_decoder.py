@@ -5,6 +5,7 @@ from torch import optim
 import torch.nn.functional as F
 from torch.autograd import Variable
 import torch.nn.utils.rnn as rnn
+import torch.utils.checkpoint as checkpoint
 from tools.Constants import *
 import numpy as np
 
@@ -19,19 +20,75 @@ def attention(query, key, value, mask=None, dropout=0.1):
         scores = scores.masked_fill(mask == 1, -1e9)
 #         scores.data.masked_fill_(mask == 1, -1e9)
     # after softmax, we can calculate hom much each word will be expressed at this position
-    prob_attn = F.softmax(scores, dim = -1)
+    # softmax in float32 under bf16 autocast
+    prob_attn = F.softmax(scores.float(), dim = -1)
     if dropout is not None:
         prob_attn = dropout(prob_attn)
     sum_attn = torch.matmul(prob_attn, value)
     # sum is like the context vector, which will be sent to feed forward NN, and then sent to decoder
     return sum_attn#, prob_attn
 
+def local_attention(query, key, value, window, mask=None, dropout=None, global_tokens=0):
+    """
+    Sliding window 'Scaled Dot Product Attention': position i attends to the keys j with
+    |i - j| <= window, and to the first global_tokens positions, which attend to everything.
+    Queries are taken in blocks of window rows, so at most (window, 3*window + global_tokens)
+    scores exist at a time instead of (target_len, source_len); memory is linear in length.
+    The same as attention() when window >= source_len.
+    @mask: (batch_size, 1, source_len), 1 for padding, as for attention()
+    """
+    d_k = query.size(-1)
+    target_len, source_len = query.size(-2), key.size(-2)
+    n_global = min(global_tokens, source_len)
+    batch_size = query.size(0)
+    pad = mask[..., -1, :] == 1 if mask is not None else None # (batch_size, source_len)
+    # a key padding row broadcasts over heads and query rows
+    pad_shape = (batch_size,) + (1,) * (query.dim() - 2) + (-1,)
+    outputs = []
+    for start in range(0, target_len, window):
+        end = min(start + window, target_len)
+        k_start, k_end = max(0, start - window), min(source_len, end + window)
+        keys, values = key[..., k_start:k_end, :], value[..., k_start:k_end, :]
+        distance = torch.arange(start, end, device=query.device).unsqueeze(1) - \
+                   torch.arange(k_start, k_end, device=query.device).unsqueeze(0)
+        banned = distance.abs() > window # (block, span)
+        key_pad = pad[:, k_start:k_end] if pad is not None else None
+        if n_global:
+            # global keys go first; inside the window they would be counted twice
+            banned = banned | (torch.arange(k_start, k_end, device=query.device) < n_global).unsqueeze(0)
+            banned = torch.cat([banned.new_zeros(end - start, n_global), banned], dim=1)
+            keys = torch.cat([key[..., :n_global, :], keys], dim=-2)
+            values = torch.cat([value[..., :n_global, :], values], dim=-2)
+            if pad is not None:
+                key_pad = torch.cat([pad[:, :n_global], key_pad], dim=1)
+        scores = torch.matmul(query[..., start:end, :], keys.transpose(-2, -1)) / math.sqrt(d_k)
+        scores = scores.masked_fill(banned, -1e9)
+        if key_pad is not None:
+            scores = scores.masked_fill(key_pad.reshape(pad_shape), -1e9)
+        # softmax in float32 under bf16 autocast
+        prob_attn = F.softmax(scores.float(), dim = -1)
+        if dropout is not None:
+            prob_attn = dropout(prob_attn)
+        outputs.append(torch.matmul(prob_attn, values))
+    sum_attn = torch.cat(outputs, dim=-2)
+    if n_global:
+        # the global positions attend to the whole source, (global_tokens, source_len) scores
+        global_attn = attention(query[..., :n_global, :], key, value, mask, dropout)
+        sum_attn = torch.cat([global_attn, sum_attn[..., n_global:, :]], dim=-2)
+    return sum_attn
+
 def clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
 
 class MultiHeadedAttention(nn.Module):
-    def __init__(self, num_head, emb_size, dropout=0.1):
+    def __init__(self, num_head, emb_size, dropout=0.1, window=None, global_tokens=0):
+        """
+        @window: None for full attention, else local_attention() with this window
+        @global_tokens: with window, leading positions that attend and are attended everywhere
+        """
         super(MultiHeadedAttention, self).__init__()
+        self.window = window
+        self.global_tokens = global_tokens
         self.emb_size = emb_size
         self.num_head = num_head
         self.d_k = emb_size // num_head
@@ -57,7 +114,10 @@ class MultiHeadedAttention(nn.Module):
         V = self.linear_V(value).view(batch_size, -1, self.num_head, self.d_k).transpose(1, 2)
 
         # compute 'scaled dot product attention' 
-        sum_attn = attention(query, key, value, mask, self.dropout)
+        if self.window:
+            sum_attn = local_attention(query, key, value, self.window, mask, self.dropout, self.global_tokens)
+        else:
+            sum_attn = attention(query, key, value, mask, self.dropout)
 
         # concat
         sum_attn = sum_attn.transpose(1,2).contiguous().view(batch_size, -1, self.num_head * self.d_k)
@@ -83,22 +143,45 @@ class FeedForwardSublayer(nn.Module):
         return out
 
 
-class PositionalEncoding(nn.Module):
-    def __init__(self, emd_size, dropout = 0.1, max_len = 5000):
-        super(PositionalEncoding, self).__init__()
-        self.dropout = nn.Dropout(dropout)
-        
+# float32 sinusoid tables shared by every PositionalEncoding, keyed by (emb size, device)
+_POSITION_TABLES = {}
+
+
+def positional_table(length, emd_size, device):
+    """
+    The first `length` rows of the sinusoid position table; the shared table
+    grows by doubling, so only positions that were asked for are ever computed
+    """
+    key = (emd_size, str(device))
+    table = _POSITION_TABLES.get(key)
+    if table is None or table.size(0) < length:
+        size = max(length, 64, 2 * table.size(0) if table is not None else 0)
         # Compute the positional encodings once in log space.
-        pe = torch.zeros(max_len, emd_size)
-        position = torch.arange(0., max_len).unsqueeze(1)
+        pe = torch.zeros(size, emd_size)
+        position = torch.arange(0., size).unsqueeze(1)
         div_term = torch.exp(torch.arange(0., emd_size, 2) * -(math.log(10000.0) / emd_size))
         pe[:, 0::2] = torch.sin(position * div_term)
         pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0)
-        self.register_buffer('pe', pe)
-        
+        table = _POSITION_TABLES[key] = pe.to(device)
+    return table[:length]
+
+
+class PositionalEncoding(nn.Module):
+    def __init__(self, emd_size, dropout = 0.1, max_len = 5000):
+        super(PositionalEncoding, self).__init__()
+        self.dropout = nn.Dropout(dropout)
+        self.emd_size = emd_size
+        self.max_len = max_len
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the shared table hold a 'pe' buffer, it is recomputed instead
+        state_dict.pop(prefix + 'pe', None)
+        super(PositionalEncoding, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, x):
-        x = x + torch.tensor(self.pe[:, :x.size(1)], requires_grad=False)
+        if x.size(1) > self.max_len:
+            raise ValueError("sequence of length %d is longer than max_len %d" % (x.size(1), self.max_len))
+        x = x + positional_table(x.size(1), self.emd_size, x.device).unsqueeze(0)
         return self.dropout(x)
 
 
@@ -132,14 +215,23 @@ class SelfAttentionEncoderLayer(nn.Module):
 
     
 class SelfAttentionEncoder(nn.Module):
-    def __init__(self, layer, N):
+    def __init__(self, layer, N, recompute=False):
+        """
+        @recompute: activation checkpointing, keep only each layer's input in training
+                    and recompute the layer in backward
+        """
         super(SelfAttentionEncoder, self).__init__()
         self.layers = clones(layer, N)
         self.norm = LayerNorm(layer.embd_size)
+        self.recompute = recompute
         
     def forward(self, x, mask):
         for layer in self.layers:
-            x = layer(x, mask)
+            if self.recompute and self.training and torch.is_grad_enabled():
+                # the saved rng state replays the same dropout masks in backward
+                x = checkpoint.checkpoint(layer, x, mask, use_reentrant=False)
+            else:
+                x = layer(x, mask)
         return self.norm(x)
 
 
@@ -148,8 +240,12 @@ class Encoder_SelfAttn(nn.Module):
                  dim_ff, selfattn_en_num, 
                  decoder_layers, decoder_hidden_size,
                  pre_embedding, notPretrained,
-                 device=DEVICE, attn_head=6):
-        
+                 device=DEVICE, attn_head=6, attn_window=None, global_tokens=0, recompute=False):
+        """
+        @attn_window: None for full self attention, else sliding window attention
+                      with linear memory in source length, see local_attention()
+        @recompute: recompute layer activations in backward instead of storing them
+        """
         super(Encoder_SelfAttn, self).__init__()
         self.dim_ff = dim_ff
         self.emb_dim = emb_dim
@@ -173,18 +269,19 @@ class Encoder_SelfAttn(nn.Module):
             self.embedding_freeze.weight.requires_grad = False
         
         self.pe = PositionalEncoding(emb_dim)
-        self.attn = MultiHeadedAttention(attn_head, emb_dim)
+        self.attn = MultiHeadedAttention(attn_head, emb_dim, window=attn_window, global_tokens=global_tokens)
         self.ff = FeedForwardSublayer(emb_dim, dim_ff)
         self.layer=SelfAttentionEncoderLayer(emb_dim, self.attn, self.ff)
-        self.encoder= SelfAttentionEncoder(self.layer, selfattn_en_num)
+        self.encoder= SelfAttentionEncoder(self.layer, selfattn_en_num, recompute)
         self.decoder2h0 = nn.Sequential(nn.Linear(emb_dim, decoder_hidden_size*decoder_layers), nn.Tanh())
         self.output2=nn.Sequential(nn.Linear(emb_dim, 2*decoder_hidden_size), nn.Tanh())
 #         self.output2=nn.Sequential(nn.Linear(emb_dim, decoder_hidden_size), nn.Tanh())
         self.device = device
         
         
-    def set_mask(self, encoder_input_lengths):
-        seq_len = max(encoder_input_lengths).item()
+    def set_mask(self, encoder_input_lengths, seq_len=None):
+        if seq_len is None:
+            seq_len = max(encoder_input_lengths).item()
         mask = (torch.arange(seq_len).expand(len(encoder_input_lengths), seq_len).to(self.device) > \
                 encoder_input_lengths.unsqueeze(1))
         mask = mask.unsqueeze(1)
@@ -202,7 +299,7 @@ class Encoder_SelfAttn(nn.Module):
             embedded += self.embedding_liquid(source)
 
         embedded = self.pe(embedded)         
-        mask = self.set_mask(lengths) # <class 'torch.Tensor'> (batch_size, seq_len)
+        mask = self.set_mask(lengths, seq_len) # <class 'torch.Tensor'> (batch_size, seq_len)
         outputs=self.encoder(embedded, mask)
         hidden=outputs.mean(1).unsqueeze(1).transpose(0,1)
         hidden=self.decoder2h0(hidden).view(self.decoder_layers, batch_size, self.emb_dim)
@@ -255,15 +352,19 @@ class SelfAttentionDecoderLayer(nn.Module):
 
 
 class SelfAttentionDecoder(nn.Module):
-    "Generic N layer decoder with masking."
-    def __init__(self, layer, N):
+    "Generic N layer decoder with masking, recompute as for SelfAttentionEncoder."
+    def __init__(self, layer, N, recompute=False):
         super(SelfAttentionDecoder, self).__init__()
         self.layers = clones(layer, N)
         self.norm = LayerNorm(layer.embd_size)
+        self.recompute = recompute
         
     def forward(self, x, memory, src_mask, tgt_mask):
         for layer in self.layers:
-            x = layer(x, memory, src_mask, tgt_mask)
+            if self.recompute and self.training and torch.is_grad_enabled():
+                x = checkpoint.checkpoint(layer, x, memory, src_mask, tgt_mask, use_reentrant=False)
+            else:
+                x = layer(x, memory, src_mask, tgt_mask)
         return self.norm(x)
 
     
@@ -271,7 +372,7 @@ class Decoder_SelfAttn(nn.Module):
     def __init__(self, output_size, emb_dim, 
                  dim_ff, selfattn_de_num, 
                  pre_embedding, notPretrained,
-                 device=DEVICE, attn_head=6):
+                 device=DEVICE, attn_head=6, recompute=False):
         super(Decoder_SelfAttn, self).__init__()
         
         self.dim_ff = dim_ff
@@ -297,7 +398,7 @@ class Decoder_SelfAttn(nn.Module):
         self.source_attn = MultiHeadedAttention(attn_head, emb_dim)
         self.ff = FeedForwardSublayer(emb_dim, dim_ff)
         self.layer=SelfAttentionDecoderLayer(emb_dim, self.attn, self.source_attn, self.ff)
-        self.decoder= SelfAttentionDecoder(self.layer, selfattn_de_num)
+        self.decoder= SelfAttentionDecoder(self.layer, selfattn_de_num, recompute)
         self.output_dim = nn.Linear(emb_dim, output_size, bias=False)
         self.softmax = nn.LogSoftmax(dim=2)
         self.device = device 
@@ -333,7 +434,7 @@ class Decoder_SelfAttn(nn.Module):
         output = self.decoder(embedded, encoder_outputs, src_mask, tgt_mask)  
 
         output = self.output_dim(output)
-        output = self.softmax(output)
+        output = self.softmax(output.float())
 
         return output, None, None, None
     
@@ -344,8 +445,12 @@ class EncoderRNN(nn.Module):
                  decoder_layers, decoder_hidden_size,
                  pre_embedding, notPretrained, rnn_type = 'GRU',
                  use_bi=False, device=DEVICE, 
-                 self_attn=False, attn_head=5):
-        
+                 self_attn=False, attn_head=5, attention_outputs=False):
+        """
+        attention_outputs: with use_bi=False, also project the outputs to the
+        (batch, seq_len, 2, decoder_hidden_size) layout DecoderRNN_Attention reads,
+        so attention works over a unidirectional encoder (incremental wait-k encoding)
+        """
         super(EncoderRNN, self).__init__()
         self.hidden_size = hidden_size
         self.decoder_layers = decoder_layers
@@ -382,11 +487,25 @@ class EncoderRNN(nn.Module):
             print('RNN Model Type ERROR')
         self.decoder2c = nn.Sequential(nn.Linear(hidden_size*(1+use_bi)*num_layers, hidden_size), nn.Tanh())
         self.decoder2h0 = nn.Sequential(nn.Linear(hidden_size, decoder_hidden_size*decoder_layers), nn.Tanh())
+        self.attention_outputs = attention_outputs and not use_bi
+        if self.attention_outputs:
+            self.output2 = nn.Sequential(nn.Linear(hidden_size, 2*decoder_hidden_size), nn.Tanh())
 
         self.device = device
         
-    def set_mask(self, encoder_input_lengths):
-        seq_len = max(encoder_input_lengths).item()
+    def project_outputs(self, outputs, lengths):
+        """
+        (batch, seq_len, hidden_size) unidirectional outputs to (batch, seq_len, 2, decoder_hidden_size),
+        positions past lengths stay zero as pad_packed_sequence leaves them
+        """
+        batch_size, seq_len = outputs.size(0), outputs.size(1)
+        mask = torch.arange(seq_len, device=outputs.device).unsqueeze(0) < lengths.to(outputs.device).unsqueeze(1)
+        outputs = self.output2(outputs) * mask.unsqueeze(2).to(outputs.dtype)
+        return outputs.view(batch_size, seq_len, 2, -1)
+
+    def set_mask(self, encoder_input_lengths, seq_len=None):
+        if seq_len is None:
+            seq_len = max(encoder_input_lengths).item()
         mask = (torch.arange(seq_len).expand(len(encoder_input_lengths), seq_len).to(self.device) < \
                 encoder_input_lengths.unsqueeze(1)).to(self.device)
         return mask.detach()
@@ -404,16 +523,18 @@ class EncoderRNN(nn.Module):
             
         if self.self_attention: 
             embedded = self.pe(embedded)         
-            mask = self.set_mask(lengths).unsqueeze(1)
+            mask = self.set_mask(lengths, seq_len).unsqueeze(1)
             embedded = self.self_attn(embedded, embedded, embedded,mask)
             
-        packed = rnn.pack_padded_sequence(embedded, lengths.cpu().numpy(), batch_first=True)
+        # self_attn output is bf16 under autocast, the recurrent layers take float32
+        packed = rnn.pack_padded_sequence(embedded.float(), lengths.cpu().numpy(), batch_first=True)
         if self.rnn_type == 'GRU':
             outputs, hidden = self.gru(packed, hidden)
         else: 
             outputs, (hidden, c_state) = self.lstm(packed, (hidden, c_state)) 
         
-        outputs, output_lengths = rnn.pad_packed_sequence(outputs, batch_first=True)
+        # a sub-batch of train() keeps the batch's width, its rows may all be shorter
+        outputs, output_lengths = rnn.pad_packed_sequence(outputs, batch_first=True, total_length=seq_len)
         
         if self.use_bi:
             outputs = outputs.view(batch_size, seq_len, 2, self.hidden_size) # batch, seq_len, num_dir, hidden_sz
@@ -428,6 +549,8 @@ class EncoderRNN(nn.Module):
                     batch_size, self.decoder_layers, -1).contiguous().transpose(0, 1).contiguous()                
             return None, hidden, outputs, output_lengths, c_state
         else:
+            if self.attention_outputs:
+                outputs = self.project_outputs(outputs, output_lengths)
             hidden = hidden.transpose(0, 1).contiguous().view(batch_size, 1, -1).contiguous().transpose(0, 1)
             c = self.decoder2c(hidden) # (1, batch_sz, hidden_size)
             hidden = self.decoder2h0(c) # (1, batch_sz, decoder_hidden_size*decoder_layers) 
@@ -449,6 +572,102 @@ class EncoderRNN(nn.Module):
         return hidden, c_state
 
 
+class EncoderConv(nn.Module):
+    """
+    Gated convolutional encoder (Gehring et al. 2017, Convolutional Sequence to Sequence Learning):
+    word plus positional embeddings, then num_layers residual blocks of a GLU
+    convolution over time, so every source position is encoded at once.
+    Returns what EncoderRNN returns for the same use_bi: use_bi=True for
+    DecoderRNN_Attention (outputs (batch, seq_len, 2, decoder_hidden_size), c None),
+    use_bi=False for DecoderRNN (c (1, batch, decoder_hidden_size)).
+    attention_outputs=True gives the attention layout without use_bi, as for EncoderRNN;
+    the convolutions see the whole source either way.
+    rnn_type is the decoder's, "LSTM" also returns an initial c_state.
+    """
+    def __init__(self, input_size, emb_dim, 
+                 hidden_size, num_layers, 
+                 decoder_layers, decoder_hidden_size,
+                 pre_embedding, notPretrained, rnn_type = 'GRU',
+                 use_bi=False, device=DEVICE, 
+                 kernel_size=3, dropout=0.1, attention_outputs=False):
+        
+        super(EncoderConv, self).__init__()
+        assert kernel_size % 2 == 1, "kernel_size must be odd to keep the source length"
+        self.hidden_size = hidden_size
+        self.decoder_layers = decoder_layers
+        self.decoder_hidden_size = decoder_hidden_size
+        self.num_layers = num_layers
+        self.use_bi = use_bi or attention_outputs
+        self.rnn_type = rnn_type
+        if pre_embedding is None:
+            self.embedding_liquid = nn.Embedding(input_size, emb_dim, padding_idx=PAD)
+            self.notPretrained = None
+        elif notPretrained.all() == 1:
+            self.embedding_liquid = nn.Embedding(input_size, emb_dim, padding_idx=PAD)
+            self.embedding_liquid.weight = nn.Parameter(torch.FloatTensor(pre_embedding))
+            self.notPretrained = None
+        else:
+            self.embedding_freeze = nn.Embedding(input_size, emb_dim, padding_idx=PAD)
+            self.embedding_liquid = nn.Embedding(input_size, emb_dim, padding_idx=PAD)
+            self.notPretrained = torch.FloatTensor(notPretrained[:, np.newaxis]).to(device)
+            self.embedding_freeze.weight = nn.Parameter(torch.FloatTensor(pre_embedding))
+            self.embedding_freeze.weight.requires_grad = False
+
+        self.pe = PositionalEncoding(emb_dim, dropout)
+        self.emb2hidden = nn.Linear(emb_dim, hidden_size)
+        self.convs = nn.ModuleList([nn.Conv1d(hidden_size, 2*hidden_size, kernel_size, padding=kernel_size // 2)
+                                    for _ in range(num_layers)])
+        self.dropout = nn.Dropout(dropout)
+        if self.use_bi:
+            self.output2 = nn.Sequential(nn.Linear(hidden_size, 2*decoder_hidden_size), nn.Tanh())
+        else:
+            self.decoder2c = nn.Sequential(nn.Linear(hidden_size, decoder_hidden_size), nn.Tanh())
+        self.decoder2h0 = nn.Sequential(nn.Linear(hidden_size, decoder_hidden_size*decoder_layers), nn.Tanh())
+
+        self.device = device
+
+    def set_mask(self, encoder_input_lengths, seq_len=None):
+        if seq_len is None:
+            seq_len = max(encoder_input_lengths).item()
+        mask = (torch.arange(seq_len).expand(len(encoder_input_lengths), seq_len).to(self.device) < \
+                encoder_input_lengths.unsqueeze(1)).to(self.device)
+        return mask.detach()
+
+    def forward(self, source, hidden, lengths, c_state = None):
+        batch_size = source.size(0)
+        seq_len = source.size(1)
+
+        if self.notPretrained is None:
+            embedded = self.embedding_liquid(source)
+        else:
+            embedded = self.embedding_freeze(source) # (batch_sz, seq_len, emb_dim)
+            self.embedding_liquid.weight.data.mul_(self.notPretrained)
+            embedded += self.embedding_liquid(source)
+
+        mask = self.set_mask(lengths, seq_len).unsqueeze(1) # (batch_sz, 1, seq_len)
+        x = self.emb2hidden(self.pe(embedded)).transpose(1, 2) # (batch_sz, hidden_size, seq_len)
+        for conv in self.convs:
+            # zero the padding first so it never leaks into real positions through the kernel
+            x = x.masked_fill(~mask, 0)
+            x = (x + F.glu(conv(self.dropout(x)), dim=1)) * math.sqrt(0.5)
+        x = x.masked_fill(~mask, 0).transpose(1, 2) # (batch_sz, seq_len, hidden_size)
+
+        pooled = x.sum(1) / lengths.unsqueeze(1).to(x.dtype) # mean over the real positions
+        hidden = self.decoder2h0(pooled).view(batch_size, self.decoder_layers, -1).transpose(0, 1).contiguous()
+        c_state = hidden if self.rnn_type == 'LSTM' else None
+        output_lengths = lengths.cpu()
+        if self.use_bi:
+            # zero padded outputs like pad_packed_sequence does for EncoderRNN
+            outputs = self.output2(x).masked_fill(~mask.transpose(1, 2), 0)
+            outputs = outputs.view(batch_size, seq_len, 2, self.decoder_hidden_size)
+            return None, hidden, outputs, output_lengths, c_state
+        c = self.decoder2c(pooled).unsqueeze(0) # (1, batch_sz, decoder_hidden_size)
+        return c, hidden, x, output_lengths, c_state
+
+    def initHidden(self, batch_size):
+        return None, None
+
+
 class DecoderRNN(nn.Module):
     def __init__(self, output_size, emb_dim, hidden_size, num_layers,
                  pre_embedding, notPretrained, rnn_type = 'GRU', dropout_p=0.1, device=DEVICE):
@@ -503,16 +722,17 @@ class DecoderRNN(nn.Module):
 
         c = c.transpose(0, 1)
 
-        rnn_input = torch.cat((embedded, c), dim=2)
+        # the recurrent state stays float32, autocast still picks a bf16 LSTM kernel where there is one
+        rnn_input = torch.cat((embedded, c), dim=2).float()
         if self.rnn_type == 'GRU':
-            output, hidden = self.gru(rnn_input, last_hidden)
+            output, hidden = self.gru(rnn_input, last_hidden.float())
         else: 
-            output, (hidden, c_state) = self.lstm(rnn_input,(hidden, c_state))
+            output, (hidden, c_state) = self.lstm(rnn_input, (last_hidden.float(), c_state.float()))
         output = output.squeeze(1) # B x hidden_size
-        output = torch.cat((output, rnn_input.squeeze()), dim=1)
+        output = torch.cat((output, rnn_input.squeeze(1)), dim=1)
         output = self.maxout(output)
         output = self.linear(output)
-        output = F.log_softmax(output, dim=1)
+        output = F.log_softmax(output.float(), dim=1)
 
         return output, hidden, None, c_state
 
@@ -568,21 +788,93 @@ class DecoderRNN_Attention(nn.Module):
         
         attn_context, attn_weights = self.attn(encoder_outputs, last_hidden, encoder_output_lengths, self.device)
 
-        rnn_input = torch.cat([attn_context, embedded], dim=2)
+        # the recurrent state stays float32, autocast still picks a bf16 LSTM kernel where there is one
+        rnn_input = torch.cat([attn_context, embedded], dim=2).float()
         if self.rnn_type == 'GRU':
-            output, hidden = self.gru(rnn_input, last_hidden)
+            output, hidden = self.gru(rnn_input, last_hidden.float())
         else:
-            output, (hidden, c_state) = self.lstm(rnn_input, (last_hidden, c_state))
+            output, (hidden, c_state) = self.lstm(rnn_input, (last_hidden.float(), c_state.float()))
         
         output = output.squeeze(1) # B x hidden_size
-        output = torch.cat((output, rnn_input.squeeze()), dim=1)
+        output = torch.cat((output, rnn_input.squeeze(1)), dim=1)
         output = self.maxout(output)
         output = self.linear(output)
-        output = F.log_softmax(output, dim=1)
+        output = F.log_softmax(output.float(), dim=1)
 
         # Return final output, hidden state, and attention weights (for visualization)
         return output, hidden, attn_weights, c_state
 
+    def forward_sequence(self, word_inputs, last_hidden, c,
+                         encoder_outputs, encoder_output_lengths, c_state = None):
+        """
+        Teacher forced forward over a whole target, the same numbers as calling
+        forward() once per step. With one layer the embedding half of the input
+        projection is a single GEMM over all steps, only the attention context
+        and the recurrence run step by step, and maxout and the output layer run
+        once over all steps. The recurrence is computed in float32, as forward()
+        does for GRU.
+        @ word_inputs: (batch, seq_len), SOS followed by the target shifted right
+        @ return: log probs (batch, seq_len, output_size), last hidden, 
+                  attention weights (batch, seq_len, source_len), c_state
+        """
+        if self.n_layers > 1:
+            # the inner layers see dropout in between, keep nn.GRU/nn.LSTM for them
+            outputs, attns = [], []
+            for di in range(word_inputs.size(1)):
+                output, last_hidden, attn_weights, c_state = self.forward(word_inputs[:, di:di+1], last_hidden, c, 
+                                                                          encoder_outputs, encoder_output_lengths, c_state)
+                outputs.append(output)
+                attns.append(attn_weights)
+            return torch.stack(outputs, dim=1), last_hidden, torch.cat(attns, dim=1), c_state
+
+        if self.notPretrained is None:
+            embedded = self.embedding_liquid(word_inputs)
+        else:
+            embedded = self.embedding_freeze(word_inputs) # (batch_sz, seq_len, emb_dim)
+            self.embedding_liquid.weight.data.mul_(self.notPretrained)
+            embedded += self.embedding_liquid(word_inputs)
+        embedded = embedded.float()
+
+        cell = self.gru if self.rnn_type == 'GRU' else self.lstm
+        w_context = cell.weight_ih_l0[:, :self.hidden_size]
+        w_embedded = cell.weight_ih_l0[:, self.hidden_size:]
+        hidden = last_hidden.float()[0] # (batch_sz, hidden_size)
+        if self.rnn_type == 'LSTM':
+            cell_state = c_state.float()[0]
+        with torch.autocast(device_type=word_inputs.device.type, enabled=False):
+            embedded_gates = F.linear(embedded, w_embedded, cell.bias_ih_l0) # (batch_sz, seq_len, gates*hidden_size)
+
+        contexts, hiddens, attns = [], [], []
+        for di in range(word_inputs.size(1)):
+            attn_context, attn_weights = self.attn(encoder_outputs, hidden.unsqueeze(0), encoder_output_lengths, self.device)
+            attn_context = attn_context.float().squeeze(1)
+            with torch.autocast(device_type=word_inputs.device.type, enabled=False):
+                gates_i = embedded_gates[:, di] + F.linear(attn_context, w_context)
+                gates_h = F.linear(hidden, cell.weight_hh_l0, cell.bias_hh_l0)
+                if self.rnn_type == 'GRU':
+                    i_r, i_z, i_n = gates_i.chunk(3, 1)
+                    h_r, h_z, h_n = gates_h.chunk(3, 1)
+                    r = torch.sigmoid(i_r + h_r)
+                    z = torch.sigmoid(i_z + h_z)
+                    n = torch.tanh(i_n + r * h_n)
+                    hidden = (1 - z) * n + z * hidden
+                else:
+                    i, f, g, o = (gates_i + gates_h).chunk(4, 1)
+                    cell_state = torch.sigmoid(f) * cell_state + torch.sigmoid(i) * torch.tanh(g)
+                    hidden = torch.sigmoid(o) * torch.tanh(cell_state)
+            contexts.append(attn_context)
+            hiddens.append(hidden)
+            attns.append(attn_weights)
+
+        rnn_input = torch.cat([torch.stack(contexts, dim=1), embedded], dim=2)
+        output = torch.cat((torch.stack(hiddens, dim=1), rnn_input), dim=2)
+        output = self.maxout(output)
+        output = self.linear(output)
+        output = F.log_softmax(output.float(), dim=2)
+        if self.rnn_type == 'LSTM':
+            c_state = cell_state.unsqueeze(0)
+        return output, hidden.unsqueeze(0), torch.cat(attns, dim=1), c_state
+
 
 class Attention(nn.Module):
     def __init__(self, hidden_size, decoder_layers, method="cat"):
@@ -596,8 +888,9 @@ class Attention(nn.Module):
 
 
 
-    def set_mask(self, encoder_output_lengths, device):
-        seq_len = max(encoder_output_lengths).item()
+    def set_mask(self, encoder_output_lengths, device, seq_len=None):
+        if seq_len is None:
+            seq_len = max(encoder_output_lengths).item()
         mask = (torch.arange(seq_len).expand(len(encoder_output_lengths), seq_len) > \
                     encoder_output_lengths.unsqueeze(1)).to(device)
         return mask.detach()
@@ -617,17 +910,17 @@ class Attention(nn.Module):
             else:
                 last_hidden = last_hidden.transpose(1, 2)
             last_hidden = last_hidden.expand_as(encoder_outputs)
-            energy = self.energy(torch.cat([last_hidden.squeeze(), encoder_outputs], dim=2))
+            energy = self.energy(torch.cat([last_hidden, encoder_outputs], dim=2))
         elif self.method == "dot":
             if not dim_match:
                 last_hidden = last_hidden.permute(1, 2, 0)
             energy = torch.bmm(encoder_outputs, last_hidden)
             # (batch_size, seq_len, 1)
         energy = energy.squeeze(2)
-        mask = self.set_mask(encoder_output_lengths, device)
+        mask = self.set_mask(encoder_output_lengths, device, encoder_outputs.size(1))
 
         energy.data.masked_fill_(mask, -float('inf'))
-        attn = F.softmax(energy, dim=1).unsqueeze(1) # (batch_size, 1, seq_len)
+        attn = F.softmax(energy.float(), dim=1).unsqueeze(1) # (batch_size, 1, seq_len)
         attn_context = torch.bmm(attn, encoder_outputs)
         # (batch_size, 1, seq_len) * (batch_size, seq_len, hidden_size)
         return attn_context, attn
@@ -659,6 +952,8 @@ class LayerNorm(nn.Module):
         self.eps = eps
 
     def forward(self, x):
+        # statistics in float32, bf16 has too few mantissa bits for the variance
+        x = x.float()
         mean = x.mean(-1, keepdim=True)
         std = x.std(-1, keepdim=True)
         return self.a_2 * (x - mean) / (std + self.eps) + self.b_2
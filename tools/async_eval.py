@@ -0,0 +1,90 @@
+import copy
+import queue
+import time
+import torch
+import torch.multiprocessing as mp
+from tools.checkpoint import to_cpu
+
+'''
+Usage:
+evaluator = AsyncEvaluator(test, encoder, decoder, dev_loader, test_args)
+evaluator.submit(epoch, encoder, decoder)    # snapshot the weights, return immediately
+for epoch, bleu, sentences_per_sec, encoder_state, decoder_state in evaluator.poll():
+    ...
+evaluator.close()
+
+One spawned process keeps its own copy of the models and decodes the dev set
+for each submitted snapshot in order, so training never waits for test().
+poll() hands back the snapshot with its score so the evaluated weights, not
+the current ones, are saved as the best model.
+'''
+
+
+def _worker(test_fn, encoder, decoder, dataset, batch_size, collate_fn, test_args, device, threads,
+            requests, results):
+    torch.set_num_threads(threads)
+    encoder, decoder = encoder.to(device), decoder.to(device)
+    # no loader workers, they would only compete with training for cores
+    dev_loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False,
+                                             collate_fn=collate_fn, num_workers=0)
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        epoch, encoder_state, decoder_state = request
+        try:
+            encoder.load_state_dict(encoder_state)
+            decoder.load_state_dict(decoder_state)
+            start = time.time()
+            bleu_score, _, _, _ = test_fn(encoder, decoder, dev_loader, *test_args)
+            results.put((epoch, bleu_score, len(dataset) / (time.time() - start), None))
+        except Exception as e:
+            results.put((epoch, None, None, repr(e)))
+
+
+class AsyncEvaluator(object):
+    """
+    @param test_fn: eval.test
+    @param dev_loader: the dev DataLoader, rebuilt in the evaluation process from its dataset
+    @param test_args: the arguments of test_fn after (encoder, decoder, dataloader)
+    @param threads: intra-op threads of the evaluation process
+    """
+    def __init__(self, test_fn, encoder, decoder, dev_loader, test_args, device="cpu", threads=1):
+        ctx = mp.get_context("spawn")
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.snapshots = {}
+        self.process = ctx.Process(target=_worker,
+                                   args=(test_fn, copy.deepcopy(encoder).cpu(), copy.deepcopy(decoder).cpu(),
+                                         dev_loader.dataset, dev_loader.batch_size, dev_loader.collate_fn,
+                                         test_args, device, threads, self.requests, self.results))
+        self.process.start()
+
+    def submit(self, epoch, encoder, decoder):
+        encoder_state, decoder_state = to_cpu(encoder.state_dict()), to_cpu(decoder.state_dict())
+        self.snapshots[epoch] = (encoder_state, decoder_state)
+        self.requests.put((epoch, encoder_state, decoder_state))
+
+    def pending(self):
+        return len(self.snapshots)
+
+    def poll(self, block=False):
+        """
+        Returns the finished evaluations as (epoch, bleu, sentences/sec, encoder_state, decoder_state),
+        with block=True waits for all submitted ones
+        """
+        finished = []
+        while self.snapshots:
+            try:
+                epoch, bleu_score, speed, error = self.results.get(block=block)
+            except queue.Empty:
+                break
+            encoder_state, decoder_state = self.snapshots.pop(epoch)
+            if error is not None:
+                raise RuntimeError("evaluation of epoch %d failed: %s" % (epoch, error))
+            finished.append((epoch, bleu_score, speed, encoder_state, decoder_state))
+        return finished
+
+    def close(self):
+        self.requests.put(None)
+        self.process.join()
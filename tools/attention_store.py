@@ -0,0 +1,61 @@
+import os
+import numpy as np
+
+'''
+Usage:
+writer = AttentionWriter("results/zh_attn-dev-attn")
+writer.add(attn, target_lengths, source_lengths)   # per batch, attn: (batch_size, target_len, source_len)
+writer.close()
+
+store = AttentionStore("results/zh_attn-dev-attn")
+store[i]    # (target_len, source_len) float32 memmap view of sentence i
+
+<path>.bin holds the trimmed matrices back to back, <path>.idx.npy one
+(offset, target_len, source_len) row per sentence in the order they were
+added, which is the order of test()'s decoded_list. Only one batch is ever
+held in memory while writing, and reading maps the file instead of loading it.
+'''
+
+
+class AttentionWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.data = open(path + ".bin", "wb")
+        self.index = []
+        self.offset = 0
+
+    def add(self, attn, target_lengths, source_lengths):
+        """
+        @param attn: (batch_size, steps, source_len) tensor, one row per decoder step
+        @param target_lengths, source_lengths: (batch_size,) number of real rows and columns
+        """
+        attn = attn.float().cpu().numpy()
+        for matrix, t, s in zip(attn, np.asarray(target_lengths), np.asarray(source_lengths)):
+            matrix = np.ascontiguousarray(matrix[:t, :s], dtype=np.float32)
+            self.data.write(matrix.tobytes())
+            self.index.append((self.offset, matrix.shape[0], matrix.shape[1]))
+            self.offset += matrix.size
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self.data.close()
+        # write then rename so a reader never sees an index longer than the data
+        with open(self.path + ".idx.tmp", "wb") as f:
+            np.save(f, np.array(self.index, dtype=np.int64).reshape(-1, 3))
+        os.replace(self.path + ".idx.tmp", self.path + ".idx.npy")
+
+
+class AttentionStore(object):
+    def __init__(self, path):
+        self.index = np.load(path + ".idx.npy")
+        size = int(self.index[:, 1:].prod(1).sum()) if len(self.index) else 0
+        self.data = np.memmap(path + ".bin", dtype=np.float32, mode="r", shape=(size,)) if size else np.zeros(0, np.float32)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        offset, target_len, source_len = self.index[i]
+        return self.data[offset:offset + target_len * source_len].reshape(target_len, source_len)
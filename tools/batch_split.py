@@ -0,0 +1,62 @@
+import math
+
+'''
+Usage:
+splitter = BatchSplitter()
+n_chunks = splitter.chunks(batch_size, padded_len)
+try:
+    ... train on n_chunks sub-batches, accumulating gradients ...
+except RuntimeError as e:
+    if not is_oom(e):
+        raise
+    n_chunks = splitter.out_of_memory(batch_size, padded_len, n_chunks)    # then retry
+
+Remembers a safe token budget (sub-batch rows x padded source+target length)
+per length bucket. A batch that ran out of memory halves the budget of its
+bucket, and later batches of that length or longer are split before they are
+tried, since longer sentences cost at least as much per token.
+'''
+
+
+def is_oom(error):
+    message = str(error)
+    # CUDA raises torch.cuda.OutOfMemoryError, the CPU allocator a plain RuntimeError
+    return "out of memory" in message or "can't allocate memory" in message or "not enough memory" in message
+
+
+class BatchSplitter(object):
+    def __init__(self, bucket_width=16, budgets=None):
+        self.bucket_width = bucket_width
+        self.budgets = dict(budgets or {}) # bucket -> max tokens per sub-batch
+
+    def bucket(self, padded_len):
+        return padded_len // self.bucket_width
+
+    def budget(self, padded_len):
+        bucket = self.bucket(padded_len)
+        known = [tokens for b, tokens in self.budgets.items() if b <= bucket]
+        return min(known) if known else None
+
+    def chunks(self, batch_size, padded_len):
+        """
+        @return: number of sub-batches to split a batch into up front
+        """
+        budget = self.budget(padded_len)
+        if budget is None:
+            return 1
+        return min(batch_size, max(1, math.ceil(batch_size * padded_len / budget)))
+
+    def out_of_memory(self, batch_size, padded_len, n_chunks):
+        """
+        Record that sub-batches of n_chunks splits did not fit
+        @return: number of sub-batches to retry with
+        """
+        if n_chunks >= batch_size:
+            raise RuntimeError("a single sentence of length %d does not fit in memory" % padded_len)
+        rows = math.ceil(batch_size / n_chunks)
+        tokens = max(1, rows // 2) * padded_len
+        bucket = self.bucket(padded_len)
+        self.budgets[bucket] = min(tokens, self.budgets.get(bucket, tokens))
+        print("out of memory on %d x %d tokens, splitting batches of this length into %d x %d tokens" % (
+            rows, padded_len, max(1, rows // 2), padded_len))
+        return min(batch_size, max(self.chunks(batch_size, padded_len), n_chunks * 2))
@@ -47,7 +47,7 @@ class Beam(object):
         best_scores, best_scores_id = flat_beam_scores.topk(k=self.beam_width, dim=0,
                                                             largest=True, sorted=True)
         self.scores = best_scores
-        prev_k = best_scores_id / num_words
+        prev_k = best_scores_id // num_words
         self.prev_ks.append(prev_k)
         self.next_ys.append((best_scores_id - prev_k * num_words))
         for i in range(self.next_ys[-1].size(0)):
@@ -78,11 +78,18 @@ class Beam(object):
     def get_hyp(self, timestep, k):
         """
         Walk back to construct the full hypothesis.
+        @return: (timestep,) tensor of word ids
         """
-        hyp = []
-        for j in range(len(self.prev_ks[:timestep]) - 1, -1, -1):
-            hyp.append(self.next_ys[j + 1][k])
-            k = self.prev_ks[j][k]
-        return hyp[::-1]
+        if timestep == 0:
+            return self.next_ys[0].new_zeros(0)
+        # the back pointers come to the host once, the words are gathered in one indexing op
+        prev_ks = torch.stack(self.prev_ks[:timestep]).tolist()
+        k = int(k)
+        index = [0] * timestep
+        for j in range(timestep - 1, -1, -1):
+            index[j] = k
+            k = prev_ks[j][k]
+        ys = torch.stack(self.next_ys[1:timestep + 1]) # (timestep, beam_width)
+        return ys[torch.arange(timestep, device=ys.device), torch.tensor(index, device=ys.device)]
 
 
@@ -2,7 +2,7 @@
 Insturction:
 bleu_cal = BLEUCalculator(smooth="floor", smooth_floor=0.01,
                  lowercase=False, use_effective_order=True,
-                 tokenizer=DEFAULT_TOKENIZER)
+                 tokenizer=None)    # None: sacrebleu's DEFAULT_TOKENIZER
 bleu_cal.bleu(sys, ref)
 
 sys: decoded words (list or string)
@@ -12,14 +12,14 @@ returns: bleu_score, correct, total, precisions, brevity_penalty, sys_len, ref_l
 '''
 
 
-from sacrebleu import corpus_bleu, TOKENIZERS, DEFAULT_TOKENIZER
+# sacrebleu is imported on first use, TokenBLEU covers dev scoring without it
 
 class BLEUCalculator():
 
     def __init__(self,
                  smooth="floor", smooth_floor=0.01,
                  lowercase=False, use_effective_order=True,
-                 tokenizer=DEFAULT_TOKENIZER):
+                 tokenizer=None):
         self.smooth = smooth
         self.smooth_floor = smooth_floor
         self.lowercase = lowercase
@@ -27,6 +27,7 @@ class BLEUCalculator():
         self.tokenizer = tokenizer
 
     def bleu(self, sys, ref, score_only=False):
+        from sacrebleu import corpus_bleu, DEFAULT_TOKENIZER
 #         if isinstance(sys, str):
 #             _s = sys
 #         else:
@@ -39,7 +40,7 @@ class BLEUCalculator():
                 sys, ref,
                 smooth=self.smooth, smooth_floor=self.smooth_floor,
                 force=False, lowercase=self.lowercase,
-                tokenize=self.tokenizer,
+                tokenize=self.tokenizer if self.tokenizer is not None else DEFAULT_TOKENIZER,
                 use_effective_order=self.use_effective_order)
 
         if score_only:
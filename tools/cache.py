@@ -0,0 +1,72 @@
+import os
+import pickle as pkl
+from collections import OrderedDict
+
+
+class TranslationCache(object):
+    """
+    Size bounded LRU cache of translations. Keys are the normalized source
+    sentence plus the model label and decode settings, so a cache file can be
+    shared between models without returning stale results.
+    @param max_size: max number of cached translations
+    @param path: optional pickle file to load from and save to
+    """
+    def __init__(self, max_size=100000, path=None):
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.added = None
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as f:
+                self.entries = pkl.load(f)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            print("found existing translation cache.. %d entries" % len(self.entries))
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def record_added(self):
+        """
+        Keep the entries put from now on for take_added(), e.g. in a worker process whose
+        cache is a copy that the parent has to merge back
+        """
+        self.added = []
+
+    def take_added(self):
+        added = self.added or []
+        if self.added is not None:
+            self.added = []
+        return added
+
+    def put(self, key, translation):
+        if self.added is not None:
+            self.added.append((key, translation))
+        self.entries[key] = translation
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def save(self):
+        if self.path is None:
+            return
+        # write then rename so an interrupted save never leaves a broken cache file
+        with open(self.path + ".tmp", "wb") as f:
+            pkl.dump(self.entries, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def stats(self):
+        return {"cache_size": len(self.entries),
+                "cache_hits": self.hits,
+                "cache_misses": self.misses,
+                "cache_evictions": self.evictions,
+                "cache_hit_rate": self.hits / max(self.hits + self.misses, 1)}
@@ -0,0 +1,140 @@
+import glob
+import os
+import queue
+import random
+import re
+import threading
+import numpy as np
+import torch
+
+'''
+Usage:
+manager = CheckpointManager("checkpoints/", label, keep=3)
+manager.save({"encoder": ..., "epoch": epoch}, epoch)  # returns once the state is copied to CPU
+manager.save_file(encoder.state_dict(), 'encoder-' + label + '.ckpt')
+state = manager.load(latest_checkpoint("checkpoints/", label))
+manager.close()                                       # waits for pending writes
+
+Writes happen on one background thread in submission order, each to a .tmp
+file renamed over the target, so a preempted job never leaves a broken
+checkpoint. Only the last `keep` epoch checkpoints are kept.
+'''
+
+
+def to_cpu(obj):
+    """
+    Copy every tensor in a (nested) state dict to CPU memory so training can
+    keep updating the originals while the copy is written
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def list_checkpoints(directory, label):
+    """
+    Epoch checkpoints on disk as a list of (epoch, path), oldest first
+    """
+    if not directory:
+        return []
+    pattern = re.compile(re.escape(label) + r"-epoch(\d+)\.ckpt$")
+    found = []
+    for path in glob.glob(os.path.join(directory, "%s-epoch*.ckpt" % label)):
+        match = pattern.search(os.path.basename(path))
+        if match:
+            found.append((int(match.group(1)), path))
+    return sorted(found)
+
+
+def latest_checkpoint(directory, label):
+    found = list_checkpoints(directory, label)
+    return found[-1][1] if found else None
+
+
+class CheckpointManager(object):
+    """
+    @param directory: where epoch checkpoints go, None to only use save_file
+    @param label: model label, checkpoints are <directory>/<label>-epoch<N>.ckpt
+    @param keep: number of epoch checkpoints to keep
+    """
+    def __init__(self, directory, label, keep=3):
+        self.directory = directory
+        self.label = label
+        self.keep = keep
+        self.queue = queue.Queue()
+        self.error = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def path(self, epoch):
+        return os.path.join(self.directory, "%s-epoch%d.ckpt" % (self.label, epoch))
+
+    def checkpoints(self):
+        return list_checkpoints(self.directory, self.label)
+
+    def latest(self):
+        return latest_checkpoint(self.directory, self.label)
+
+    def save(self, state, epoch):
+        self.queue.put((to_cpu(state), self.path(epoch), True))
+        self._raise()
+
+    def save_file(self, state, path):
+        self.queue.put((to_cpu(state), path, False))
+        self._raise()
+
+    def load(self, path, device="cpu"):
+        return torch.load(path, map_location=device, weights_only=False)
+
+    def wait(self):
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            state, path, rotate = item
+            try:
+                torch.save(state, path + ".tmp")
+                os.replace(path + ".tmp", path)
+                if rotate:
+                    for _, old in self.checkpoints()[:-self.keep]:
+                        os.remove(old)
+            except Exception as e:
+                # surfaced on the training thread by the next save() or wait()
+                self.error = e
+            self.queue.task_done()
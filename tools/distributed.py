@@ -0,0 +1,122 @@
+import copy
+import datetime
+import os
+import tempfile
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+'''
+Usage:
+python main.py ... --world_size 4
+python main.py ... --world_size 4 --scaling_report True
+
+Every rank trains on its own shard of the training set (DistributedSampler),
+gradients are averaged with gloo all-reduce before clipping and the optimizer
+step, so encoder and decoder stay identical on all ranks. Only rank 0
+evaluates, logs and saves checkpoints.
+'''
+
+
+def init_distributed(rank, world_size, init_method, timeout_minutes=180):
+    """
+    timeout_minutes: how long collectives wait; the other ranks wait in one while
+    rank 0 decodes or validates on the dev set, which can exceed gloo's 30 minute default
+    """
+    dist.init_process_group("gloo", init_method=init_method, rank=rank, world_size=world_size, 
+                            timeout=datetime.timedelta(minutes=timeout_minutes))
+    # share the cores between ranks instead of oversubscribing them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+
+
+def launch(fn, args):
+    """
+    Run fn(rank, args) in args.world_size processes with a local file rendezvous
+    """
+    if args.dist_init is None:
+        fd, path = tempfile.mkstemp(prefix="dist_init_")
+        os.close(fd)
+        os.remove(path)
+        args.dist_init = "file://" + path
+    mp.spawn(fn, args=(args,), nprocs=args.world_size, join=True)
+
+
+def broadcast_parameters(module, src=0):
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(tensor.data, src)
+
+
+def average_gradients(module, world_size, bucket_size=2**22):
+    """
+    All-reduce the gradients of module in buckets of up to bucket_size elements
+    """
+    grads = []
+    for p in module.parameters():
+        if not p.requires_grad:
+            continue
+        if p.grad is None:
+            # keep the collectives identical on every rank
+            p.grad = torch.zeros_like(p.data)
+        grads.append(p.grad.data)
+
+    bucket, size = [], 0
+    for grad in grads:
+        if bucket and size + grad.numel() > bucket_size:
+            _all_reduce_bucket(bucket, world_size)
+            bucket, size = [], 0
+        bucket.append(grad)
+        size += grad.numel()
+    if bucket:
+        _all_reduce_bucket(bucket, world_size)
+
+
+def _all_reduce_bucket(bucket, world_size):
+    flat = _flatten_dense_tensors(bucket)
+    dist.all_reduce(flat)
+    flat.div_(world_size)
+    for grad, reduced in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+        grad.copy_(reduced)
+
+
+def all_reduce_sum(value):
+    tensor = torch.tensor([float(value)])
+    dist.all_reduce(tensor)
+    return tensor.item()
+
+
+def broadcast_flag(flag, src=0):
+    tensor = torch.tensor([int(flag)])
+    dist.broadcast(tensor, src)
+    return bool(tensor.item())
+
+
+def scaling_report(fn, args, read_throughput):
+    """
+    Train one epoch with 1, 2, 4, ... up to args.world_size ranks and print the
+    throughput and scaling efficiency of each run
+    @param read_throughput: function (args) -> sentences/sec of the last run
+    """
+    world_sizes = [1]
+    while world_sizes[-1] * 2 <= args.world_size:
+        world_sizes.append(world_sizes[-1] * 2)
+    if world_sizes[-1] != args.world_size:
+        world_sizes.append(args.world_size)
+
+    results = []
+    for world_size in world_sizes:
+        run_args = copy.deepcopy(args)
+        run_args.world_size, run_args.dist_init = world_size, None
+        run_args.epoch, run_args.print_every, run_args.save_model = 1, 10**9, False
+        if world_size == 1:
+            fn(0, run_args)
+        else:
+            launch(fn, run_args)
+        results.append((world_size, read_throughput(run_args)))
+
+    base = results[0][1]
+    print("ranks  sentences/sec  speedup  efficiency")
+    for world_size, throughput in results:
+        print("%5d  %13.1f  %7.2f  %9.1f%%" % (world_size, throughput, throughput / base,
+                                                100 * throughput / (base * world_size)))
+    return results
@@ -0,0 +1,272 @@
+import copy
+from typing import Optional, Tuple
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.nn.utils.rnn as rnn
+from torch import Tensor
+from tools.quantization import fold_embeddings
+
+'''
+Usage:
+export_model(encoder, decoder, "zh_attn.pt")
+encoder, decoder = load_exported("zh_attn.pt", device)
+decoded_words, _ = evaluate(encoder, decoder, source, source_len, ...)
+
+The artifact is a single TorchScript module with three methods: encode(),
+prepare() (attention keys and mask, once per sentence) and forward() (one
+decoder step). Embedding folding, GRU/LSTM, bi/uni and the attention method
+are resolved when exporting, and loading needs torch only. Supported models
+are EncoderRNN with DecoderRNN or DecoderRNN_Attention.
+'''
+
+
+class ScriptMaxout(nn.Module):
+    d_out: torch.jit.Final[int]
+    pool_size: torch.jit.Final[int]
+
+    def __init__(self, maxout):
+        super(ScriptMaxout, self).__init__()
+        self.lin = maxout.lin
+        self.d_out = maxout.d_out
+        self.pool_size = maxout.pool_size
+
+    def forward(self, inputs):
+        out = self.lin(inputs)
+        return out.view(inputs.size(0), self.d_out, self.pool_size).max(2)[0]
+
+
+class ScriptEncoderRNN(nn.Module):
+    use_bi: torch.jit.Final[bool]
+    num_layers: torch.jit.Final[int]
+    hidden_size: torch.jit.Final[int]
+    decoder_layers: torch.jit.Final[int]
+
+    def __init__(self, encoder):
+        super(ScriptEncoderRNN, self).__init__()
+        if encoder.self_attention:
+            raise ValueError("export does not support EncoderRNN with self attention")
+        encoder = fold_embeddings(encoder)
+        self.embedding = encoder.embedding_liquid
+        self.gru = encoder.gru if encoder.rnn_type == 'GRU' else None
+        self.lstm = encoder.lstm if encoder.rnn_type == 'LSTM' else None
+        self.decoder2c = encoder.decoder2c
+        self.decoder2h0 = encoder.decoder2h0
+        self.use_bi = bool(encoder.use_bi)
+        self.num_layers = encoder.num_layers
+        self.hidden_size = encoder.hidden_size
+        self.decoder_layers = encoder.decoder_layers
+
+    def forward(self, source, lengths):
+        # type: (Tensor, Tensor) -> Tuple[Optional[Tensor], Tensor, Tensor, Tensor, Optional[Tensor]]
+        batch_size = source.size(0)
+        seq_len = source.size(1)
+        embedded = self.embedding(source)
+        packed = rnn.pack_padded_sequence(embedded, lengths.cpu(), batch_first=True)
+        h0 = torch.zeros(self.num_layers * (1 + int(self.use_bi)), batch_size, self.hidden_size,
+                         device=source.device)
+        c_state: Optional[Tensor] = None
+        if self.lstm is not None:
+            packed_outputs, (hidden, c_n) = self.lstm(packed, (h0, h0))
+            c_state = c_n
+        else:
+            assert self.gru is not None
+            packed_outputs, hidden = self.gru(packed, h0)
+        outputs, output_lengths = rnn.pad_packed_sequence(packed_outputs, batch_first=True)
+
+        if self.use_bi:
+            outputs = outputs.view(batch_size, seq_len, 2, self.hidden_size)
+            hidden = self.decoder2h0(outputs[:, 0, 1, :])
+            hidden = hidden.unsqueeze(0).transpose(0, 1).reshape(
+                batch_size, self.decoder_layers, -1).transpose(0, 1).contiguous()
+            if c_state is not None:
+                c_state = hidden
+            return None, hidden, outputs, output_lengths, c_state
+
+        hidden = hidden.transpose(0, 1).contiguous().view(batch_size, 1, -1).transpose(0, 1)
+        c = self.decoder2c(hidden)
+        hidden = self.decoder2h0(c)
+        hidden = hidden.transpose(0, 1).reshape(batch_size, self.decoder_layers, -1).transpose(0, 1).contiguous()
+        if c_state is not None:
+            c_state = c_state.transpose(0, 1).contiguous().view(batch_size, 1, -1).transpose(0, 1)
+            c = self.decoder2c(c_state)
+            c_state = self.decoder2h0(c)
+            c_state = c_state.transpose(0, 1).reshape(batch_size, self.decoder_layers, -1).transpose(0, 1).contiguous()
+        return c, hidden, outputs, output_lengths, c_state
+
+
+class ScriptDecoderRNN(nn.Module):
+    def __init__(self, decoder):
+        super(ScriptDecoderRNN, self).__init__()
+        decoder = fold_embeddings(decoder)
+        self.embedding = decoder.embedding_liquid
+        self.gru = decoder.gru if decoder.rnn_type == 'GRU' else None
+        self.lstm = decoder.lstm if decoder.rnn_type == 'LSTM' else None
+        self.maxout = ScriptMaxout(decoder.maxout)
+        self.linear = decoder.linear
+
+    def prepare(self, encoder_outputs, lengths):
+        # type: (Tensor, Tensor) -> Tuple[Tensor, Tensor]
+        return encoder_outputs, lengths
+
+    def forward(self, word_input, last_hidden, c, memory, mask, c_state):
+        # type: (Tensor, Tensor, Optional[Tensor], Tensor, Tensor, Optional[Tensor]) -> Tuple[Tensor, Tensor, Optional[Tensor], Optional[Tensor]]
+        assert c is not None
+        embedded = self.embedding(word_input)
+        rnn_input = torch.cat((embedded, c.transpose(0, 1)), dim=2)
+        if self.lstm is not None:
+            assert c_state is not None
+            output, (hidden, c_n) = self.lstm(rnn_input, (last_hidden, c_state))
+            c_state = c_n
+        else:
+            assert self.gru is not None
+            output, hidden = self.gru(rnn_input, last_hidden)
+        output = torch.cat((output.squeeze(1), rnn_input.squeeze(1)), dim=1)
+        output = self.linear(self.maxout(output))
+        return F.log_softmax(output, dim=1), hidden, None, c_state
+
+
+class ScriptDecoderRNN_Attention(nn.Module):
+    dim_match: torch.jit.Final[bool]
+    use_dot: torch.jit.Final[bool]
+
+    def __init__(self, decoder):
+        super(ScriptDecoderRNN_Attention, self).__init__()
+        decoder = fold_embeddings(decoder)
+        self.embedding = decoder.embedding_liquid
+        self.gru = decoder.gru if decoder.rnn_type == 'GRU' else None
+        self.lstm = decoder.lstm if decoder.rnn_type == 'LSTM' else None
+        self.preprocess = decoder.attn.preprocess
+        self.energy = decoder.attn.energy
+        self.maxout = ScriptMaxout(decoder.maxout)
+        self.linear = decoder.linear
+        # a one layer decoder attends over preprocessed encoder outputs, see Attention.forward
+        self.dim_match = decoder.n_layers != 1
+        self.use_dot = decoder.attn.method == "dot"
+
+    def prepare(self, encoder_outputs, lengths):
+        # type: (Tensor, Tensor) -> Tuple[Tensor, Tensor]
+        memory = encoder_outputs.reshape(encoder_outputs.size(0), encoder_outputs.size(1), -1)
+        if not self.dim_match:
+            memory = self.preprocess(memory)
+        positions = torch.arange(memory.size(1), device=lengths.device)
+        mask = positions.unsqueeze(0).expand(lengths.size(0), memory.size(1)) > lengths.unsqueeze(1)
+        return memory, mask.to(memory.device)
+
+    def forward(self, word_input, last_hidden, c, memory, mask, c_state):
+        # type: (Tensor, Tensor, Optional[Tensor], Tensor, Tensor, Optional[Tensor]) -> Tuple[Tensor, Tensor, Optional[Tensor], Optional[Tensor]]
+        embedded = self.embedding(word_input)
+
+        if self.dim_match:
+            query = last_hidden.transpose(0, 1).contiguous().view(memory.size(0), -1, 1)
+            if self.use_dot:
+                energy = torch.bmm(memory, query)
+            else:
+                energy = self.energy(torch.cat([query.transpose(1, 2).expand_as(memory), memory], dim=2))
+        else:
+            if self.use_dot:
+                energy = torch.bmm(memory, last_hidden.permute(1, 2, 0))
+            else:
+                energy = self.energy(torch.cat([last_hidden.transpose(0, 1).expand_as(memory), memory], dim=2))
+        energy = energy.squeeze(2).masked_fill(mask, -float('inf'))
+        attn = F.softmax(energy, dim=1).unsqueeze(1)
+        attn_context = torch.bmm(attn, memory)
+
+        rnn_input = torch.cat([attn_context, embedded], dim=2)
+        if self.lstm is not None:
+            assert c_state is not None
+            output, (hidden, c_n) = self.lstm(rnn_input, (last_hidden, c_state))
+            c_state = c_n
+        else:
+            assert self.gru is not None
+            output, hidden = self.gru(rnn_input, last_hidden)
+        output = torch.cat((output.squeeze(1), rnn_input.squeeze(1)), dim=1)
+        output = self.linear(self.maxout(output))
+        return F.log_softmax(output, dim=1), hidden, attn, c_state
+
+
+class InferenceGraph(nn.Module):
+    output_size: torch.jit.Final[int]
+
+    def __init__(self, encoder, decoder):
+        super(InferenceGraph, self).__init__()
+        self.encoder = ScriptEncoderRNN(encoder)
+        if hasattr(decoder, "attn"):
+            self.decoder = ScriptDecoderRNN_Attention(decoder)
+        else:
+            self.decoder = ScriptDecoderRNN(decoder)
+        self.output_size = decoder.output_size
+
+    @torch.jit.export
+    def encode(self, source, lengths):
+        # type: (Tensor, Tensor) -> Tuple[Optional[Tensor], Tensor, Tensor, Tensor, Optional[Tensor]]
+        return self.encoder(source, lengths)
+
+    @torch.jit.export
+    def prepare(self, encoder_outputs, lengths):
+        # type: (Tensor, Tensor) -> Tuple[Tensor, Tensor]
+        return self.decoder.prepare(encoder_outputs, lengths)
+
+    def forward(self, word_input, last_hidden, c, memory, mask, c_state):
+        # type: (Tensor, Tensor, Optional[Tensor], Tensor, Tensor, Optional[Tensor]) -> Tuple[Tensor, Tensor, Optional[Tensor], Optional[Tensor]]
+        return self.decoder(word_input, last_hidden, c, memory, mask, c_state)
+
+
+def export_model(encoder, decoder, path):
+    """
+    Script encoder and decoder step into a single file loadable with torch.jit.load
+    """
+    if type(encoder).__name__ != "EncoderRNN" or \
+            type(decoder).__name__ not in ("DecoderRNN", "DecoderRNN_Attention"):
+        raise ValueError("export supports EncoderRNN with DecoderRNN or DecoderRNN_Attention, got %s and %s"
+                         % (type(encoder).__name__, type(decoder).__name__))
+    if encoder.attention_outputs:
+        raise ValueError("export does not support the unidirectional attention encoder")
+    graph = InferenceGraph(copy.deepcopy(encoder).eval(), copy.deepcopy(decoder).eval()).eval()
+    scripted = torch.jit.script(graph)
+    scripted = torch.jit.freeze(scripted, preserved_attrs=["encode", "prepare", "output_size"])
+    scripted.save(path)
+    return scripted
+
+
+class ExportedEncoder(object):
+    """
+    Presents an exported graph with the EncoderRNN interface used by evaluate()
+    """
+    def __init__(self, graph):
+        self.graph = graph
+
+    def eval(self):
+        return self
+
+    def initHidden(self, batch_size):
+        return None, None
+
+    def __call__(self, source, hidden, lengths, c_state=None):
+        return self.graph.encode(source, lengths)
+
+
+class ExportedDecoder(object):
+    """
+    Presents an exported graph with the decoder interface used by evaluate() and
+    beam_decode(). Attention keys and mask are computed once per encoder output.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        self.output_size = graph.output_size
+        self.encoder_outputs = None
+        self.encoder_output_lengths = None
+
+    def eval(self):
+        return self
+
+    def __call__(self, word_input, last_hidden, c, encoder_outputs, encoder_output_lengths, c_state=None):
+        if encoder_outputs is not self.encoder_outputs or encoder_output_lengths is not self.encoder_output_lengths:
+            self.encoder_outputs, self.encoder_output_lengths = encoder_outputs, encoder_output_lengths
+            self.memory, self.mask = self.graph.prepare(encoder_outputs, encoder_output_lengths)
+        return self.graph(word_input, last_hidden, c, self.memory, self.mask, c_state)
+
+
+def load_exported(path, device="cpu"):
+    graph = torch.jit.load(path, map_location=device)
+    return ExportedEncoder(graph), ExportedDecoder(graph)
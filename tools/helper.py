@@ -1,7 +1,6 @@
+import argparse
 import time
 import math
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
 import numpy as np
 from subprocess import call
 import os.path
@@ -30,6 +29,9 @@ def timeSince(since, percent):
 #    plt.plot(points)
 
 def showPlot(points, title, save_pth):
+    # matplotlib takes longer to import than the rest of the inference path, load it when plotting
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
     plt.figure()
     fig, ax = plt.subplots(figsize=(15,10))
     # this locator puts ticks at regular intervals
@@ -0,0 +1,24 @@
+import contextlib
+import torch
+
+'''
+Usage:
+with autocast(precision, device):
+    loss = ...
+
+"bfloat16" runs Linear/matmul work (Maxout, output projections,
+MultiHeadedAttention, feed-forward sublayers, attention energy) and, where
+the backend has a bf16 kernel, LSTM under torch.autocast. Softmax,
+log-softmax, the loss and LayerNorm statistics are computed in float32 in
+models/encoder_decoder.py. Weights and optimizer state stay float32.
+'''
+
+PRECISIONS = ("float32", "bfloat16")
+
+
+def autocast(precision, device):
+    if precision == "float32":
+        return contextlib.nullcontext()
+    if precision == "bfloat16":
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    raise ValueError("unknown precision %s, expected one of %s" % (precision, PRECISIONS))
@@ -75,34 +75,41 @@ def char_tokenizer(sent):
     char_sent = ' '.join(list(sent))
     return char_sent
 
+def normalizeSource(source, lang, char=True):
+    """
+    Source side cleanup shared by readLangs and raw-text translation
+    @param source: raw source sentence
+    @param lang: source language, zh or vi
+    @param char: whether chinese is tokenized in character level
+    """
+    if char and (lang == "zh"):
+    # tokenize in chinese character level
+        source = char_tokenizer(source)
+    # remove quotation marks and also remove underscore in vietnamese word
+    source = source.replace("&apos", "").replace("&quot","").replace("_","") 
+    source = re.sub("([,|.|!|?])", "", source)
+    source = re.sub("[\（\[].*?[\）\]]", "", source)
+    source = re.sub( '\s+', ' ', source)
+    source = source.strip()
+
+    # undo the first-word capitalization for Vietamese
+    if lang == 'vi' and source != "":
+        source = source.replace(source[0], source[0].lower())
+    return source
+
 def readLangs(t, lang1, lang2, path, reverse=False, char=True):
     
     if char and (lang1 == "zh"):
-    # tokenize in chinese character level
         path_lang1 = "%s/iwslt-%s-%s/%s.%s" % (path, lang1, lang2, t, lang1) # get source sentence
         path_lang2 = "%s/iwslt-%s-%s/%s.tok.%s" % (path, lang1, lang2, t, lang2) # get target sentence
-        char_lang1 = [char_tokenizer(sent) for sent in read_data(path_lang1)]
-        zipped = zip(char_lang1, read_data(path_lang2))
     else:
         path_lang1 = "%s/iwslt-%s-%s/%s.tok.%s" % (path, lang1, lang2, t, lang1)
         path_lang2 = "%s/iwslt-%s-%s/%s.tok.%s" % (path, lang1, lang2, t, lang2)
-        zipped = zip(read_data(path_lang1), read_data(path_lang2))
+    zipped = zip(read_data(path_lang1), read_data(path_lang2))
     
     pairs = []
     for source, target in zipped:
-        # remove quotation marks and also remove underscore in vietnamese word
-        source = source.replace("&apos", "").replace("&quot","").replace("_","") 
-        source = re.sub("([,|.|!|?])", "", source)
-        source = re.sub("[\（\[].*?[\）\]]", "", source)
-        source = re.sub( '\s+', ' ', source)
-        
-        pairs.append([source.strip(), normalizeString(target, noPunc=True).strip()])
-    
-    # undo the first-word capitalization for Vietamese
-    if lang1 == 'vi': 
-        for i in range(len(pairs)):
-            if pairs[i][0] is not "":
-                pairs[i][0] = pairs[i][0].replace(pairs[i][0][0], pairs[i][0][0].lower())
+        pairs.append([normalizeSource(source, lang1, char), normalizeString(target, noPunc=True).strip()])
     
     # Reverse pairs, make Lang instances
     if reverse:
@@ -0,0 +1,155 @@
+import contextlib
+import json
+import time
+from collections import defaultdict
+import torch
+
+'''
+Usage:
+profiling.enable("results/zh_attn-profile.jsonl", trace_path="results/zh_attn-trace.json")
+with profiling.stage("encoder"):
+    ...
+profiling.count("sentences", source.size(0))
+profiling.dump(epoch=epoch)    # one JSON line with the totals since the last dump
+
+Opt-in, process wide. While disabled stage() returns one shared null context
+and count() returns at once, so the instrumented loops pay a function call.
+Stage times synchronize CUDA so they are attributed to the right stage. A
+stage nested in another is counted in both. Collate only shows up for
+loaders with num_workers=0; with workers it is part of data_loader.
+'''
+
+_NULL = contextlib.nullcontext()
+_stats = None
+
+
+class _Stats(object):
+    def __init__(self, path, trace_path):
+        self.path = path
+        self.trace_path = trace_path
+        self.sync = torch.cuda.is_available()
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counts = defaultdict(int)
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+        if self.sync:
+            torch.cuda.synchronize()
+        self.seconds[name] += time.perf_counter() - start
+        self.calls[name] += 1
+
+
+def enable(path, trace_path=None):
+    """
+    @param path: JSON lines file the dumps are appended to
+    @param trace_path: where trace() writes a PyTorch profiler (chrome) trace, None for no trace
+    """
+    global _stats
+    _stats = _Stats(path, trace_path)
+
+
+def disable():
+    global _stats
+    _stats = None
+
+
+def enabled():
+    return _stats is not None
+
+
+def stage(name):
+    if _stats is None:
+        return _NULL
+    return _stats.stage(name)
+
+
+def count(name, value=1):
+    """
+    @param value: int or a tensor, tensors are only read on host at dump() time
+    """
+    if _stats is None:
+        return
+    _stats.counts[name] = _stats.counts[name] + value
+
+
+def trace():
+    """
+    Context that records a PyTorch profiler trace to trace_path, null when not requested
+    """
+    if _stats is None or _stats.trace_path is None:
+        return _NULL
+    return _Trace(_stats.trace_path)
+
+
+class _Trace(object):
+    def __init__(self, path):
+        self.path = path
+        self.profiler = torch.profiler.profile(record_shapes=True)
+
+    def __enter__(self):
+        self.profiler.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.__exit__(*exc)
+        self.profiler.export_chrome_trace(self.path)
+        return False
+
+
+def dump(**extra):
+    """
+    Append the stage times, counts and per second rates since the last dump as
+    one JSON line, then start over
+    @param extra: fields added to the line, e.g. epoch or phase
+    """
+    if _stats is None:
+        return None
+    wall = time.time() - _stats.start
+    counts = {k: v.item() if torch.is_tensor(v) else v for k, v in _stats.counts.items()}
+    record = dict(extra)
+    record.update({"wall_seconds": wall,
+                   "seconds": dict(_stats.seconds),
+                   "calls": dict(_stats.calls),
+                   "counts": counts,
+                   "per_second": {k: v / wall for k, v in counts.items() if wall > 0}})
+    with open(_stats.path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    _stats.reset()
+    return record
+
+
+class Timed(object):
+    """
+    Picklable wrapper that times fn as a stage, e.g. a DataLoader collate_fn
+    """
+    def __init__(self, fn, name):
+        self.fn = fn
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        with stage(self.name):
+            return self.fn(*args, **kwargs)
+
+
+def timed_iter(iterable, name):
+    """
+    Yield from iterable, timing each next() as a stage (the wait for a DataLoader batch)
+    """
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
@@ -0,0 +1,109 @@
+import copy
+import io
+import os
+import time
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig, float_qparams_weight_only_qconfig
+
+'''
+Usage:
+q_encoder, q_decoder = quantize_model(encoder, decoder)
+save_quantized(q_encoder, q_decoder, label)
+q_encoder, q_decoder = load_quantized(encoder, decoder, label)
+has_quantized(label, ["encoder-<label>.ckpt", "decoder-<label>.ckpt"])    # False once they are retrained
+
+GRU/LSTM and Linear layers (Maxout, output projection, attention energy,
+transformer projections and feed-forward) run with dynamic int8 weights and
+activations; embedding tables are stored as per-row uint8. CPU only.
+'''
+
+QUANTIZED_MODULES = {nn.GRU: default_dynamic_qconfig,
+                     nn.LSTM: default_dynamic_qconfig,
+                     nn.Linear: default_dynamic_qconfig,
+                     nn.Embedding: float_qparams_weight_only_qconfig}
+
+
+def fold_embeddings(model):
+    """
+    Merge embedding_freeze and the masked embedding_liquid into a single table,
+    which is what forward() computes for every token anyway
+    """
+    if getattr(model, "notPretrained", None) is None:
+        return model
+    weight = model.embedding_freeze.weight.data + model.embedding_liquid.weight.data * model.notPretrained
+    model.embedding_liquid.weight = nn.Parameter(weight)
+    del model.embedding_freeze
+    model.notPretrained = None
+    return model
+
+
+def quantize_model(encoder, decoder):
+    """
+    Returns int8 copies of encoder and decoder, the float models are left untouched
+    """
+    quantized = []
+    for model in (encoder, decoder):
+        model = fold_embeddings(copy.deepcopy(model).cpu().eval())
+        model.device = "cpu"
+        quantized.append(quantize_dynamic(model, QUANTIZED_MODULES))
+    return quantized[0], quantized[1]
+
+
+def quantized_path(name, label):
+    return name + "-" + label + "-int8.ckpt"
+
+
+def save_quantized(encoder, decoder, label):
+    torch.save(encoder.state_dict(), quantized_path("encoder", label))
+    torch.save(decoder.state_dict(), quantized_path("decoder", label))
+
+
+def load_quantized(encoder, decoder, label):
+    """
+    @param encoder, decoder: float models built with the same arguments as the saved ones
+    """
+    encoder, decoder = quantize_model(encoder, decoder)
+    encoder.load_state_dict(torch.load(quantized_path("encoder", label), weights_only=False))
+    decoder.load_state_dict(torch.load(quantized_path("decoder", label), weights_only=False))
+    return encoder, decoder
+
+
+def has_quantized(label, checkpoint_paths=()):
+    """
+    @param checkpoint_paths: float checkpoints the int8 files were made from; files older than any of them are stale
+    """
+    paths = [quantized_path("encoder", label), quantized_path("decoder", label)]
+    if not all(os.path.exists(path) for path in paths):
+        return False
+    made = min(os.path.getmtime(path) for path in paths)
+    return all(os.path.getmtime(path) <= made for path in checkpoint_paths if os.path.exists(path))
+
+
+def model_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def compare_quantized(encoder, decoder, q_encoder, q_decoder, bleu_fn, n_sentences):
+    """
+    Report BLEU, latency and size of the float and int8 models
+    @param bleu_fn: function (encoder, decoder) -> bleu score, e.g. eval.test on the dev loader
+    @param n_sentences: number of sentences bleu_fn decodes
+    """
+    results = {}
+    for name, enc, dec in (("float32", encoder, decoder), ("int8", q_encoder, q_decoder)):
+        start = time.time()
+        bleu = bleu_fn(enc, dec)
+        elapsed = time.time() - start
+        results[name] = {"bleu": bleu,
+                         "ms_per_sentence": 1000 * elapsed / max(n_sentences, 1),
+                         "size_mb": (model_size(enc) + model_size(dec)) / 2.**20}
+        print("%s: bleu %.3f, %.2f ms/sentence, %.1f MB" % (name, results[name]["bleu"],
+              results[name]["ms_per_sentence"], results[name]["size_mb"]))
+    print("int8 vs float32: bleu delta %.3f, latency x%.2f, size x%.2f" % (
+          results["int8"]["bleu"] - results["float32"]["bleu"],
+          results["float32"]["ms_per_sentence"] / max(results["int8"]["ms_per_sentence"], 1e-9),
+          results["float32"]["size_mb"] / max(results["int8"]["size_mb"], 1e-9)))
+    return results
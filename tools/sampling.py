@@ -0,0 +1,45 @@
+import numpy as np
+import torch
+
+'''
+Usage:
+order = stratified_order(source_lengths(dataset), seed=0)
+loader = subset_loader(dev_loader, order[:1000])    # the same 1000 sentences on every run
+
+stratified_order() sorts the sentences by source length, cuts them into
+equal sized strata, shuffles each stratum with a fixed seed and then takes one
+sentence from every stratum in turn. Any prefix of the order is therefore a
+reproducible sample with roughly the length distribution of the whole set,
+so a larger sample is just a longer prefix of the same order.
+'''
+
+
+def source_lengths(dataset):
+    """
+    Source length in tokens of every pair of a tools.Dataloader.Dataset, without building tensors
+    """
+    return np.array([len(pair[0].split(' ')) for pair in dataset.pairs])
+
+
+def stratified_order(lengths, strata=10, seed=0):
+    """
+    @return: a permutation of range(len(lengths)) whose prefixes are length stratified samples
+    """
+    rng = np.random.RandomState(seed)
+    groups = np.array_split(np.argsort(lengths, kind="stable"), min(strata, max(len(lengths), 1)))
+    for group in groups:
+        rng.shuffle(group)
+    # stratum k contributes its i-th sentence at position i, so prefixes stay balanced
+    position = np.concatenate([np.arange(len(group)) for group in groups])
+    stratum = np.concatenate([np.full(len(group), k) for k, group in enumerate(groups)])
+    merged = np.concatenate(groups)
+    return merged[np.lexsort((stratum, position))]
+
+
+def subset_loader(loader, indices):
+    """
+    A loader like `loader` over only the given dataset indices, in dataset order
+    """
+    subset = torch.utils.data.Subset(loader.dataset, sorted(int(i) for i in indices))
+    return torch.utils.data.DataLoader(subset, batch_size=loader.batch_size, shuffle=False,
+                                       collate_fn=loader.collate_fn, num_workers=loader.num_workers)
@@ -0,0 +1,92 @@
+import re
+
+'''
+Usage:
+leading, pieces = split_document(text, "zh", max_tokens=60, count=lambda s: len(normalizeSource(s, "zh").split()))
+text == leading + ''.join(sentence + whitespace for sentence, whitespace in pieces)
+
+split_document() cuts a paragraph or a whole document into sentences with
+per-language rules and keeps the whitespace that followed every sentence, so
+the input can be rebuilt exactly and a translation can be laid out the same
+way. Line breaks always end a sentence. Sentences still longer than
+max_tokens are cut again at clause punctuation, so they stay in the length
+range the model was trained on.
+'''
+
+# closing quotes and brackets stay with the sentence they end
+_CLOSERS = "\"'”’」』）)\\]》"
+_SENTENCE_END = {
+    # chinese stops need no whitespace after them
+    "zh": re.compile(r"[。！？!?；…]+[%s]*|\.(?=\s)" % _CLOSERS),
+    # latin script: a stop followed by whitespace, and no lower case word next (see _cut)
+    "vi": re.compile(r"[.!?…]+[%s]*(?=\s)" % _CLOSERS),
+    "en": re.compile(r"[.!?…]+[%s]*(?=\s)" % _CLOSERS),
+}
+_CLAUSE_END = re.compile(r"[，,、；;：:]+[%s]*" % _CLOSERS)
+# a stop after these does not end the sentence
+_NO_BREAK = {"en": re.compile(r"(?:\b(?:Mr|Mrs|Ms|Dr|Prof|Sr|Jr|St|vs|etc|Inc|Ltd|Co|No|e\.g|i\.e)|\b[A-Z])\.$"),
+             "vi": re.compile(r"(?:\b(?:TS|ThS|PGS|GS|TP|Tp)|\b[A-ZĐ])\.$")}
+
+
+def _cut(text, start, end, pattern, skip=None, lower_continues=False):
+    """
+    Spans of text[start:end] ending at every match of pattern
+    @param skip: matched against the text up to the match, a hit means no cut
+    @param lower_continues: no cut when the next word starts in lower case
+    """
+    spans, begin = [], start
+    for match in pattern.finditer(text, start, end):
+        if skip is not None and skip.search(text[begin:match.end()]):
+            continue
+        if lower_continues and text[match.end():end].lstrip()[:1].islower():
+            continue
+        spans.append((begin, match.end()))
+        begin = match.end()
+    spans.append((begin, end))
+    return spans
+
+
+def _strip(text, spans):
+    stripped = []
+    for start, end in spans:
+        piece = text[start:end]
+        if piece.strip():
+            stripped.append((start + len(piece) - len(piece.lstrip()), end - len(piece) + len(piece.rstrip())))
+    return stripped
+
+
+def _split_long(text, start, end, max_tokens, count):
+    """
+    Cut text[start:end] at clause punctuation into spans of at most max_tokens where possible
+    """
+    if count(text[start:end]) <= max_tokens:
+        return [(start, end)]
+    spans = []
+    for clause_start, clause_end in _cut(text, start, end, _CLAUSE_END):
+        if spans and count(text[spans[-1][0]:clause_end]) <= max_tokens:
+            spans[-1] = (spans[-1][0], clause_end)
+        else:
+            spans.append((clause_start, clause_end))
+    return _strip(text, spans)
+
+
+def split_document(text, language, max_tokens=None, count=None):
+    """
+    @param language: zh, vi or en
+    @param max_tokens: optional, sentences with more tokens are cut at clause punctuation
+    @param count: number of model tokens in a piece of text, needed with max_tokens
+    @return: whitespace before the first sentence, list of (sentence, whitespace after it)
+    """
+    if language not in _SENTENCE_END:
+        raise ValueError("no sentence splitting rules for %s" % language)
+    spans = []
+    for line in re.finditer(r"[^\n]+", text):
+        spans.extend(_cut(text, line.start(), line.end(), _SENTENCE_END[language], _NO_BREAK.get(language), 
+                          lower_continues=language != "zh"))
+    spans = _strip(text, spans)
+    if max_tokens is not None:
+        spans = [span for start, end in spans for span in _split_long(text, start, end, max_tokens, count)]
+    if not spans:
+        return text, []
+    ends = [start for start, _ in spans[1:]] + [len(text)]
+    return text[:spans[0][0]], [(text[start:end], text[end:next_start]) for (start, end), next_start in zip(spans, ends)]
@@ -0,0 +1,192 @@
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Usage:
+server = TranslationServer(translator.translate, host="127.0.0.1", port=8000,
+                           max_batch_size=32, max_wait_ms=10, max_queue=1024)
+server.serve_forever()
+
+POST /translate  {"text": "..."} or {"texts": ["...", ...]}
+              -> {"translations": ["...", ...]}
+GET  /stats   -> throughput and latency counters
+'''
+
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class ServerStats(object):
+    def __init__(self, window=10000):
+        self.start = time.time()
+        self.requests = 0
+        self.sentences = 0
+        self.batches = 0
+        self.rejected = 0
+        self.errors = 0
+        self.batch_time = 0.
+        # keep a bounded window of latencies for the percentiles
+        self.latencies = deque(maxlen=window)
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0.
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.))]
+
+    def as_dict(self, queue_size=0):
+        uptime = time.time() - self.start
+        return {"uptime": uptime,
+                "requests": self.requests,
+                "sentences": self.sentences,
+                "batches": self.batches,
+                "rejected": self.rejected,
+                "errors": self.errors,
+                "queue_size": queue_size,
+                "avg_batch_size": self.sentences / max(self.batches, 1),
+                "avg_batch_time_ms": 1000 * self.batch_time / max(self.batches, 1),
+                "sentences_per_sec": self.sentences / max(uptime, 1e-9),
+                "latency_p50_ms": 1000 * self.percentile(50),
+                "latency_p99_ms": 1000 * self.percentile(99)}
+
+
+class TranslationServer(object):
+    """
+    Local asyncio HTTP server. Sentences from all requests are queued and grouped
+    into dynamic batches of at most max_batch_size, waiting at most max_wait_ms
+    for a batch to fill. Batches run one at a time on a dedicated inference thread.
+    When more than max_queue sentences are waiting, requests are rejected with 503.
+    extra_stats is an optional callable whose dict is merged into GET /stats.
+    """
+    def __init__(self, translate_fn, host="127.0.0.1", port=8000,
+                 max_batch_size=32, max_wait_ms=10, max_queue=1024, extra_stats=None):
+        self.translate_fn = translate_fn
+        self.extra_stats = extra_stats
+        self.host = host
+        self.port = port
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.max_queue = max_queue
+        self.stats = ServerStats()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+
+    async def submit(self, sentences):
+        loop = asyncio.get_event_loop()
+        futures = []
+        for sentence in sentences:
+            future = loop.create_future()
+            self.queue.put_nowait((sentence, future))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    async def batcher(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            start = time.time()
+            try:
+                translations = await loop.run_in_executor(self.executor, self.translate_fn,
+                                                          [sentence for sentence, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.stats.batches += 1
+            self.stats.batch_time += time.time() - start
+            for (_, future), translation in zip(batch, translations):
+                if not future.done():
+                    future.set_result(translation)
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/stats":
+            stats = self.stats.as_dict(self.queue.qsize())
+            if self.extra_stats is not None:
+                stats.update(self.extra_stats())
+            return 200, stats
+        if method != "POST" or path != "/translate":
+            return 404, {"error": "unknown endpoint %s %s" % (method, path)}
+        try:
+            request = json.loads(body.decode("utf-8"))
+            sentences = request["texts"] if "texts" in request else [request["text"]]
+            if not all(isinstance(s, str) for s in sentences):
+                raise ValueError
+        except (ValueError, KeyError, TypeError):
+            return 400, {"error": 'expected {"text": str} or {"texts": [str]}'}
+        if self.queue.qsize() + len(sentences) > self.max_queue:
+            self.stats.rejected += 1
+            return 503, {"error": "server busy, retry later"}
+
+        start = time.time()
+        try:
+            translations = await self.submit(sentences)
+        except Exception as e:
+            self.stats.errors += 1
+            return 500, {"error": repr(e)}
+        self.stats.requests += 1
+        self.stats.sentences += len(sentences)
+        self.stats.latencies.append(time.time() - start)
+        return 200, {"translations": translations}
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, value = line.decode("latin-1").split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            status, payload = await self.route(method, path.split("?")[0], body)
+        except (ValueError, asyncio.IncompleteReadError):
+            status, payload = 400, {"error": "malformed request"}
+
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        header = "HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n" \
+                 % (status, STATUS[status], len(data))
+        if status == 503:
+            header += "Retry-After: 1\r\n"
+        writer.write((header + "Connection: close\r\n\r\n").encode("latin-1") + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def run(self):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self.batcher())
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        print("serving on http://%s:%d (max batch %d, max wait %.0fms)"
+              % (self.host, self.port, self.max_batch_size, self.max_wait * 1000))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,265 @@
+import numpy as np
+import torch
+from tools.Constants import SOS, EOS, UNK
+from tools.preprocess import normalizeSource
+from tools.precision import autocast
+from tools.token_bleu import TokenBLEU, vocab_map, trim_at_eos
+
+'''
+Usage:
+bleu, al, ap = wait_k_test(encoder, decoder, dev_loader, output_lang, output_lang_dev, k=3, max_length=...)
+
+stream = WaitKStream(encoder, decoder, input_lang, output_lang, k=3, max_length=..., language="zh")
+stream.push("我们今天")    # target words that became ready, possibly none
+stream.push("讨论")
+stream.finish()           # the source is complete, the rest of the translation
+
+Wait-k (Ma et al. 2019, STACL): target token t (from 0) is emitted once
+k + t source tokens have been read, attending only over the prefix read so
+far. IncrementalEncoder keeps the EncoderRNN state between reads: a
+unidirectional encoder only runs its recurrent layers (and, for the attention
+decoder, the output projection) over the new tokens. Train the attention model
+with --unidirectional_attn True for that. A bidirectional encoder cannot be
+extended: its backward direction starts at the last token read, so the whole
+prefix is encoded again after every read and decoding a sentence costs
+quadratic encoder time in its length.
+Latency is reported as average lagging (AL) and average proportion (AP) in
+source words.
+'''
+
+
+class IncrementalEncoder(object):
+    """
+    Encodes a growing source prefix for a batch of rows with an EncoderRNN.
+    Rows must be sorted by decreasing source length, as the collate function does.
+    """
+    def __init__(self, encoder):
+        if type(encoder).__name__ != "EncoderRNN" or encoder.self_attention:
+            raise ValueError("incremental encoding needs an EncoderRNN without source self attention")
+        self.encoder = encoder
+
+    def reset(self, batch_size, device):
+        self.hidden, self.c_state = self.encoder.initHidden(batch_size)
+        self.tokens = torch.zeros(batch_size, 0, dtype=torch.long, device=device)
+        self.outputs = []
+        self.lengths = torch.zeros(batch_size, dtype=torch.long)
+        self.cached = None
+
+    def embed(self, tokens):
+        encoder = self.encoder
+        if encoder.notPretrained is None:
+            return encoder.embedding_liquid(tokens)
+        embedded = encoder.embedding_freeze(tokens)
+        encoder.embedding_liquid.weight.data.mul_(encoder.notPretrained)
+        return embedded + encoder.embedding_liquid(tokens)
+
+    def extend(self, tokens, active):
+        """
+        @param tokens: (batch_size, n) the next source tokens
+        @param active: (batch_size,) bool, rows that read them; the others keep their state
+        """
+        active_cpu = active.cpu()
+        self.lengths += tokens.size(1) * active_cpu.long()
+        self.tokens = torch.cat([self.tokens, tokens], dim=1)
+        self.cached = None
+        if self.encoder.use_bi:
+            return
+        embedded = self.embed(tokens).float()
+        if self.encoder.rnn_type == 'GRU':
+            outputs, hidden = self.encoder.gru(embedded, self.hidden)
+        else:
+            outputs, (hidden, c_state) = self.encoder.lstm(embedded, (self.hidden, self.c_state))
+            self.c_state = torch.where(active.view(1, -1, 1), c_state, self.c_state)
+        self.hidden = torch.where(active.view(1, -1, 1), hidden, self.hidden)
+        # rows that did not read get zero outputs, like pad_packed_sequence padding
+        if self.encoder.attention_outputs:
+            outputs = self.encoder.output2(outputs)
+        self.outputs.append(outputs * active.view(-1, 1, 1).to(outputs.dtype))
+
+    def state(self):
+        """
+        @return: (c, hidden, outputs, output_lengths, c_state) of EncoderRNN.forward on the prefix read so far
+        """
+        if self.cached is not None:
+            return self.cached
+        encoder = self.encoder
+        if encoder.use_bi:
+            seq_len = int(self.lengths.max())
+            hidden, c_state = encoder.initHidden(self.tokens.size(0))
+            self.cached = encoder(self.tokens[:, :seq_len], hidden, self.lengths.to(self.tokens.device), c_state)
+            return self.cached
+        batch_size = self.tokens.size(0)
+        outputs = torch.cat(self.outputs, dim=1)
+        if encoder.attention_outputs:
+            outputs = outputs.view(batch_size, outputs.size(1), 2, -1)
+        # the non-bidirectional tail of EncoderRNN.forward, on the carried state
+        hidden = self.hidden.transpose(0, 1).contiguous().view(batch_size, 1, -1).contiguous().transpose(0, 1)
+        c = encoder.decoder2c(hidden)
+        hidden = encoder.decoder2h0(c)
+        hidden = hidden.transpose(0, 1).view(batch_size, encoder.decoder_layers, -1).contiguous().transpose(0, 1)
+        c_state = None
+        if self.c_state is not None:
+            c_state = self.c_state.transpose(0, 1).contiguous().view(batch_size, 1, -1).contiguous().transpose(0, 1)
+            c_state = encoder.decoder2h0(encoder.decoder2c(c_state))
+            c_state = c_state.transpose(0, 1).view(batch_size, encoder.decoder_layers, -1).contiguous().transpose(0, 1)
+        self.cached = (c, hidden, outputs, self.lengths.clone(), c_state)
+        return self.cached
+
+
+def wait_k_decode(encoder, decoder, source, source_len, k, max_length, device, precision="float32"):
+    """
+    Greedy wait-k decoding of a batch
+    @param source, source_len: as from the collate function, sorted by decreasing length
+    @return: (batch_size, steps) word ids as from eval.evaluate, and (batch_size, steps) source tokens read before each target token
+    """
+    with torch.no_grad(), autocast(precision, device):
+        batch_size = source.size(0)
+        source_len = source_len.to(device)
+        incremental = IncrementalEncoder(encoder)
+        incremental.reset(batch_size, device)
+        read = 0
+        decoder_input = torch.tensor([[SOS]] * batch_size, device=device)
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        decoded_words, reads = [], []
+        for t in range(max_length):
+            while read < min(k + t, source.size(1)):
+                incremental.extend(source[:, read:read+1], read < source_len)
+                read += 1
+            c, hidden, encoder_outputs, encoder_output_lengths, c_state = incremental.state()
+            if t == 0:
+                # the decoder starts from the encoder state after the first k tokens, then keeps its own
+                decoder_hidden, decoder_c_state = hidden, c_state
+            decoder_output, decoder_hidden, _, decoder_c_state = decoder(decoder_input, decoder_hidden, c,
+                                                                         encoder_outputs, encoder_output_lengths,
+                                                                         decoder_c_state)
+            _, topi = decoder_output.topk(1)
+            decoded_words.append(topi.squeeze(1).detach())
+            reads.append(torch.clamp(source_len, max=k + t))
+            decoder_input = topi.detach()
+            finished |= topi.squeeze(1) == EOS
+            if finished.all():
+                break
+    return torch.stack(decoded_words, dim=1), torch.stack(reads, dim=1)
+
+
+def average_lagging(reads, source_len, target_len):
+    """
+    AL of one sentence, in source words
+    @param reads: source words read before each target word
+    """
+    if target_len == 0 or source_len == 0:
+        return 0.
+    reads = np.minimum(np.asarray(reads[:target_len], dtype=np.float64), source_len)
+    gamma = target_len / source_len
+    # tau: the first target word emitted after the whole source was read
+    tau = int(np.argmax(reads >= source_len)) + 1 if (reads >= source_len).any() else target_len
+    return float(np.mean(reads[:tau] - np.arange(tau) / gamma))
+
+
+def average_proportion(reads, source_len, target_len):
+    if target_len == 0 or source_len == 0:
+        return 0.
+    reads = np.minimum(np.asarray(reads[:target_len], dtype=np.float64), source_len)
+    return float(reads.sum() / (source_len * target_len))
+
+
+def wait_k_test(encoder, decoder, dataloader, output_lang, output_lang_dev, k, max_length, device,
+                precision="float32"):
+    """
+    Corpus BLEU of wait-k decoding of dataloader, with mean AL and AP
+    @return: bleu, average lagging, average proportion
+    """
+    bleu_cal = TokenBLEU(smooth="exp", smooth_floor=0.00, use_effective_order=True)
+    ref_map = vocab_map(output_lang_dev, output_lang).to(device)
+    encoder.eval()
+    decoder.eval()
+    lagging, proportion = [], []
+    for (data1, data2, len1, len2) in dataloader:
+        source, target, source_len, target_len = data1.to(device), data2.to(device), len1.to(device), len2.to(device)
+        decoded_words, reads = wait_k_decode(encoder, decoder, source, source_len, k, max_length, device, precision)
+        hyp, hyp_len = trim_at_eos(decoded_words)
+        bleu_cal.update(hyp, hyp_len, ref_map[target], target_len - 1)
+        # latency in words: the source EOS is not a word, the target EOS is not emitted
+        for r, x, y in zip(reads.cpu().numpy(), (len1 - 1).numpy(), hyp_len.cpu().numpy()):
+            lagging.append(average_lagging(r, x, y))
+            proportion.append(average_proportion(r, x, y))
+    return bleu_cal.score(), float(np.mean(lagging)) if lagging else 0., float(np.mean(proportion)) if proportion else 0.
+
+
+class WaitKStream(object):
+    """
+    Live wait-k translation of one sentence at a time, see the usage above.
+    After finish(), `reads` holds the source words read before each emitted word.
+    """
+    def __init__(self, encoder, decoder, input_lang, output_lang, k, max_length, language, char=True,
+                 device="cpu", precision="float32"):
+        self.encoder = encoder
+        self.decoder = decoder
+        self.input_lang = input_lang
+        self.output_lang = output_lang
+        self.k = k
+        self.max_length = max_length
+        self.language = language
+        self.char = char
+        self.device = device
+        self.precision = precision
+        self.encoder.eval()
+        self.decoder.eval()
+        self.reset()
+
+    def reset(self):
+        self.incremental = IncrementalEncoder(self.encoder)
+        self.incremental.reset(1, self.device)
+        self.read = 0
+        self.reads = []
+        self.words = []
+        self.done = False
+        self.decoder_input = torch.tensor([[SOS]], device=self.device)
+        self.decoder_hidden = self.decoder_c_state = None
+
+    def push(self, text):
+        """
+        @param text: the next raw source fragment
+        @return: list of target words that became ready
+        """
+        tokens = [t for t in normalizeSource(text, self.language, self.char).split(' ') if t]
+        if not tokens:
+            return []
+        ids = [self.input_lang.word2index.get(t, UNK) for t in tokens]
+        self.read_tokens(ids)
+        self.read += len(ids)
+        return self.emit(source_done=False)
+
+    def finish(self):
+        """
+        The source is complete: read its EOS and decode the rest
+        @return: list of the remaining target words
+        """
+        self.read_tokens([EOS])
+        return self.emit(source_done=True)
+
+    def read_tokens(self, ids):
+        with torch.no_grad(), autocast(self.precision, self.device):
+            self.incremental.extend(torch.tensor([ids], device=self.device), torch.ones(1, dtype=torch.bool))
+
+    def emit(self, source_done):
+        emitted = []
+        with torch.no_grad(), autocast(self.precision, self.device):
+            while not self.done and len(self.words) < self.max_length and \
+                  (source_done or self.read >= self.k + len(self.words)):
+                c, hidden, encoder_outputs, encoder_output_lengths, c_state = self.incremental.state()
+                if self.decoder_hidden is None:
+                    self.decoder_hidden, self.decoder_c_state = hidden, c_state
+                decoder_output, self.decoder_hidden, _, self.decoder_c_state = self.decoder(
+                    self.decoder_input, self.decoder_hidden, c, encoder_outputs, encoder_output_lengths,
+                    self.decoder_c_state)
+                _, topi = decoder_output.topk(1)
+                self.decoder_input = topi.detach()
+                word = topi.item()
+                if word == EOS:
+                    self.done = True
+                    break
+                self.words.append(self.output_lang.index2word[word])
+                self.reads.append(self.read)
+                emitted.append(self.words[-1])
+        return emitted
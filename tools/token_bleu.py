@@ -0,0 +1,168 @@
+import math
+import numpy as np
+import torch
+from tools.Constants import EOS
+
+'''
+Usage:
+bleu_cal = TokenBLEU(smooth="exp", use_effective_order=True)
+ref_map = vocab_map(output_lang_dev, output_lang)
+for each batch:
+    hyp, hyp_len = trim_at_eos(decoded_words)    # decoded_words from eval.evaluate
+    bleu_cal.update(hyp, hyp_len, ref_map[target], target_len - 1)
+bleu_cal.score()
+
+Corpus BLEU straight from token ids. Each batch only adds its clipped n-gram
+matches, n-gram totals and lengths to 4+4+2 counters, so nothing is kept per
+sentence. The score is the same as sacrebleu corpus_bleu(..., tokenize="none")
+on the space joined words.
+
+With sentence_stats=True the 10 counters of every sentence are kept as well
+(80 bytes a sentence) and bootstrap_ci() resamples them instead of decoding again.
+'''
+
+NGRAM_ORDER = 4
+
+
+def _signed(x):
+    x &= 2**64 - 1
+    return x - 2**64 if x >= 2**63 else x
+
+
+# multiplicative hashing of n-grams in int64, overflow wraps around
+_MIX = 0x9E3779B97F4A7C15
+_POWERS = [_signed(_MIX ** k) for k in range(NGRAM_ORDER)]
+_SENTENCE_MIX = _signed(0xC2B2AE3D27D4EB4F)
+
+
+def vocab_map(src_lang, dst_lang):
+    """
+    Map ids of src_lang to ids of dst_lang; words dst_lang does not know get a
+    distinct negative id so they only match themselves, as strings would
+    """
+    return torch.tensor([dst_lang.word2index.get(w, -1 - i) for i, w in enumerate(src_lang.index2word)])
+
+
+def trim_at_eos(tokens):
+    """
+    @return: tokens and the length of each row up to its first EOS
+    """
+    is_eos = tokens == EOS
+    lengths = torch.full((tokens.size(0),), tokens.size(1), dtype=torch.long, device=tokens.device)
+    if tokens.size(1) > 0:
+        lengths = torch.where(is_eos.any(1), is_eos.int().argmax(1), lengths)
+    return tokens, lengths
+
+
+def ngram_keys(tokens, lengths, n):
+    """
+    One int64 key per n-gram of every row, tagged with the row so counts stay per sentence
+    @return: keys and the row of each key
+    """
+    batch_size, seq_len = tokens.size()
+    if seq_len < n:
+        return tokens.new_zeros(0), tokens.new_zeros(0)
+    windows = tokens.unfold(1, n, 1) # (batch_size, seq_len - n + 1, n)
+    hashes = (windows * torch.tensor(_POWERS[:n], device=tokens.device)).sum(-1)
+    rows = torch.arange(batch_size, device=tokens.device).unsqueeze(1)
+    keys = hashes * _SENTENCE_MIX + rows
+    valid = torch.arange(seq_len - n + 1, device=tokens.device) < (lengths - n + 1).unsqueeze(1)
+    return keys[valid], rows.expand_as(keys)[valid]
+
+
+def compute_bleu(correct, total, sys_len, ref_len, smooth="exp", smooth_floor=0.0, use_effective_order=True):
+    """
+    sacrebleu's compute_bleu on corpus statistics
+    """
+    precisions = [0.] * NGRAM_ORDER
+    smooth_mteval = 1.
+    effective_order = NGRAM_ORDER
+    for n in range(NGRAM_ORDER):
+        if total[n] == 0:
+            break
+        if use_effective_order:
+            effective_order = n + 1
+        if correct[n] == 0:
+            if smooth == "exp":
+                smooth_mteval *= 2
+                precisions[n] = 100. / (smooth_mteval * total[n])
+            elif smooth == "floor":
+                precisions[n] = 100. * smooth_floor / total[n]
+        else:
+            precisions[n] = 100. * correct[n] / total[n]
+
+    brevity_penalty = 1.0
+    if sys_len < ref_len:
+        brevity_penalty = math.exp(1 - ref_len / sys_len) if sys_len > 0 else 0.0
+    log_precisions = [math.log(p) if p > 0 else -9999999999 for p in precisions[:effective_order]]
+    return brevity_penalty * math.exp(sum(log_precisions) / effective_order)
+
+
+class TokenBLEU(object):
+    """
+    Streaming corpus BLEU over token id tensors, one reference per sentence
+    @param smooth: "exp", "floor" or "none", as in sacrebleu
+    @param sentence_stats: also keep every sentence's statistics, for bootstrap_ci()
+    """
+    def __init__(self, smooth="exp", smooth_floor=0.0, use_effective_order=True, sentence_stats=False):
+        self.sentence_stats = [] if sentence_stats else None
+        self.smooth = smooth
+        self.smooth_floor = smooth_floor
+        self.use_effective_order = use_effective_order
+        self.correct = [0] * NGRAM_ORDER
+        self.total = [0] * NGRAM_ORDER
+        self.sys_len = 0
+        self.ref_len = 0
+
+    def update(self, hyp, hyp_len, ref, ref_len):
+        """
+        @param hyp, ref: (batch_size, len) id tensors in the same vocabulary
+        @param hyp_len, ref_len: (batch_size,) number of tokens to score in each row
+        """
+        ref = ref.to(hyp.device)
+        hyp_len, ref_len = hyp_len.to(hyp.device), ref_len.to(hyp.device)
+        self.sys_len += hyp_len.sum().item()
+        self.ref_len += ref_len.sum().item()
+        batch_size = hyp.size(0)
+        # per sentence: correct 1-4, total 1-4, sys_len, ref_len
+        stats = torch.zeros(batch_size, 2 * NGRAM_ORDER + 2, dtype=torch.long, device=hyp.device)
+        stats[:, -2], stats[:, -1] = hyp_len, ref_len
+        for n in range(1, NGRAM_ORDER + 1):
+            (hyp_keys, hyp_rows), (ref_keys, ref_rows) = ngram_keys(hyp, hyp_len, n), ngram_keys(ref, ref_len, n)
+            if hyp_keys.numel() == 0:
+                continue
+            keys, inverse = torch.unique(torch.cat([hyp_keys, ref_keys]), return_inverse=True)
+            hyp_counts = torch.bincount(inverse[:hyp_keys.numel()], minlength=keys.numel())
+            ref_counts = torch.bincount(inverse[hyp_keys.numel():], minlength=keys.numel())
+            clipped = torch.min(hyp_counts, ref_counts)
+            self.correct[n - 1] += clipped.sum().item()
+            self.total[n - 1] += hyp_keys.numel()
+            if self.sentence_stats is not None:
+                key_rows = torch.zeros_like(keys).scatter_(0, inverse, torch.cat([hyp_rows, ref_rows]))
+                stats[:, n - 1] = torch.bincount(key_rows, weights=clipped.double(), minlength=batch_size).long()
+                stats[:, NGRAM_ORDER + n - 1] = torch.bincount(hyp_rows, minlength=batch_size)
+        if self.sentence_stats is not None:
+            self.sentence_stats.append(stats.cpu().numpy())
+
+    def score(self):
+        return compute_bleu(self.correct, self.total, self.sys_len, self.ref_len,
+                            self.smooth, self.smooth_floor, self.use_effective_order)
+
+    def bootstrap_ci(self, n_resamples=1000, alpha=0.05, seed=0):
+        """
+        Percentile bootstrap interval of the corpus score, resampling sentences
+        @return: (low, high)
+        """
+        stats = np.concatenate(self.sentence_stats) if self.sentence_stats else np.zeros((0, 2 * NGRAM_ORDER + 2))
+        if len(stats) == 0:
+            return 0., 0.
+        rng = np.random.RandomState(seed)
+        scores = []
+        for start in range(0, n_resamples, 100):
+            # resample as sentence counts so memory does not grow with n_resamples
+            counts = rng.multinomial(len(stats), [1. / len(stats)] * len(stats), size=min(100, n_resamples - start))
+            for totals in counts.dot(stats):
+                scores.append(compute_bleu(totals[:NGRAM_ORDER], totals[NGRAM_ORDER:2 * NGRAM_ORDER],
+                                           totals[-2], totals[-1],
+                                           self.smooth, self.smooth_floor, self.use_effective_order))
+        return float(np.percentile(scores, 100 * alpha / 2)), float(np.percentile(scores, 100 * (1 - alpha / 2)))
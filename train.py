@@ -3,52 +3,125 @@ import torch.nn as nn
 from torch import optim
 from torch.optim.lr_scheduler import ExponentialLR
 import torch.nn.functional as F
+import contextlib
+import math
 import random
 import time
 from tools.helper import timeSince, showPlot
 from tools.preprocess import tensorsFromPair
 from tools.Constants import *
+from tools.distributed import broadcast_parameters, average_gradients, all_reduce_sum, broadcast_flag
+from tools.precision import autocast
+from tools.checkpoint import CheckpointManager, rng_state, set_rng_state
+from tools.async_eval import AsyncEvaluator
+from tools.batch_split import BatchSplitter, is_oom
+from tools import profiling
 from eval import test
+from models.encoder_decoder import Decoder_SelfAttn
 
-def train(source, target, source_len, target_len, encoder, decoder, encoder_optimizer, decoder_optimizer, criterion, max_length=MAX_WORD_LENGTH[1],device=DEVICE, teacher_forcing_ratio=0.5):
+def train(source, target, source_len, target_len, encoder, decoder, encoder_optimizer, decoder_optimizer, criterion, max_length=MAX_WORD_LENGTH[1],device=DEVICE, teacher_forcing_ratio=0.5, world_size=1, precision="float32", splitter=None):
     """
     source: (batch_size, max_input_len)
     target: (batch_size, max_output_len)
+    precision: the forward pass and loss run under this autocast, backward does not
+    splitter: optional tools.batch_split.BatchSplitter; the batch is then run as
+    sub-batches when it ran out of memory before (or does now), with gradients
+    accumulated so the update is the same as for the whole batch
     """
+    batch_size = source.size(0)
+    steps = target_len.max().item()
+    use_teacher_forcing = True if random.random() < teacher_forcing_ratio else False
+    padded_len = source.size(1) + target.size(1)
+    n_chunks = splitter.chunks(batch_size, padded_len) if splitter is not None else 1
+    while True:
+        encoder_optimizer.zero_grad()
+        decoder_optimizer.zero_grad()
+        try:
+            loss = 0
+            # rows are sorted by source length, so neighbouring rows pad alike
+            for rows in torch.arange(batch_size).chunk(n_chunks):
+                rows = slice(rows[0].item(), rows[-1].item() + 1)
+                loss += train_rows(source[rows], target[rows], source_len[rows], encoder, decoder, criterion, 
+                                   steps, use_teacher_forcing, device, precision, (rows.stop - rows.start) / batch_size)
+            break
+        except RuntimeError as e:
+            if splitter is None or not is_oom(e):
+                raise
+        # retried outside the except block, so the failed attempt's tensors are freed first
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        n_chunks = splitter.out_of_memory(batch_size, padded_len, n_chunks)
+    if profiling.enabled():
+        # every row is decoded for max(target_len) steps, the ones past their length are wasted
+        profiling.count("train_sentences", source.size(0))
+        profiling.count("train_tokens", target_len.sum())
+        profiling.count("train_padded_decoder_rows", target_len.max() * source.size(0) - target_len.sum())
+
+    if world_size > 1:
+        with profiling.stage("grad_sync"):
+            average_gradients(encoder, world_size)
+            average_gradients(decoder, world_size)
+    with profiling.stage("optimizer_step"):
+        torch.nn.utils.clip_grad_norm_(encoder.parameters(), 3)
+        torch.nn.utils.clip_grad_norm_(decoder.parameters(), 3)
+
+        encoder_optimizer.step()
+        decoder_optimizer.step()
+
+    return loss / steps
+
+
+def train_rows(source, target, source_len, encoder, decoder, criterion, steps, use_teacher_forcing, 
+               device, precision, weight):
+    """
+    Forward and backward of some rows of a batch, for all `steps` target positions of the batch
+    @param weight: share of the batch's rows, the per-step mean losses are scaled by it
+    @return: the rows' weighted loss
+    """
+    # the rows keep the batch's padded width: attention masks and the self attention mean depend
+    # on it, so cutting the padding would change the numbers against the unsplit batch
     encoder_hidden, encoder_c_state = encoder.initHidden(source.size(0))
-    encoder_optimizer.zero_grad()
-    decoder_optimizer.zero_grad()
     loss = 0
    
-    c, decoder_hidden, encoder_outputs, encoder_output_lengths, encoder_c_state = \
-                                                    encoder(source, encoder_hidden, source_len, encoder_c_state)
-    decoder_c_state = encoder_c_state
-    decoder_input = torch.tensor([[SOS]]*source.size(0), device=device)
+    with autocast(precision, device):
+        with profiling.stage("encoder"):
+            c, decoder_hidden, encoder_outputs, encoder_output_lengths, encoder_c_state = \
+                                                            encoder(source, encoder_hidden, source_len, encoder_c_state)
+        decoder_c_state = encoder_c_state
+        decoder_input = torch.tensor([[SOS]]*source.size(0), device=device)
 
-    use_teacher_forcing = True if random.random() < teacher_forcing_ratio else False
-    if use_teacher_forcing:
-        for di in range(target_len.max().item()):
-            decoder_output, decoder_hidden, attn, decoder_c_state = decoder(decoder_input, decoder_hidden, c, 
-                                                     encoder_outputs, encoder_output_lengths, decoder_c_state)
-            # TODO: mask out irrelevant loss
-            loss += criterion(decoder_output, target[:, di])
-            decoder_input = target[:, di].unsqueeze(1) # (batch_size, 1)
-    else:
-        for di in range(target_len.max().item()):
-            decoder_output, decoder_hidden, attn, decoder_c_state = decoder(decoder_input, decoder_hidden, c, 
-                                                     encoder_outputs, encoder_output_lengths, decoder_c_state)
-            loss += criterion(decoder_output, target[:,di])
-            topv, topi = decoder_output.topk(1)
-            decoder_input = topi.squeeze().detach().unsqueeze(1)
-
-    loss.backward()
-    torch.nn.utils.clip_grad_norm_(encoder.parameters(), 3)
-    torch.nn.utils.clip_grad_norm_(decoder.parameters(), 3)
-
-    encoder_optimizer.step()
-    decoder_optimizer.step()
-
-    return loss.item() / target_len.max().item()
+        if use_teacher_forcing and hasattr(decoder, "forward_sequence"):
+            # the whole shifted target in one call, see DecoderRNN_Attention.forward_sequence
+            decoder_inputs = torch.cat([decoder_input, target[:, :steps - 1]], dim=1)
+            with profiling.stage("decoder_sequence"):
+                decoder_outputs, decoder_hidden, attn, decoder_c_state = decoder.forward_sequence(
+                    decoder_inputs, decoder_hidden, c, encoder_outputs, encoder_output_lengths, decoder_c_state)
+            with profiling.stage("loss"):
+                for di in range(steps):
+                    loss += criterion(decoder_outputs[:, di], target[:, di])
+        elif use_teacher_forcing:
+            for di in range(steps):
+                with profiling.stage("decoder_step"):
+                    decoder_output, decoder_hidden, attn, decoder_c_state = decoder(decoder_input, decoder_hidden, c, 
+                                                             encoder_outputs, encoder_output_lengths, decoder_c_state)
+                # TODO: mask out irrelevant loss
+                with profiling.stage("loss"):
+                    loss += criterion(decoder_output, target[:, di])
+                decoder_input = target[:, di].unsqueeze(1) # (batch_size, 1)
+        else:
+            for di in range(steps):
+                with profiling.stage("decoder_step"):
+                    decoder_output, decoder_hidden, attn, decoder_c_state = decoder(decoder_input, decoder_hidden, c, 
+                                                             encoder_outputs, encoder_output_lengths, decoder_c_state)
+                with profiling.stage("loss"):
+                    loss += criterion(decoder_output, target[:,di])
+                topv, topi = decoder_output.topk(1)
+                decoder_input = topi.squeeze(1).detach().unsqueeze(1)
+
+    loss = loss * weight
+    with profiling.stage("backward"):
+        loss.backward()
+    return loss.item()
 
 # train for transformer
 # def train(source, target, source_len, target_len, encoder, decoder, encoder_optimizer, decoder_optimizer, criterion, max_length=MAX_WORD_LENGTH[1],device=DEVICE, teacher_forcing_ratio=0.5):
@@ -82,6 +155,76 @@ def train(source, target, source_len, target_len, encoder, decoder, encoder_opti
 #     return loss.item() / target_len.max().item()
 
 
+def teacher_forced(decoder, decoder_input, target_len, decoder_hidden, c, 
+                   encoder_outputs, encoder_output_lengths, decoder_c_state):
+    """
+    Decoder log probabilities for a whole teacher forced target
+    @param decoder_input: (batch_size, seq_len), SOS followed by the target shifted right
+    @return: (batch_size, seq_len, output_size)
+    """
+    if isinstance(decoder, Decoder_SelfAttn):
+        # the self attention decoder takes the whole sequence at once
+        return decoder(decoder_input, target_len, encoder_outputs, encoder_output_lengths)[0]
+    if hasattr(decoder, "forward_sequence"):
+        return decoder.forward_sequence(decoder_input, decoder_hidden, c, 
+                                        encoder_outputs, encoder_output_lengths, decoder_c_state)[0]
+    outputs = []
+    for di in range(decoder_input.size(1)):
+        decoder_output, decoder_hidden, _, decoder_c_state = decoder(decoder_input[:, di:di+1], decoder_hidden, c, 
+                                                                     encoder_outputs, encoder_output_lengths, decoder_c_state)
+        outputs.append(decoder_output)
+    return torch.stack(outputs, dim=1)
+
+
+def validate(encoder, decoder, dataloader, device=DEVICE, precision="float32"):
+    """
+    Teacher forced loss on dataloader without decoding: one no-grad pass per batch,
+    PAD positions masked out of the loss
+    @return: mean loss per target token, perplexity
+    """
+    criterion = nn.NLLLoss(ignore_index=PAD, reduction="sum")
+    total_loss = 0
+    total_tokens = 0
+    encoder.eval()
+    decoder.eval()
+    with torch.no_grad(), autocast(precision, device):
+        for (data1, data2, len1, len2) in dataloader:
+            source, target, source_len, target_len = data1.to(device), data2.to(device), len1.to(device), len2.to(device)
+            encoder_hidden, encoder_c_state = encoder.initHidden(source.size(0))
+            c, decoder_hidden, encoder_outputs, encoder_output_lengths, encoder_c_state = \
+                                                            encoder(source, encoder_hidden, source_len, encoder_c_state)
+            start = torch.full((target.size(0), 1), SOS, dtype=target.dtype, device=device)
+            decoder_input = torch.cat([start, target[:, :-1]], dim=1)
+            log_probs = teacher_forced(decoder, decoder_input, target_len, decoder_hidden, c, 
+                                       encoder_outputs, encoder_output_lengths, encoder_c_state)
+            # summed on device, read back once at the end
+            total_loss = total_loss + criterion(log_probs.reshape(-1, log_probs.size(-1)).float(), target.reshape(-1))
+            total_tokens = total_tokens + (target != PAD).sum()
+    total_tokens = int(total_tokens)
+    loss = float(total_loss) / total_tokens if total_tokens else 0.
+    return loss, math.exp(min(loss, 100))
+
+
+def report_bleu(epoch, bleu_score, decode_speed, train_speed, encoder_state, decoder_state, 
+                cur_best, fail_cnt, bleu_file, checkpoints, label):
+    """
+    Log the dev bleu of the weights from epoch and save them if they are the best so far
+    @param checkpoints: CheckpointManager to save the best model with, None to not save
+    @return: updated (cur_best, fail_cnt)
+    """
+    print('epoch %d Bleu Score %.3f, decode %.1f sentences/sec' % (epoch, bleu_score, decode_speed))
+    bleu_file.write("%s %s %s\n" % (bleu_score, train_speed, decode_speed))
+    bleu_file.flush()
+    if (bleu_score > cur_best):
+        print("found best! save model...")
+        if checkpoints is not None:
+            checkpoints.save_file(encoder_state, 'encoder' + "-" + label + '.ckpt')
+            checkpoints.save_file(decoder_state, 'decoder' + "-" + label + '.ckpt')
+            print("model saved")
+        return bleu_score, 0
+    return cur_best, fail_cnt + 1
+
+
 def trainIters(encoder, decoder, train_loader, dev_loader, \
                input_lang, output_lang, 
                input_lang_dev, output_lang_dev,
@@ -91,68 +234,180 @@ def trainIters(encoder, decoder, train_loader, dev_loader, \
                teacher_forcing_ratio=0.5, label="", 
                use_lr_scheduler = True, gamma_en = 0.9, gamma_de=0.9, 
                beam_width=3, min_len=1, n_best=1, decode_method="beam", 
-               save_result_path = '', save_model=False):
+               save_result_path = '', save_model=False, 
+               rank=0, world_size=1, train_sampler=None, precision="float32", 
+               checkpoint_dir=None, keep_checkpoints=3, resume=None, 
+               async_eval=False, eval_threads=1, validate_every=0, adaptive_split=False):
+    """
+    With world_size > 1 this runs once per rank: every rank trains on its shard
+    from train_sampler with averaged gradients, and only rank 0 evaluates, logs
+    and saves. Early stopping is broadcast from rank 0.
+    precision ("float32" or "bfloat16") is used for both training and dev decoding;
+    each bleu file line is: bleu, train sentences/sec, decode sentences/sec.
+    The full training state (models, optimizers, schedulers, RNG, epoch, best
+    bleu and early stopping count) is written to checkpoint_dir after every
+    epoch on a background thread; resume is a checkpoint path to continue from.
+    With async_eval the dev set is decoded in a separate process (eval_threads
+    intra-op threads) on a snapshot of the weights while training continues;
+    best-model saving and early stopping happen when its bleu arrives.
+    Every validate_every training steps (0 to disable) rank 0 also computes the
+    teacher forced dev loss and perplexity with validate(), logged as
+    "epoch step loss perplexity" lines of <label>-dev_loss.txt.
+    With adaptive_split a batch that runs out of memory is retried as smaller
+    sub-batches with accumulated gradients, and later batches of that length
+    are split up front (tools.batch_split); the learned budgets are checkpointed.
+    """
     start = time.time()
     num_steps = len(train_loader)
     plot_losses = []
     print_loss_total = 0  # Reset every print_every
     plot_loss_total = 0  # Reset every plot_every
     cur_best = 0
+    fail_cnt = 0
+    start_epoch = 1
+    if world_size > 1:
+        # start every rank from the weights of rank 0
+        broadcast_parameters(encoder)
+        broadcast_parameters(decoder)
 
     encoder_optimizer = optim.Adam(encoder.parameters(), lr=learning_rate, weight_decay=weight_decay)
     decoder_optimizer = optim.Adam(decoder.parameters(), lr=learning_rate, weight_decay=weight_decay)
     scheduler_encoder = ExponentialLR(encoder_optimizer, gamma_en, last_epoch=-1) 
     scheduler_decoder = ExponentialLR(decoder_optimizer, gamma_de, last_epoch=-1) 
     criterion = nn.NLLLoss()
+    splitter = BatchSplitter() if adaptive_split else None
+
+    if resume is not None:
+        state = torch.load(resume, map_location="cpu", weights_only=False)
+        encoder.load_state_dict(state["encoder"])
+        decoder.load_state_dict(state["decoder"])
+        encoder_optimizer.load_state_dict(state["encoder_optimizer"])
+        decoder_optimizer.load_state_dict(state["decoder_optimizer"])
+        scheduler_encoder.load_state_dict(state["scheduler_encoder"])
+        scheduler_decoder.load_state_dict(state["scheduler_decoder"])
+        set_rng_state(state["rng"])
+        start_epoch = state["epoch"] + 1
+        cur_best, fail_cnt, plot_losses = state["cur_best"], state["fail_cnt"], state["plot_losses"]
+        if splitter is not None:
+            splitter.budgets.update(state.get("split_budgets", {}))
+        print("resumed from %s at epoch %d" % (resume, start_epoch))
  
-    loss_file = open(save_result_path +'/%s-loss.txt'%label, 'w+')
-    bleu_file = open(save_result_path +'/%s-bleu.txt'%label, 'w+')
-    for epoch in range(1, n_iters + 1):
+    if rank == 0:
+        # keep the earlier log lines when resuming
+        mode = 'w+' if resume is None else 'a+'
+        loss_file = open(save_result_path +'/%s-loss.txt'%label, mode)
+        bleu_file = open(save_result_path +'/%s-bleu.txt'%label, mode)
+        throughput_file = open(save_result_path +'/%s-throughput.txt'%label, mode)
+        dev_loss_file = open(save_result_path +'/%s-dev_loss.txt'%label, mode) if validate_every > 0 else None
+        checkpoints = CheckpointManager(checkpoint_dir, label, keep_checkpoints)
+        evaluator = None
+        if async_eval:
+            evaluator = AsyncEvaluator(test, encoder, decoder, dev_loader, 
+                                       (input_lang, output_lang, input_lang_dev, output_lang_dev, 
+                                        beam_width, min_len, n_best, max_word_len, decode_method, device, precision, False), 
+                                       device, eval_threads)
+        train_speeds = {}
+    stop = False
+    for epoch in range(start_epoch, n_iters + 1):
         if use_lr_scheduler:
             scheduler_encoder.step()
             scheduler_decoder.step()
-        for i, (data1, data2, len1, len2) in enumerate(train_loader):
-            encoder.train()
-            decoder.train()
-            source, target, source_len, target_len = data1.to(device), data2.to(device),len1.to(device),len2.to(device)
-
-            loss = train(source, target, source_len, target_len, encoder,
-                     decoder, encoder_optimizer, decoder_optimizer, criterion, 
-                         device=device, teacher_forcing_ratio=teacher_forcing_ratio)
-            print_loss_total += loss
-            plot_loss_total += loss
-
-            if i != 0 and (i % plot_every == 0):
-                plot_loss_avg = plot_loss_total / plot_every
-                plot_losses.append(plot_loss_avg)
-                plot_loss_total = 0
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        epoch_start = time.time()
+        num_sentences = 0
+        # the profiler trace, when requested, covers the training steps of the first epoch
+        with profiling.trace() if epoch == start_epoch else contextlib.nullcontext():
+            for i, (data1, data2, len1, len2) in enumerate(profiling.timed_iter(train_loader, "data_loader")):
+                encoder.train()
+                decoder.train()
+                source, target, source_len, target_len = data1.to(device), data2.to(device),len1.to(device),len2.to(device)
+
+                loss = train(source, target, source_len, target_len, encoder,
+                         decoder, encoder_optimizer, decoder_optimizer, criterion, 
+                             device=device, teacher_forcing_ratio=teacher_forcing_ratio, 
+                             world_size=world_size, precision=precision, splitter=splitter)
+                num_sentences += source.size(0)
+                print_loss_total += loss
+                plot_loss_total += loss
+
+                if i != 0 and (i % plot_every == 0):
+                    plot_loss_avg = plot_loss_total / plot_every
+                    plot_losses.append(plot_loss_avg)
+                    plot_loss_total = 0
+                step = (epoch - 1) * num_steps + i + 1
+                if rank == 0 and validate_every > 0 and step % validate_every == 0:
+                    with profiling.stage("validate"):
+                        dev_loss, dev_ppl = validate(encoder, decoder, dev_loader, device, precision)
+                    print('step %d dev loss %.4f, perplexity %.2f' % (step, dev_loss, dev_ppl))
+                    dev_loss_file.write("%d %d %s %s\n" % (epoch, step, dev_loss, dev_ppl))
+                    dev_loss_file.flush()
+        epoch_time = time.time() - epoch_start
+        if world_size > 1:
+            num_sentences = all_reduce_sum(num_sentences)
+        if rank == 0:
+            throughput_file.write("%d %s\n" % (world_size, num_sentences / epoch_time))
+            throughput_file.flush()
         if epoch != 0 and (epoch % print_every == 0):        
             print_loss_avg = print_loss_total / len(train_loader)
+            if world_size > 1:
+                print_loss_avg = all_reduce_sum(print_loss_avg) / world_size
             print_loss_total = 0
-            print("testing..")
-            bleu_score, _ , _, _ = test(encoder, decoder, dev_loader, 
-                                    input_lang, output_lang,
-                                    input_lang_dev, output_lang_dev,
-                                    beam_width, min_len, n_best, 
-                                    max_word_len, decode_method, device)
-            print('%s epoch:(%d %d%%) step[%d %d] Average_Loss %.4f, Bleu Score %.3f' % (timeSince(start, epoch / n_iters),
-                                        epoch, epoch / n_iters * 100, i, num_steps, print_loss_avg, bleu_score))
-            loss_file.write("%s\n" % print_loss_avg)    
-            bleu_file.write("%s\n" % bleu_score)
-            if (bleu_score > cur_best):
-                print("found best! save model...")
-                fail_cnt = 0
-                if save_model:
-                    torch.save(encoder.state_dict(), 'encoder' + "-" + label + '.ckpt')
-                    torch.save(decoder.state_dict(), 'decoder' + "-" + label + '.ckpt')
-                    print("model saved")
-                cur_best = bleu_score
-            else:
-                fail_cnt += 1
-            if fail_cnt == 15:
-                print("No improvement for 15 epochs. Halt!")
-                return 0
+            stop = False
+            if rank == 0:
+                print('%s epoch:(%d %d%%) step[%d %d] Average_Loss %.4f, %.1f sentences/sec (%s)' % (
+                                            timeSince(start, epoch / n_iters), epoch, epoch / n_iters * 100, 
+                                            i, num_steps, print_loss_avg, num_sentences / epoch_time, precision))
+                loss_file.write("%s\n" % print_loss_avg)    
+                train_speeds[epoch] = num_sentences / epoch_time
+                if evaluator is not None:
+                    evaluator.submit(epoch, encoder, decoder)
+                    results = evaluator.poll()
+                else:
+                    print("testing..")
+                    test_start = time.time()
+                    bleu_score, _ , _, _ = test(encoder, decoder, dev_loader, 
+                                            input_lang, output_lang,
+                                            input_lang_dev, output_lang_dev,
+                                            beam_width, min_len, n_best, 
+                                            max_word_len, decode_method, device, precision, return_text=False)
+                    results = [(epoch, bleu_score, len(dev_loader.dataset) / (time.time() - test_start), 
+                                encoder.state_dict(), decoder.state_dict())]
+                for eval_epoch, bleu_score, decode_speed, encoder_state, decoder_state in results:
+                    cur_best, fail_cnt = report_bleu(eval_epoch, bleu_score, decode_speed, train_speeds.pop(eval_epoch), 
+                                                     encoder_state, decoder_state, cur_best, fail_cnt, 
+                                                     bleu_file, checkpoints if save_model else None, label)
+                    stop = stop or fail_cnt >= 15
+                if stop:
+                    print("No improvement for 15 epochs. Halt!")
+            if world_size > 1:
+                stop = broadcast_flag(stop)
+        if rank == 0 and checkpoint_dir:
+            checkpoints.save({"encoder": encoder.state_dict(), "decoder": decoder.state_dict(),
+                              "encoder_optimizer": encoder_optimizer.state_dict(), 
+                              "decoder_optimizer": decoder_optimizer.state_dict(),
+                              "scheduler_encoder": scheduler_encoder.state_dict(), 
+                              "scheduler_decoder": scheduler_decoder.state_dict(),
+                              "rng": rng_state(), "epoch": epoch, "cur_best": cur_best, 
+                              "fail_cnt": fail_cnt, "plot_losses": plot_losses, 
+                              "split_budgets": splitter.budgets if splitter is not None else {}}, epoch)
+        profiling.dump(epoch=epoch, rank=rank)
+        if stop:
+            break
         
         torch.cuda.empty_cache()
-    loss_file.close()
-    bleu_file.close()
+    if rank == 0:
+        if evaluator is not None:
+            # the last snapshots can still become the best model
+            for eval_epoch, bleu_score, decode_speed, encoder_state, decoder_state in evaluator.poll(block=True):
+                cur_best, fail_cnt = report_bleu(eval_epoch, bleu_score, decode_speed, train_speeds.pop(eval_epoch), 
+                                                 encoder_state, decoder_state, cur_best, fail_cnt, 
+                                                 bleu_file, checkpoints if save_model else None, label)
+            evaluator.close()
+        loss_file.close()
+        bleu_file.close()
+        throughput_file.close()
+        if dev_loss_file is not None:
+            dev_loss_file.close()
+        checkpoints.close()
+    return 0
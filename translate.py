@@ -0,0 +1,246 @@
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import time
+import torch
+from tools.Constants import PAD, DEVICE
+from tools.preprocess import normalizeSource, tensorFromSentence
+from eval import evaluate, word_array, ids_to_sentences
+from tools.token_bleu import trim_at_eos
+from tools.segment import split_document
+
+
+class Translator(object):
+    """
+    Translate raw source sentences with a trained encoder/decoder pair.
+    Sentences are cleaned the same way as readLangs, sorted by length,
+    padded into batches of at most batch_size and decoded with evaluate().
+    Identical sources are decoded once, and looked up first in the optional
+    TranslationCache under (source, label, decode settings); label has to tell
+    apart every model variant (checkpoint, quantized, exported, precision).
+    """
+    def __init__(self, encoder, decoder, input_lang, output_lang, max_length,
+                 language, char=True, method="greedy", beam_width=10, min_len=5, n_best=5,
+                 batch_size=64, device=DEVICE, cache=None, label=""):
+        self.encoder = encoder
+        self.decoder = decoder
+        self.input_lang = input_lang
+        self.output_lang = output_lang
+        self.output_words = word_array(output_lang)
+        self.max_length = max_length
+        self.language = language
+        self.char = char
+        self.method = method
+        self.beam_width = beam_width
+        self.min_len = min_len
+        self.n_best = n_best
+        self.batch_size = batch_size
+        self.device = device
+        self.cache = cache
+        self.label = label
+        self.encoder.eval()
+        self.decoder.eval()
+
+    def normalize(self, sentence):
+        return normalizeSource(sentence, self.language, self.char)
+
+    def translate(self, sentences):
+        """
+        @param sentences: list of raw source sentences
+        @output: list of translations, in the same order as sentences
+        """
+        return self.translate_normalized([self.normalize(s) for s in sentences])
+
+    def translate_documents(self, documents, max_tokens=None):
+        """
+        @param documents: list of raw source paragraphs or documents
+        @param max_tokens: sentences with more source tokens are cut again at clause punctuation
+        @output: list of translations, each laid out with the whitespace of its document
+        Sentences of all documents are pooled, so translate() sorts and batches them together.
+        """
+        count = lambda text: len(self.normalize(text).split())
+        split = [split_document(document, self.language, max_tokens, count) for document in documents]
+        sentences = [self.normalize(sentence) for _, pieces in split for sentence, _ in pieces]
+        # sentences that normalize to nothing, e.g. a lone bracket, translate to nothing
+        translated = iter(self.translate_normalized([sentence for sentence in sentences if sentence]))
+        translations = iter([next(translated) if sentence else "" for sentence in sentences])
+        results = []
+        for leading, pieces in split:
+            text = leading
+            for i, (_, whitespace) in enumerate(pieces):
+                # chinese has no space between sentences, the english translation needs one
+                if not whitespace and i < len(pieces) - 1:
+                    whitespace = " "
+                text += next(translations) + whitespace
+            results.append(text)
+        return results
+
+    def translate_normalized(self, sources):
+        """
+        @param sources: list of sentences already cleaned by normalize()
+        """
+        translations = [None] * len(sources)
+        pending = {} # source -> positions waiting for its translation
+        for i, source in enumerate(sources):
+            if self.cache is not None and source not in pending:
+                translations[i] = self.cache.get(self.cache_key(source))
+            if translations[i] is None:
+                pending.setdefault(source, []).append(i)
+
+        unique = list(pending)
+        indexes = [tensorFromSentence(self.input_lang, s) for s in unique]
+        # pack_padded_sequence needs every batch sorted by decreasing length
+        order = sorted(range(len(indexes)), key=lambda i: -len(indexes[i]))
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            for i, words in zip(batch, self.decode_batch([indexes[i] for i in batch])):
+                if self.cache is not None:
+                    self.cache.put(self.cache_key(unique[i]), words)
+                for j in pending[unique[i]]:
+                    translations[j] = words
+        return translations
+
+    def cache_key(self, source):
+        return (source, self.label, self.method, self.beam_width, self.min_len, self.n_best)
+
+    def decode_batch(self, indexes):
+        """
+        @param indexes: list of source index lists sorted by decreasing length
+        """
+        source_len = torch.LongTensor([len(ids) for ids in indexes])
+        source = torch.LongTensor(len(indexes), source_len.max().item()).fill_(PAD)
+        for i, ids in enumerate(indexes):
+            source[i, :len(ids)] = torch.LongTensor(ids)
+        source, source_len = source.to(self.device), source_len.to(self.device)
+
+        decoded_words, _ = evaluate(self.encoder, self.decoder, source, source_len, self.max_length,
+                                    self.beam_width, self.min_len, self.n_best, self.method, self.device)
+        hyp, hyp_len = trim_at_eos(decoded_words)
+        return ids_to_sentences(hyp.cpu().numpy(), hyp_len.cpu().numpy(), self.output_words)
+
+
+def chunk_offsets(path, chunk_size):
+    """
+    Byte offset and line count of every chunk of chunk_size lines in path
+    """
+    chunks = []
+    with open(path, "rb") as f:
+        offset, n_lines = 0, 0
+        for line in f:
+            n_lines += 1
+            if n_lines == chunk_size:
+                chunks.append((offset, n_lines))
+                offset, n_lines = f.tell(), 0
+        if n_lines:
+            chunks.append((offset, n_lines))
+    return chunks
+
+
+_worker = {}
+
+def _init_worker(translator, threads, next_worker):
+    # ctrl-c is handled by the parent, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    torch.set_num_threads(threads)
+    with next_worker.get_lock():
+        k = next_worker.value
+        next_worker.value += 1
+    # pin each worker to its own cores when there are enough of them
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        if len(cores) >= (k + 1) * threads:
+            os.sched_setaffinity(0, cores[k * threads:(k + 1) * threads])
+    if translator.cache is not None:
+        # the worker's cache is a copy, its new entries go back to the parent with each chunk
+        translator.cache.record_added()
+    _worker["translator"] = translator
+
+
+def _translate_chunk(task):
+    input_path, offset, n_lines, part, documents = task
+    with open(input_path, "rb") as f:
+        f.seek(offset)
+        lines = [f.readline().decode("utf-8").rstrip("\r\n") for _ in range(n_lines)]
+    translator = _worker["translator"]
+    # translate() sorts the whole chunk by length, so batches are dense
+    if documents:
+        translations = translator.translate_documents([line for line in lines if line.strip()], 
+                                                      max_tokens=documents)
+    else:
+        translations = translator.translate([line for line in lines if line.strip()])
+    translations = iter(translations)
+    with open(part + ".tmp", "w", encoding="utf-8") as f:
+        for line in lines:
+            f.write((next(translations) if line.strip() else "") + "\n")
+    os.replace(part + ".tmp", part)
+    return n_lines, translator.cache.take_added() if translator.cache is not None else []
+
+
+def translate_file(translator, input_path, output_path, num_procs=1, chunk_size=10000, threads_per_proc=1, 
+                   documents=None):
+    """
+    Translate input_path line by line into output_path with num_procs worker processes.
+    documents: None, or the max source tokens per sentence to treat every line as a
+    paragraph or document that is split into sentences (Translator.translate_documents).
+    Every finished chunk is kept under output_path.parts until the final merge, so
+    running the same command again after an interruption only translates what is missing.
+    Translations the workers add to the cache are merged into translator.cache; saving it is
+    up to the caller. A CUDA translator runs the chunks in this process: forking after CUDA
+    is initialized is unsupported, and one process already keeps the GPU busy with batches.
+    """
+    parts_dir = output_path + ".parts"
+    meta = {"input": os.path.abspath(input_path), "size": os.path.getsize(input_path), "chunk_size": chunk_size, 
+            "documents": documents}
+    os.makedirs(parts_dir, exist_ok=True)
+    meta_path = os.path.join(parts_dir, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) != meta:
+                raise ValueError("%s belongs to a different input or chunk size, remove it to start over" % parts_dir)
+    else:
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+
+    chunks = chunk_offsets(input_path, chunk_size)
+    parts = [os.path.join(parts_dir, "%08d.txt" % i) for i in range(len(chunks))]
+    tasks = [(input_path, offset, n_lines, part, documents) for (offset, n_lines), part in zip(chunks, parts)
+             if not os.path.exists(part)]
+    total = sum(n_lines for _, n_lines in chunks)
+    done = total - sum(task[2] for task in tasks)
+    print("translating %d lines in %d chunks, %d lines already done" % (total, len(chunks), done))
+
+    start, translated = time.time(), 0
+    if torch.device(translator.device).type == "cuda":
+        if num_procs > 1:
+            print("translating on %s in one process, num_procs is ignored" % translator.device)
+        _worker["translator"] = translator
+        results, pool = map(_translate_chunk, tasks), None
+    else:
+        context = multiprocessing.get_context("fork")
+        pool = context.Pool(num_procs, initializer=_init_worker,
+                            initargs=(translator, threads_per_proc, context.Value("i", 0)))
+        results = pool.imap_unordered(_translate_chunk, tasks)
+    try:
+        for n_lines, added in results:
+            translated += n_lines
+            for key, translation in added:
+                translator.cache.put(key, translation)
+            print("%d/%d lines, %.1f lines/sec" % (done + translated, total, translated / (time.time() - start)))
+        if pool is not None:
+            pool.close()
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+
+    with open(output_path + ".tmp", "w", encoding="utf-8") as out:
+        for part in parts:
+            with open(part, encoding="utf-8") as f:
+                shutil.copyfileobj(f, out)
+    os.replace(output_path + ".tmp", output_path)
+    shutil.rmtree(parts_dir)